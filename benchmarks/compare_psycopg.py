@@ -0,0 +1,203 @@
+"""
+Side-by-side latency comparison of the psycopg 3 data layer against the
+previous psycopg2 implementation (a fresh connection per call, SELECT then
+UPDATE/INSERT, four sequential SELECTs in get_all_user_data and the
+check_and_init_db catalog queries before every conditions read/write).
+
+Usage (against a scratch database configured through the usual DB_* variables):
+    pip install psycopg2-binary
+    python benchmarks/compare_psycopg.py --iterations 200
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+import uuid
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import database
+
+try:
+    import psycopg2
+except ImportError:
+    psycopg2 = None
+
+PROFILE = {'resourceType': 'Patient', 'name': [{'text': 'Benchmark Patient'}], 'gender': 'female'}
+CONDITIONS = [
+    {'resource': {'resourceType': 'Condition', 'id': f'c{i}',
+                  'code': {'text': f'Condition {i}'},
+                  'assertedDate': '2020-01-01',
+                  'clinicalStatus': {'coding': [{'code': 'active'}]}}}
+    for i in range(50)
+]
+
+
+def legacy_connect():
+    return psycopg2.connect(
+        host=os.getenv('DB_HOST'),
+        port=os.getenv('DB_PORT'),
+        database=os.getenv('DB_NAME'),
+        user=os.getenv('DB_USER'),
+        password=os.getenv('DB_PASSWORD')
+    )
+
+
+def legacy_check_tables():
+    conn = legacy_connect()
+    cur = conn.cursor()
+    for table in ('users', 'profiles', 'conditions', 'family_history'):
+        cur.execute("""
+            SELECT EXISTS (
+                SELECT FROM information_schema.tables
+                WHERE table_name = %s
+            );
+        """, (table,))
+        cur.fetchone()
+    conn.commit()
+    cur.close()
+    conn.close()
+
+
+def legacy_save_profile(user_id, gorilla_id, profile_data):
+    conn = legacy_connect()
+    cur = conn.cursor()
+    cur.execute("SELECT id FROM profiles WHERE user_id = %s", (user_id,))
+    if cur.fetchone():
+        cur.execute("""
+            UPDATE profiles SET gorilla_id = %s, profile_data = %s, updated_at = CURRENT_TIMESTAMP
+            WHERE user_id = %s RETURNING id
+        """, (gorilla_id, database.json.dumps(profile_data), user_id))
+    else:
+        cur.execute("""
+            INSERT INTO profiles (user_id, gorilla_id, profile_data) VALUES (%s, %s, %s) RETURNING id
+        """, (user_id, gorilla_id, database.json.dumps(profile_data)))
+    cur.fetchone()
+    conn.commit()
+    cur.close()
+    conn.close()
+
+
+def legacy_get_profile(user_id):
+    conn = legacy_connect()
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT id, gorilla_id, profile_data, created_at, updated_at FROM profiles WHERE user_id = %s
+    """, (user_id,))
+    cur.fetchone()
+    cur.close()
+    conn.close()
+
+
+def legacy_save_conditions(user_id, gorilla_id, api_response):
+    legacy_check_tables()
+    conn = legacy_connect()
+    cur = conn.cursor()
+    cur.execute("SELECT id FROM conditions WHERE user_id = %s", (user_id,))
+    if cur.fetchone():
+        cur.execute("""
+            UPDATE conditions SET api_response = %s, gorilla_id = %s, updated_at = CURRENT_TIMESTAMP
+            WHERE user_id = %s RETURNING id
+        """, (database.json.dumps(api_response), gorilla_id, user_id))
+    else:
+        cur.execute("""
+            INSERT INTO conditions (user_id, gorilla_id, api_response) VALUES (%s, %s, %s) RETURNING id
+        """, (user_id, gorilla_id, database.json.dumps(api_response)))
+    cur.fetchone()
+    conn.commit()
+    cur.close()
+    conn.close()
+
+
+def legacy_get_conditions(user_id):
+    legacy_check_tables()
+    conn = legacy_connect()
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT id, gorilla_id, api_response, created_at, updated_at FROM conditions WHERE user_id = %s
+    """, (user_id,))
+    cur.fetchone()
+    cur.close()
+    conn.close()
+
+
+def legacy_get_all_user_data(user_id):
+    conn = legacy_connect()
+    cur = conn.cursor()
+    cur.execute("SELECT id, username, email, created_at FROM users WHERE id = %s", (user_id,))
+    cur.fetchone()
+    for table, column in (('profiles', 'profile_data'), ('conditions', 'api_response'),
+                          ('family_history', 'api_response')):
+        cur.execute(f"SELECT gorilla_id, {column}, created_at, updated_at FROM {table} WHERE user_id = %s",
+                    (user_id,))
+        cur.fetchone()
+    cur.close()
+    conn.close()
+
+
+def measure(fn, iterations):
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    return {
+        'mean': statistics.mean(timings),
+        'p50': timings[len(timings) // 2],
+        'p95': timings[min(len(timings) - 1, int(len(timings) * 0.95))],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=200)
+    args = parser.parse_args()
+
+    if psycopg2 is None:
+        sys.exit("psycopg2 is required for the legacy side of the comparison: pip install psycopg2-binary")
+    if not database.init_db():
+        sys.exit("Could not initialize the database")
+
+    name = f"bench_{uuid.uuid4().hex[:12]}"
+    user_id = database.create_user(name, f"{name}@example.com", "x")
+    database.save_profile(user_id, 'BENCH', PROFILE)
+    database.save_conditions(user_id, 'BENCH', CONDITIONS)
+
+    cases = [
+        ('save_profile',
+         lambda: legacy_save_profile(user_id, 'BENCH', PROFILE),
+         lambda: database.save_profile(user_id, 'BENCH', PROFILE)),
+        ('get_profile_by_user_id',
+         lambda: legacy_get_profile(user_id),
+         lambda: database.get_profile_by_user_id(user_id)),
+        ('save_conditions',
+         lambda: legacy_save_conditions(user_id, 'BENCH', CONDITIONS),
+         lambda: database.save_conditions(user_id, 'BENCH', CONDITIONS)),
+        ('get_conditions_by_user_id',
+         lambda: legacy_get_conditions(user_id),
+         lambda: database.get_conditions_by_user_id(user_id)),
+        ('get_all_user_data',
+         lambda: legacy_get_all_user_data(user_id),
+         lambda: database.get_all_user_data(user_id)),
+    ]
+
+    print(f"{'operation':<28}{'psycopg2 mean/p50/p95 (ms)':>30}{'psycopg 3 mean/p50/p95 (ms)':>31}{'speedup':>10}")
+    for label, legacy_fn, new_fn in cases:
+        legacy = measure(legacy_fn, args.iterations)
+        new = measure(new_fn, args.iterations)
+        print(f"{label:<28}"
+              f"{legacy['mean']:>12.2f}{legacy['p50']:>9.2f}{legacy['p95']:>9.2f}"
+              f"{new['mean']:>13.2f}{new['p50']:>9.2f}{new['p95']:>9.2f}"
+              f"{legacy['mean'] / new['mean']:>9.1f}x")
+
+    conn = database.get_db_connection()
+    try:
+        conn.execute("DELETE FROM users WHERE id = %s", (user_id,))
+        conn.commit()
+    finally:
+        database.release_db_connection(conn)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,289 @@
+"""
+Benchmark the database.py data layer at realistic data scale.
+
+The database is filled (with COPY, through database.bulk_import_users) up to
+each --scales user count in turn. Filler users get a few dozen conditions
+and family members each. At every scale, one probe user per --histories
+size is timed on save_profile, save_conditions, get_conditions_by_user_id,
+get_condition_summaries (all years and one year), check_duplicate_condition,
+check_duplicate_family_history and get_all_user_data, along with the
+clinic-wide cohort_analytics queries.
+Throughput and p50/p95/p99 latency are printed per
+operation, scale and history size.
+
+--output writes the results as a JSON baseline; --compare prints the change
+against an earlier baseline, so a data-layer change can be measured before
+it ships. The read cache is off unless --cache is given, so reads reach
+Postgres. Benchmark users are deleted at the end unless --keep is given.
+
+Usage (against a scratch database configured through the usual DB_* variables):
+    python benchmarks/data_layer.py --output baseline.json
+    python benchmarks/data_layer.py --scales 1000,10000 --compare baseline.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import time
+import uuid
+from datetime import datetime, timezone
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import cohort_analytics
+import database
+
+STATUSES = ('active', 'inactive', 'resolved', 'remission')
+RELATIONSHIPS = ('Mother', 'Father', 'Sister', 'Brother', 'Maternal grandmother',
+                 'Paternal grandfather', 'Aunt', 'Uncle')
+ICD10_CODES = ('E11.9', 'E11.65', 'I10', 'E78.5', 'J45.909', 'F32.9', 'M17.11', 'E03.9', 'K21.9', 'N18.3')
+
+OPERATIONS = (
+    'save_profile',
+    'save_conditions',
+    'get_conditions_by_user_id',
+    'get_condition_summaries',
+    'get_condition_summaries_year',
+    'check_duplicate_condition',
+    'check_duplicate_family_history',
+    'get_all_user_data',
+    'count_users_with_code',
+    'get_condition_onset_years',
+    'get_family_history_prevalence',
+)
+
+
+def make_profile(rng, patient_id):
+    return {
+        'resourceType': 'Patient',
+        'id': patient_id,
+        'name': [{'given': ['Bench'], 'family': patient_id, 'text': f"Bench {patient_id}"}],
+        'gender': rng.choice(('female', 'male')),
+        'birthDate': f"{rng.randint(1930, 2015)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+        'address': [{'line': ['1 Main St'], 'city': 'Chicago', 'state': 'IL', 'postalCode': '60601'}],
+    }
+
+
+def make_conditions(rng, count):
+    conditions = []
+    for i in range(count):
+        year = rng.randint(1990, 2025)
+        conditions.append({'resource': {
+            'resourceType': 'Condition',
+            'id': uuid.uuid4().hex,
+            'code': {
+                'coding': [{'system': 'http://snomed.info/sct', 'code': str(100000 + rng.randint(0, 5000)),
+                            'display': f"Condition {rng.randint(0, 5000)}"},
+                           {'system': 'http://hl7.org/fhir/sid/icd-10-cm', 'code': rng.choice(ICD10_CODES)}],
+                'text': f"Condition {i}",
+            },
+            'clinicalStatus': {'coding': [{'code': rng.choice(STATUSES)}]},
+            'assertedDate': f"{year}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+            'onsetDateTime': f"{year}-01-01",
+            'note': [{'text': "Recorded during a routine visit."}],
+        }})
+    return conditions
+
+
+def make_family_history(rng, count):
+    return [{'resource': {
+        'resourceType': 'FamilyMemberHistory',
+        'id': uuid.uuid4().hex,
+        'status': 'completed',
+        'relationship': {'text': rng.choice(RELATIONSHIPS)},
+        'gender': rng.choice(('female', 'male')),
+        'bornDate': f"{rng.randint(1920, 2000)}-01-01",
+        'condition': [{'code': {'text': f"Condition {rng.randint(0, 5000)}", 'coding': [
+            {'system': 'http://hl7.org/fhir/sid/icd-10-cm', 'code': rng.choice(ICD10_CODES)}]}}],
+    }} for _ in range(count)]
+
+
+def make_record(rng, prefix, n, conditions, family_members):
+    patient_id = f"{prefix}{n}"
+    return {
+        'username': patient_id,
+        'email': f"{patient_id}@bench.invalid",
+        'password_hash': 'x',
+        'gorilla_id': patient_id,
+        'profile_data': make_profile(rng, patient_id),
+        'conditions': make_conditions(rng, conditions),
+        'family_history': make_family_history(rng, family_members),
+    }
+
+
+def fill(rng, prefix, start, stop, batch_size):
+    """
+    Add filler users start..stop-1 with small, varied histories
+    """
+    began = time.monotonic()
+    for first in range(start, stop, batch_size):
+        batch = [make_record(rng, prefix, n, rng.randint(5, 40), rng.randint(2, 12))
+                 for n in range(first, min(first + batch_size, stop))]
+        if database.bulk_import_users(batch) is None:
+            sys.exit("Loading benchmark users failed")
+    elapsed = time.monotonic() - began
+    if stop > start:
+        print(f"loaded {stop - start} users in {elapsed:.1f}s", file=sys.stderr)
+
+
+def analyze():
+    conn = database.get_db_connection()
+    try:
+        for table in ('users', 'profiles', 'conditions', 'family_history', 'cohort_facts', 'cohort_rollups'):
+            conn.execute(f"ANALYZE {table}")
+        conn.commit()
+    finally:
+        database.release_db_connection(conn)
+
+
+def measure(fn, iterations, warmup):
+    for _ in range(warmup):
+        fn()
+    timings = []
+    began = time.perf_counter()
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1000)
+    total = time.perf_counter() - began
+    timings.sort()
+
+    def pct(q):
+        return timings[min(len(timings) - 1, int(len(timings) * q))]
+
+    return {
+        'iterations': iterations,
+        'ops_per_sec': iterations / total if total else 0.0,
+        'mean_ms': sum(timings) / len(timings),
+        'p50_ms': pct(0.50),
+        'p95_ms': pct(0.95),
+        'p99_ms': pct(0.99),
+        'max_ms': timings[-1],
+    }
+
+
+def probe_cases(rng, user_id, gorilla_id, history):
+    profile = make_profile(rng, gorilla_id)
+    conditions = make_conditions(rng, history)
+    new_condition = make_conditions(rng, 1)[0]
+    new_member = make_family_history(rng, 1)[0]
+    return {
+        'save_profile': lambda: database.save_profile(user_id, gorilla_id, profile),
+        'save_conditions': lambda: database.save_conditions(user_id, gorilla_id, conditions),
+        'get_conditions_by_user_id': lambda: database.get_conditions_by_user_id(user_id),
+        'get_condition_summaries': lambda: database.get_condition_summaries(user_id),
+        'get_condition_summaries_year': lambda: database.get_condition_summaries(
+            user_id, year=conditions[0]['resource']['assertedDate'][:4]),
+        'check_duplicate_condition': lambda: database.check_duplicate_condition(user_id, new_condition),
+        'check_duplicate_family_history': lambda: database.check_duplicate_family_history(user_id, new_member),
+        'get_all_user_data': lambda: database.get_all_user_data(user_id),
+        # Clinic-wide, so the same at every history size
+        'count_users_with_code': lambda: cohort_analytics.count_users_with_code('E11.*'),
+        'get_condition_onset_years': cohort_analytics.get_condition_onset_years,
+        'get_family_history_prevalence': lambda: cohort_analytics.get_family_history_prevalence('E11'),
+    }
+
+
+def compare(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = {(r['scale'], r['history'], r['operation']): r for r in json.load(f)['results']}
+    print(f"\nchange against {baseline_path} (negative is faster)")
+    print(f"{'users':>8}{'history':>9}  {'operation':<32}{'p50':>9}{'p95':>9}{'p99':>9}{'ops/s':>9}")
+    for r in results:
+        old = baseline.get((r['scale'], r['history'], r['operation']))
+        if old is None:
+            continue
+
+        def delta(key):
+            return f"{(r[key] / old[key] - 1) * 100:+.0f}%" if old[key] else "n/a"
+
+        print(f"{r['scale']:>8}{r['history']:>9}  {r['operation']:<32}"
+              f"{delta('p50_ms'):>9}{delta('p95_ms'):>9}{delta('p99_ms'):>9}{delta('ops_per_sec'):>9}")
+
+
+def cleanup(prefix):
+    conn = database.get_db_connection()
+    try:
+        # Profiles, conditions and family history go with the users. The
+        # prefix contains '_', which LIKE would treat as a wildcard
+        conn.execute("DELETE FROM users WHERE starts_with(username, %s)", (prefix,))
+        conn.commit()
+    finally:
+        database.release_db_connection(conn)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scales', default='1000,10000,100000',
+                        help="comma-separated total user counts (default 1000,10000,100000)")
+    parser.add_argument('--histories', default='10,100,500,2000',
+                        help="comma-separated probe history sizes in conditions (default 10,100,500,2000)")
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--batch-size', type=int, default=1000,
+                        help="users per COPY batch while filling (default 1000)")
+    parser.add_argument('--seed', type=int, default=595)
+    parser.add_argument('--cache', action='store_true', help="leave the read cache on")
+    parser.add_argument('--output', help="write the results to this JSON baseline file")
+    parser.add_argument('--compare', help="compare against an earlier JSON baseline")
+    parser.add_argument('--keep', action='store_true', help="keep the benchmark users afterwards")
+    args = parser.parse_args()
+
+    scales = sorted(int(s) for s in args.scales.split(','))
+    histories = [int(h) for h in args.histories.split(',')]
+    rng = random.Random(args.seed)
+    database._cache.enabled = args.cache
+
+    if not database.init_db():
+        sys.exit("Could not initialize the database")
+
+    prefix = f"bench_{uuid.uuid4().hex[:8]}_"
+    results = []
+    try:
+        # The probe users count towards the first scale
+        probes = {}
+        for history in histories:
+            record = make_record(rng, f"{prefix}probe{history}_", 0, history, max(2, history // 20))
+            user_ids = database.bulk_import_users([record])
+            if not user_ids:
+                sys.exit("Creating probe users failed")
+            probes[history] = (user_ids[record['username']], record['gorilla_id'])
+
+        loaded = len(histories)
+        print(f"{'users':>8}{'history':>9}  {'operation':<32}{'ops/s':>9}"
+              f"{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+        for scale in scales:
+            fill(rng, prefix, loaded, scale, args.batch_size)
+            loaded = max(loaded, scale)
+            analyze()
+            for history in histories:
+                user_id, gorilla_id = probes[history]
+                cases = probe_cases(rng, user_id, gorilla_id, history)
+                for operation in OPERATIONS:
+                    stats = measure(cases[operation], args.iterations, args.warmup)
+                    results.append({'scale': scale, 'history': history, 'operation': operation, **stats})
+                    print(f"{scale:>8}{history:>9}  {operation:<32}{stats['ops_per_sec']:>9.0f}"
+                          f"{stats['p50_ms']:>9.2f}{stats['p95_ms']:>9.2f}{stats['p99_ms']:>9.2f}")
+    finally:
+        if not args.keep:
+            cleanup(prefix)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'created_at': datetime.now(timezone.utc).isoformat(),
+                'python': platform.python_version(),
+                'host': os.getenv('DB_HOST'),
+                'iterations': args.iterations,
+                'cache': args.cache,
+                'seed': args.seed,
+                'results': results,
+            }, f, indent=2)
+        print(f"\nwrote {args.output}", file=sys.stderr)
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
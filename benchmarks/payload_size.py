@@ -0,0 +1,195 @@
+"""
+Measure what the FHIR payload minimizer (fhir_minimizer.py) saves.
+
+A dataset of --users conditions and family history documents is generated
+in the shapes the app stores: upstream-style conditions with meta blocks
+and narratives, form-built conditions, and family members whose conditions
+each carry the IMO search data of every condition selected with them. For
+each minimizer mode the documents are serialized, and, unless --offline is
+given, written to a temporary table to measure their stored (TOAST
+compressed) size and the latency of reading one document back and
+rehydrating it.
+
+Usage (the database part uses the usual DB_* variables; nothing persists):
+    python benchmarks/payload_size.py --users 2000
+    python benchmarks/payload_size.py --offline --output payload.json
+"""
+import argparse
+import copy
+import json
+import os
+import random
+import sys
+import time
+import uuid
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import database
+from fhir_minimizer import MODES, PayloadMinimizer, IMO_EXTENSION_URL
+from psycopg.types.json import Jsonb
+
+XHTML = '<div xmlns="http://www.w3.org/1999/xhtml">{}</div>'
+CONDITION_NAMES = ('Type 2 diabetes mellitus', 'Essential hypertension', 'Asthma', 'Hyperlipidemia',
+                   'Major depressive disorder', 'Osteoarthritis of knee', 'Hypothyroidism',
+                   'Gastroesophageal reflux disease', 'Migraine', 'Chronic kidney disease stage 3')
+RELATIONSHIPS = (('Father', 'FTH'), ('Mother', 'MTH'), ('Sibling', 'SIB'), ('Grandparent', 'GRPRN'))
+STATUSES = ('active', 'inactive', 'resolved')
+
+
+def make_condition(rng, upstream):
+    name = rng.choice(CONDITION_NAMES)
+    status = rng.choice(STATUSES)
+    resource = {
+        'resourceType': 'Condition',
+        'id': uuid.uuid4().hex,
+        'code': {
+            'text': name,
+            'coding': [{'system': 'http://snomed.info/sct', 'code': str(rng.randint(10000, 99999)),
+                        'display': name}],
+        },
+        'assertedDate': f"{rng.randint(2000, 2025)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+        'clinicalStatus': {'coding': [{
+            'system': 'http://terminology.hl7.org/CodeSystem/condition-clinical',
+            'code': status, 'display': status.capitalize()}]},
+        'category': [{'coding': [{
+            'system': 'http://terminology.hl7.org/CodeSystem/condition-category',
+            'code': 'PROBLEM', 'display': 'Problem'}]}],
+        'text': {'status': 'generated',
+                 'div': XHTML.format(name if rng.random() < 0.7 else f"{name}, noted during a routine visit")},
+    }
+    if upstream:
+        resource['verificationStatus'] = {'coding': [{
+            'system': 'http://terminology.hl7.org/CodeSystem/condition-ver-status', 'code': 'confirmed'}]}
+        resource['meta'] = {'versionId': str(rng.randint(1, 9)), 'lastUpdated': '2024-05-01T10:00:00Z',
+                            'source': 'https://api.healthgorilla.com'}
+    return {'resource': resource}
+
+
+def make_family_member(rng):
+    relationship, code = rng.choice(RELATIONSHIPS)
+    names = rng.sample(CONDITION_NAMES, rng.randint(1, 4))
+    # The family history form attaches every selected condition's IMO data
+    # (and the cause-of-death flag) to each condition
+    extensions = [{
+        'url': IMO_EXTENSION_URL,
+        'valueString': json.dumps({
+            'kndg_title': name, 'ICD10CM_TITLE': name, 'SNOMEDCT_TITLE': name,
+            'kndg_id': str(rng.randint(100000, 999999)), 'ICD10CM_CODE': f"E{rng.randint(10, 99)}.{rng.randint(0, 9)}",
+            'SNOMEDCT_CODE': str(rng.randint(10000, 99999)),
+        }),
+    } for name in names]
+    if rng.random() < 0.2:
+        extensions.insert(0, {
+            'url': 'https://www.healthgorilla.com/fhir/StructureDefinition/familymemberhistory-cause-of-death',
+            'valueBoolean': True})
+    return {'resource': {
+        'resourceType': 'FamilyMemberHistory',
+        'id': uuid.uuid4().hex,
+        'relationship': {'text': relationship, 'coding': [{
+            'code': code, 'display': relationship, 'system': 'urn:oid:2.16.840.1.113883.5.111'}]},
+        'gender': rng.choice(('male', 'female')),
+        'condition': [{
+            'code': {'text': name, 'coding': [{'display': name}]},
+            'onsetAge': {'value': rng.randint(20, 80), 'unit': 'a'} if rng.random() < 0.5 else None,
+            'extension': copy.deepcopy(extensions),
+        } for name in names],
+        'note': None,
+        'status': 'health-unknown',
+    }}
+
+
+def make_dataset(rng, users):
+    documents = []
+    for _ in range(users):
+        documents.append(('conditions', [make_condition(rng, rng.random() < 0.5)
+                                         for _ in range(rng.randint(5, 40))]))
+        documents.append(('family_history', {'resourceType': 'Bundle', 'type': 'searchset',
+                                             'entry': [make_family_member(rng) for _ in range(rng.randint(2, 8))]}))
+    return documents
+
+
+def read_latency(cur, minimizer, ids, iterations):
+    timings = []
+    for _ in range(iterations):
+        doc_id = random.choice(ids)
+        start = time.perf_counter()
+        cur.execute("SELECT doc FROM payload_bench WHERE id = %s", (doc_id,), prepare=True)
+        minimizer.rehydrate(cur.fetchone()[0])
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    return timings[len(timings) // 2], timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+
+
+def measure_stored(documents, iterations):
+    """
+    Store every mode's documents in a temporary table and measure their
+    size on disk and the latency of reading one back
+    """
+    conn = database.get_db_connection()
+    if not conn:
+        sys.exit("Could not connect to the database")
+    cur = conn.cursor()
+    results = {}
+    try:
+        cur.execute("CREATE TEMP TABLE payload_bench (id SERIAL PRIMARY KEY, mode TEXT, doc JSONB)")
+        for mode in MODES:
+            minimizer = PayloadMinimizer(mode)
+            with cur.copy("COPY payload_bench (mode, doc) FROM STDIN") as copy_:
+                for _, document in documents:
+                    copy_.write_row((mode, Jsonb(minimizer.minimize(document))))
+            cur.execute("SELECT array_agg(id), sum(pg_column_size(doc)) FROM payload_bench WHERE mode = %s",
+                        (mode,))
+            ids, stored = cur.fetchone()
+            cur.execute("ANALYZE payload_bench")
+            p50, p95 = read_latency(cur, minimizer, ids, iterations)
+            results[mode] = {'stored_bytes': int(stored), 'read_p50_ms': p50, 'read_p95_ms': p95}
+        conn.rollback()
+    finally:
+        cur.close()
+        database.release_db_connection(conn)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=1000, help="users to generate (default 1000)")
+    parser.add_argument('--iterations', type=int, default=500, help="document reads per mode (default 500)")
+    parser.add_argument('--seed', type=int, default=595)
+    parser.add_argument('--offline', action='store_true', help="only measure serialized sizes")
+    parser.add_argument('--output', help="write the results to this JSON file")
+    args = parser.parse_args()
+
+    documents = make_dataset(random.Random(args.seed), args.users)
+    results = {}
+    for mode in MODES:
+        minimizer = PayloadMinimizer(mode)
+        sizes = {'conditions': 0, 'family_history': 0}
+        start = time.perf_counter()
+        for kind, document in documents:
+            sizes[kind] += len(json.dumps(minimizer.minimize(document)))
+        results[mode] = {'json_bytes': sizes, 'minimize_ms_per_doc': (time.perf_counter() - start) * 1000 / len(documents)}
+    if not args.offline:
+        for mode, stored in measure_stored(documents, args.iterations).items():
+            results[mode].update(stored)
+
+    base = results['off']
+    print(f"{'mode':<10}{'conditions':>14}{'family hist.':>14}{'saved':>8}{'stored':>12}{'saved':>8}"
+          f"{'read p50':>10}{'read p95':>10}")
+    for mode in MODES:
+        r = results[mode]
+        json_total = sum(r['json_bytes'].values())
+        line = (f"{mode:<10}{r['json_bytes']['conditions']:>14,}{r['json_bytes']['family_history']:>14,}"
+                f"{1 - json_total / sum(base['json_bytes'].values()):>8.0%}")
+        if 'stored_bytes' in r:
+            line += (f"{r['stored_bytes']:>12,}{1 - r['stored_bytes'] / base['stored_bytes']:>8.0%}"
+                     f"{r['read_p50_ms']:>9.2f}ms{r['read_p95_ms']:>8.2f}ms")
+        print(line)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'users': args.users, 'seed': args.seed, 'results': results}, f, indent=2)
+        print(f"\nwrote {args.output}", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
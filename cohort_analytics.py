@@ -0,0 +1,250 @@
+"""
+Clinic-wide cohort analytics over the stored conditions and family history.
+
+Triggers keep cohort_facts, the ICD-10 codes and categories, onset years
+and relationships in each user's documents, in step with every write and
+queue what changed (see migration 12). refresh_rollups() adds the queued
+changes to the cohort_rollups counts, so a refresh costs as much as the
+writes since the last one, not the number of users. The query functions
+answer from cohort_rollups by primary key, or from an index range scan of
+cohort_facts for code prefixes below the category, on a read replica when
+there is one. They refresh first if this process has not refreshed in the
+last DB_COHORT_REFRESH_INTERVAL seconds (0: before every read; negative:
+never, for deployments that run `--refresh` on a schedule instead), and
+read from the primary for DB_READ_YOUR_WRITES_SECONDS after a refresh,
+which a replica may not have yet. With a positive interval every app
+process also refreshes that often in the background (see
+database.start_rollup_refresher), so the queue of changes stays short when
+nobody reads the rollups.
+
+ICD-10 codes come from conditions' ICD-10 codings and from the IMO search
+data the family history form attaches to a relative's conditions. Codes
+are compared upper-cased with the dot after the category ('e119' is E11.9).
+
+Usage:
+    python cohort_analytics.py --refresh
+    python cohort_analytics.py --code 'E11.*'
+    python cohort_analytics.py --onset-years
+    python cohort_analytics.py --family-history --code E11
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+
+import database
+from database import _instrumented, get_db_connection, release_db_connection
+
+REFRESH_INTERVAL = float(os.getenv('DB_COHORT_REFRESH_INTERVAL', '60'))
+
+# When this process last refreshed the rollups (time.monotonic())
+_last_refresh = None
+_refresh_lock = threading.Lock()
+
+_ROLLUP_SQL = """
+    SELECT users, total FROM cohort_rollups
+    WHERE dimension = %(dimension)s AND key = %(key)s AND context = ''
+"""
+
+# Users with a code starting with prefix; every code character sorts
+# before '~' in byte order
+_CODE_PREFIX_SQL = """
+    SELECT count(DISTINCT user_id) FROM cohort_facts
+    WHERE dimension = %(dimension)s
+      AND key COLLATE "C" >= %(prefix)s
+      AND key COLLATE "C" < %(prefix)s || '~'
+"""
+
+_ONSET_YEARS_SQL = """
+    SELECT key, total, users FROM cohort_rollups
+    WHERE dimension = 'onset_year' AND context = ''
+    ORDER BY key
+"""
+
+# Relatives per relationship, or with a condition in one ICD-10 category
+_FAMILY_PREVALENCE_SQL = """
+    SELECT r.relationship, r.users, r.total, family.users
+    FROM (
+        SELECT key AS relationship, users, total FROM cohort_rollups
+        WHERE %(category)s::text IS NULL AND dimension = 'relationship' AND context = ''
+        UNION ALL
+        SELECT context, users, total FROM cohort_rollups
+        WHERE dimension = 'family_icd10_category' AND key = %(category)s
+    ) r
+    LEFT JOIN cohort_rollups family
+        ON family.dimension = 'family' AND family.key = '' AND family.context = ''
+    ORDER BY r.users DESC, r.relationship
+"""
+
+
+def normalize_code(code):
+    """
+    Upper-case an ICD-10 code and put the dot after its category, as the
+    stored codes are ('e119' -> 'E11.9')
+    """
+    code = code.strip().upper()
+    if len(code) > 3 and '.' not in code:
+        code = f"{code[:3]}.{code[3:]}"
+    return code
+
+
+def _parse_pattern(pattern):
+    """
+    Split a code pattern ('E11', 'E11.*', 'E11.9', 'E11.6*', 'E1*') into
+    (code, is_prefix). A bare category counts as its whole category.
+    """
+    code = normalize_code(pattern)
+    prefix = code.endswith('*')
+    code = code.rstrip('*').rstrip('.')
+    return code, prefix or len(code) <= 3
+
+
+def _refresh_if_stale():
+    """
+    Refresh the rollups unless this process did so in the last
+    REFRESH_INTERVAL seconds; one thread refreshes while the others wait
+    """
+    if REFRESH_INTERVAL < 0:
+        return
+    with _refresh_lock:
+        if _last_refresh is None or time.monotonic() - _last_refresh >= REFRESH_INTERVAL:
+            refresh_rollups()
+
+
+def _query(sql, params, error, default):
+    """
+    Run a read query over the rollups, refreshing them first if they are
+    stale. Returns all its rows, or default on error
+    """
+    _refresh_if_stale()
+    refreshed = _last_refresh is not None and time.monotonic() - _last_refresh < database.READ_YOUR_WRITES_SECONDS
+    conn = get_db_connection(readonly=not refreshed)
+    if conn:
+        cur = conn.cursor()
+        try:
+            cur.execute(sql, params, prepare=True)
+            rows = cur.fetchall()
+            conn.commit()
+            return rows
+        except Exception as e:
+            conn.rollback()
+            print(f"Error {error}: {e}")
+            return default
+        finally:
+            cur.close()
+            release_db_connection(conn)
+    return default
+
+
+def refresh_rollups():
+    """
+    Add the changes queued since the last refresh to cohort_rollups.
+    Returns the number of rollup rows updated, or None on error
+    """
+    global _last_refresh
+    applied = database.refresh_cohort_rollups()
+    if applied is not None:
+        _last_refresh = time.monotonic()
+    return applied
+
+
+@_instrumented
+def count_users_with_code(pattern):
+    """
+    Count the users with a saved condition matching an ICD-10 code pattern:
+    a category ('E11' or 'E11.*'), a code ('E11.9') or a prefix ('E11.6*').
+    Returns the count, or None on error
+    """
+    code, prefix = _parse_pattern(pattern)
+    if prefix and len(code) == 3:
+        rows = _query(_ROLLUP_SQL, {'dimension': 'icd10_category', 'key': code},
+                      "counting users by ICD-10 category", None)
+    elif prefix:
+        rows = _query(_CODE_PREFIX_SQL, {
+            'dimension': 'icd10_category' if len(code) < 3 else 'icd10', 'prefix': code
+        }, "counting users by ICD-10 prefix", None)
+    else:
+        rows = _query(_ROLLUP_SQL, {'dimension': 'icd10', 'key': code},
+                      "counting users by ICD-10 code", None)
+    if rows is None:
+        return None
+    return rows[0][0] if rows else 0
+
+
+@_instrumented
+def get_condition_onset_years():
+    """
+    Count the saved conditions per onset year (the onset date, else the
+    date the condition was recorded), oldest first. Returns a list of
+    {'year', 'conditions', 'users'}, or None on error
+    """
+    rows = _query(_ONSET_YEARS_SQL, {}, "counting conditions by onset year", None)
+    if rows is None:
+        return None
+    return [{'year': year, 'conditions': conditions, 'users': users} for year, conditions, users in rows]
+
+
+@_instrumented
+def get_family_history_prevalence(code=None):
+    """
+    Count, per relationship, the users who recorded such a relative and the
+    relatives recorded, optionally only relatives with a condition in the
+    ICD-10 category of code ('E11', 'E11.*' or 'E11.9' all mean E11).
+    share is the fraction of the users with any family history.
+    Returns a list of {'relationship', 'users', 'relatives', 'share'},
+    most common first, or None on error
+    """
+    category = _parse_pattern(code)[0][:3] if code else None
+    rows = _query(_FAMILY_PREVALENCE_SQL, {'category': category},
+                  "getting family history prevalence", None)
+    if rows is None:
+        return None
+    return [{'relationship': relationship, 'users': users, 'relatives': relatives,
+             'share': users / family_users if family_users else 0.0}
+            for relationship, users, relatives, family_users in rows]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--refresh', action='store_true', help="apply the queued changes to the rollups")
+    parser.add_argument('--code', help="ICD-10 code pattern, e.g. 'E11.*'")
+    parser.add_argument('--onset-years', action='store_true', help="count conditions by onset year")
+    parser.add_argument('--family-history', action='store_true',
+                        help="family history prevalence by relationship (for --code's category if given)")
+    args = parser.parse_args()
+    if not (args.refresh or args.code or args.onset_years or args.family_history):
+        parser.error("give --refresh, --code, --onset-years or --family-history")
+
+    if not database.init_db():
+        sys.exit("Could not initialize the database")
+
+    if args.refresh:
+        applied = refresh_rollups()
+        if applied is None:
+            sys.exit(1)
+        print(f"rollup rows updated: {applied}")
+
+    if args.code and not args.family_history:
+        users = count_users_with_code(args.code)
+        if users is None:
+            sys.exit(1)
+        print(f"users with {args.code}: {users}")
+    if args.onset_years:
+        years = get_condition_onset_years()
+        if years is None:
+            sys.exit(1)
+        print(f"{'year':<8}{'conditions':>12}{'users':>10}")
+        for row in years:
+            print(f"{row['year']:<8}{row['conditions']:>12}{row['users']:>10}")
+    if args.family_history:
+        prevalence = get_family_history_prevalence(args.code)
+        if prevalence is None:
+            sys.exit(1)
+        print(f"{'relationship':<28}{'users':>10}{'relatives':>11}{'share':>8}")
+        for row in prevalence:
+            print(f"{row['relationship']:<28}{row['users']:>10}{row['relatives']:>11}{row['share']:>8.1%}")
+
+
+if __name__ == '__main__':
+    main()
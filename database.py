@@ -1,88 +1,529 @@
 import os
-import psycopg2
+import base64
+import copy
+import functools
+import hashlib
+import re
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+import psycopg
+from psycopg.types.json import Jsonb
 from dotenv import load_dotenv
 import json
 from datetime import datetime
+from db_pool import ConnectionPool, ReplicaSet
+from db_cache import TTLCache, MISSING
+from db_metrics import QueryMetrics
+from db_notify import NotificationListener
+from fhir_minimizer import PayloadMinimizer
+import migrations
 
 load_dotenv(dotenv_path="/Users/alphy/Python Files/TheraCareHx/.env")
 
-def get_db_connection():
+_pool = None
+_pool_lock = threading.Lock()
+
+_db_initialized = False
+_init_lock = threading.Lock()
+
+# The unit of work (see session()) active on the current thread, if any
+_local = threading.local()
+
+# Read-through cache for per-user profile, conditions and family history
+# lookups. Every write path invalidates the user's entry.
+_cache = TTLCache(
+    max_entries=int(os.getenv('DB_CACHE_MAX_ENTRIES', '1024')),
+    ttl=float(os.getenv('DB_CACHE_TTL', '30')),
+    enabled=os.getenv('DB_CACHE_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+)
+
+# Per-function timing, round trips, rows and bytes for the entry points
+# below, plus the slow-query log
+_metrics = QueryMetrics(
+    enabled=os.getenv('DB_METRICS_ENABLED', 'true').lower() in ('1', 'true', 'yes'),
+    slow_query_ms=float(os.getenv('DB_SLOW_QUERY_MS', '500')),
+    explain_rate=float(os.getenv('DB_SLOW_QUERY_EXPLAIN_RATE', '0')),
+    log_interval=float(os.getenv('DB_METRICS_LOG_INTERVAL', '0')),
+    bytes_sample_rate=float(os.getenv('DB_METRICS_BYTES_SAMPLE_RATE', '0.01'))
+)
+_instrumented = _metrics.instrument
+
+# Strips what the app never reads from stored conditions and family
+# history (off, lossless or lossy, see fhir_minimizer.py); reads rehydrate
+_minimizer = PayloadMinimizer(mode=os.getenv('DB_FHIR_MINIMIZE', 'off').lower())
+
+# Postgres channel the migration 8 triggers notify with '<kind>:<user_id>'
+# whenever a cached row changes, in any process
+CACHE_CHANNEL = 'cache_invalidation'
+_listener = None
+_listener_lock = threading.Lock()
+
+class VersionConflict(Exception):
+    """
+    Raised by a write given expected_version when the row was changed by
+    someone else since that version was read
+    """
+
+    def __init__(self, table, user_id, expected_version):
+        super().__init__(f"{table} of user {user_id} changed since version {expected_version}")
+        self.table = table
+        self.user_id = user_id
+        self.expected_version = expected_version
+
+# Read replicas (DB_REPLICA_DSNS), created with the primary pool
+_replicas = None
+
+# Reads of a user written by this process in the last
+# READ_YOUR_WRITES_SECONDS go to the primary: user_id -> deadline
+READ_YOUR_WRITES_SECONDS = float(os.getenv('DB_READ_YOUR_WRITES_SECONDS', '5'))
+_recent_writes = {}
+_recent_writes_lock = threading.Lock()
+
+# Seconds between the background refreshes of the cohort rollups (see
+# migration 12 and cohort_analytics.py); 0 or less: no background refresh
+COHORT_REFRESH_INTERVAL = float(os.getenv('DB_COHORT_REFRESH_INTERVAL', '60'))
+_rollup_refresher = None
+_rollup_refresher_lock = threading.Lock()
+
+# Trigram similarity (0-1) from which a saved condition name is reported as
+# a likely duplicate of a new one
+NEAR_DUPLICATE_THRESHOLD = float(os.getenv('DB_NEAR_DUPLICATE_THRESHOLD', '0.3'))
+
+def _connect_kwargs(conninfo=None):
+    """
+    Connection arguments for conninfo, or for the primary: DB_PRIMARY_DSN if
+    set, otherwise the DB_HOST, DB_PORT, ... settings. Shared with
+    database_async.py
+    """
+    conninfo = conninfo or os.getenv('DB_PRIMARY_DSN')
+    if conninfo:
+        return {'conninfo': conninfo}
+    return {
+        'host': os.getenv('DB_HOST'),
+        'port': os.getenv('DB_PORT'),
+        'dbname': os.getenv('DB_NAME'),
+        'user': os.getenv('DB_USER'),
+        'password': os.getenv('DB_PASSWORD')
+    }
+
+def _connect(conninfo=None):
+    """
+    Open a connection to conninfo, or to the primary (see _connect_kwargs)
+    """
+    return _metrics.connect(**_connect_kwargs(conninfo))
+
+def _new_pool(connect):
+    return ConnectionPool(
+        connect,
+        min_size=int(os.getenv('DB_POOL_MIN_SIZE', '1')),
+        max_size=int(os.getenv('DB_POOL_MAX_SIZE', '10')),
+        max_lifetime=float(os.getenv('DB_POOL_MAX_LIFETIME', '1800')),
+        timeout=float(os.getenv('DB_POOL_TIMEOUT', '30')),
+        pre_ping=os.getenv('DB_POOL_PRE_PING', 'true').lower() in ('1', 'true', 'yes'),
+        ping_idle=float(os.getenv('DB_POOL_PING_IDLE', '30'))
+    )
+
+def _replica_healthy(conn):
+    """
+    A replica is usable while it is in recovery and has replayed everything
+    it received, or its last replayed transaction is at most
+    DB_REPLICA_MAX_LAG seconds old
+    """
+    cur = conn.cursor()
     try:
-        conn = psycopg2.connect(
-            host=os.getenv('DB_HOST'),
-            port=os.getenv('DB_PORT'),
-            database=os.getenv('DB_NAME'),
-            user=os.getenv('DB_USER'),
-            password=os.getenv('DB_PASSWORD')
-        )
-        return conn
-    except Exception as e:
-        print(f"Error connecting to database: {e}")
+        cur.execute("""
+            SELECT pg_is_in_recovery(),
+                   pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn(),
+                   EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+        """)
+        in_recovery, caught_up, lag = cur.fetchone()
+        conn.rollback()
+    finally:
+        cur.close()
+    max_lag = float(os.getenv('DB_REPLICA_MAX_LAG', '30'))
+    return bool(in_recovery) and (bool(caught_up) or (lag is not None and lag <= max_lag))
+
+def get_pool():
+    """
+    Get the process-wide connection pool for the primary, creating it (and
+    the replica pools, if DB_REPLICA_DSNS lists any) on first use.
+    Sized from DB_POOL_* environment variables.
+    """
+    global _pool, _replicas
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                dsns = [dsn.strip() for dsn in os.getenv('DB_REPLICA_DSNS', '').split(',') if dsn.strip()]
+                if dsns:
+                    _replicas = ReplicaSet(
+                        [_new_pool(functools.partial(_connect, dsn)) for dsn in dsns],
+                        check=_replica_healthy,
+                        check_interval=float(os.getenv('DB_REPLICA_CHECK_INTERVAL', '10')),
+                        retry_interval=float(os.getenv('DB_REPLICA_RETRY_INTERVAL', '30')),
+                        checkout_timeout=float(os.getenv('DB_REPLICA_CHECKOUT_TIMEOUT', '0.25'))
+                    )
+                _pool = _new_pool(_connect)
+        start_cache_listener()
+        start_rollup_refresher()
+    return _pool
+
+def get_replica_stats():
+    """
+    Get read replica statistics (health, requests, fallbacks to the primary),
+    or None without replicas
+    """
+    if _replicas is None:
         return None
+    return _replicas.stats()
 
-def init_db():
+def _note_write(user_id):
+    with _recent_writes_lock:
+        now = time.monotonic()
+        if len(_recent_writes) > 10000:
+            for key in [key for key, deadline in _recent_writes.items() if deadline <= now]:
+                del _recent_writes[key]
+        _recent_writes[user_id] = now + READ_YOUR_WRITES_SECONDS
+
+def _reads_from_primary(user_id):
+    if getattr(_local, 'primary_reads', 0):
+        return True
+    if user_id is None:
+        return False
+    with _recent_writes_lock:
+        deadline = _recent_writes.get(user_id)
+    return deadline is not None and deadline > time.monotonic()
+
+@contextmanager
+def primary_reads():
+    """
+    Send every read made on this thread inside the block to the primary,
+    e.g. to read back a write made by another process
+    """
+    _local.primary_reads = getattr(_local, 'primary_reads', 0) + 1
+    try:
+        yield
+    finally:
+        _local.primary_reads -= 1
+
+def get_pool_stats():
+    """
+    Get connection pool statistics (in use, idle, wait time, ...)
+    """
+    if _pool is None:
+        return None
+    return _pool.stats()
+
+def get_db_connection(readonly=False, user_id=None):
+    """
+    Borrow a connection from the pool. Return it with release_db_connection().
+    Inside session() this is the session's shared connection instead.
+    readonly connections come from a read replica when there are any, unless
+    user_id was written to in the last READ_YOUR_WRITES_SECONDS or the
+    call is inside primary_reads().
+    """
+    start = time.perf_counter()
+    try:
+        active = getattr(_local, 'session', None)
+        if active is not None:
+            return active.connection()
+        try:
+            pool = get_pool()
+            if readonly and _replicas is not None and not _reads_from_primary(user_id):
+                conn = _replicas.getconn()
+                if conn is not None:
+                    return conn
+            return pool.getconn()
+        except Exception as e:
+            print(f"Error connecting to database: {e}")
+            return None
+    finally:
+        _metrics.record_wait(time.perf_counter() - start)
+
+def release_db_connection(conn):
+    """
+    Return a connection borrowed with get_db_connection() to the pool
+    """
+    if conn is None or isinstance(conn, _SessionConnection):
+        # Session connections go back to the pool when the session ends
+        return
+    if _replicas is not None and _replicas.owns(conn):
+        _replicas.putconn(conn)
+        return
+    get_pool().putconn(conn)
+
+class _SessionConnection:
+    """
+    Stand-in for the session's connection handed to the database.py
+    functions: commit() is deferred to the end of the session, rollback()
+    dooms the whole session, everything else goes to the real connection.
+    """
+
+    def __init__(self, session, conn):
+        self._session = session
+        self._conn = conn
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        self._session.failed = True
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+class Session:
+    """
+    A unit of work: one pooled connection and one transaction shared by every
+    database.py call made on this thread until the session ends. The
+    connection is only borrowed when the first call needs it.
+    """
+
+    def __init__(self):
+        self.failed = False
+        self._conn = None
+        self._proxy = None
+        self._invalidated = set()
+
+    def connection(self):
+        """
+        Get the session's connection, borrowing it from the pool on first use
+        """
+        if self._proxy is None:
+            try:
+                self._conn = get_pool().getconn()
+            except Exception as e:
+                print(f"Error connecting to database: {e}")
+                self.failed = True
+                return None
+            self._proxy = _SessionConnection(self, self._conn)
+        return self._proxy
+
+    def _finish(self, commit):
+        conn, self._conn, self._proxy = self._conn, None, None
+        if conn is None:
+            return True
+        try:
+            if commit and not self.failed:
+                conn.commit()
+                committed = True
+            else:
+                conn.rollback()
+                committed = False
+        except Exception as e:
+            print(f"Error committing session: {e}")
+            committed = False
+        finally:
+            get_pool().putconn(conn)
+        if committed:
+            # Another thread may have cached the old rows between the write
+            # and the commit; drop them again now the changes are visible
+            for key in self._invalidated:
+                _cache.invalidate(key)
+        else:
+            self.failed = True
+        return committed
+
+@contextmanager
+def session():
+    """
+    Run the enclosed database.py calls on one connection in one transaction.
+
+        with session():
+            if not check_duplicate_condition(user_id, condition):
+                append_conditions(user_id, gorilla_id, [condition])
+
+    Everything is committed once when the block exits, or rolled back if it
+    raises or any call inside it failed (check the session's failed
+    attribute). Nested session() blocks join the outer one.
+    """
+    active = getattr(_local, 'session', None)
+    if active is not None:
+        yield active
+        return
+    active = _local.session = Session()
+    try:
+        yield active
+    except BaseException:
+        _local.session = None
+        active._finish(commit=False)
+        raise
+    _local.session = None
+    active._finish(commit=True)
+
+def get_query_stats():
+    """
+    Get per-function query statistics (calls, errors, latency percentiles,
+    connection wait, round trips, rows, bytes) and the slow query count
+    """
+    return _metrics.stats()
+
+def get_query_summary():
+    """
+    Get the query statistics as a short human-readable report
+    """
+    return _metrics.summary()
+
+def get_cache_stats():
+    """
+    Get read cache statistics (hits, misses, evictions, ...)
+    """
+    return _cache.stats()
+
+def clear_cache():
+    """
+    Drop every entry from the read cache
+    """
+    _cache.clear()
+
+def _cached(kind, user_id, load):
+    """
+    Return load(user_id) through the read cache. Missing rows (None) are
+    not cached.
+    """
+    key = (kind, user_id)
+    active = getattr(_local, 'session', None)
+    if active is not None and key in active._invalidated:
+        # Written in this session: read our own uncommitted changes and keep
+        # them out of the cache until the session commits
+        return load(user_id)
+    value = _cache.get(key)
+    if value is not MISSING:
+        return value
+    generation = _cache.generation(key)
+    value = load(user_id)
+    if value is not None:
+        _cache.set(key, value, generation)
+        value = copy.deepcopy(value)
+    return value
+
+def _on_cache_notification(payload):
+    kind, _, user_id = payload.partition(':')
+    try:
+        user_id = int(user_id)
+    except ValueError:
+        return
+    _cache.invalidate((kind, user_id))
+    # A replica may not have the change yet either
+    _note_write(user_id)
+
+def start_cache_listener():
+    """
+    Start this process's background thread that evicts cached entries when
+    another process writes them. Started with the pool while the cache is
+    enabled and DB_CACHE_LISTEN is not turned off.
+    """
+    global _listener
+    if not _cache.enabled or os.getenv('DB_CACHE_LISTEN', 'true').lower() not in ('1', 'true', 'yes'):
+        return
+    with _listener_lock:
+        if _listener is None:
+            # Changes made while the listener was disconnected were missed
+            _listener = NotificationListener(
+                _connect, CACHE_CHANNEL, _on_cache_notification,
+                on_reconnect=_cache.clear,
+                retry_interval=float(os.getenv('DB_CACHE_LISTEN_RETRY_INTERVAL', '5'))
+            )
+    _listener.start()
+
+def start_rollup_refresher():
+    """
+    Start this process's background thread that applies the queued cohort
+    rollup changes every COHORT_REFRESH_INTERVAL seconds, so the queue stays
+    short when nobody reads the rollups. Started with the pool; a refresh
+    already running in another process makes this one a no-op.
+    """
+    global _rollup_refresher
+    if COHORT_REFRESH_INTERVAL <= 0:
+        return
+    with _rollup_refresher_lock:
+        if _rollup_refresher is not None:
+            return
+        _rollup_refresher = threading.Thread(target=_refresh_rollups_loop, name="cohort-refresh", daemon=True)
+    _rollup_refresher.start()
+
+def _refresh_rollups_loop():
+    while True:
+        time.sleep(COHORT_REFRESH_INTERVAL)
+        refresh_cohort_rollups()
+
+@_instrumented
+def refresh_cohort_rollups():
+    """
+    Add the cohort fact changes queued since the last refresh to
+    cohort_rollups. Returns the number of rollup rows updated, or None on
+    error
+    """
     conn = get_db_connection()
     if conn:
         cur = conn.cursor()
-        
         try:
-            # First create users table (no dependencies)
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS users (
-                    id SERIAL PRIMARY KEY,
-                    username VARCHAR(50) UNIQUE NOT NULL,
-                    email VARCHAR(100) UNIQUE NOT NULL,
-                    password_hash VARCHAR(255) NOT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
-            
-            # Then create profiles table (depends on users)
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS profiles (
-                    id SERIAL PRIMARY KEY,
-                    user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
-                    gorilla_id VARCHAR(255) NOT NULL,
-                    profile_data JSONB NOT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    UNIQUE(user_id)
-                )
-            """)
-            
-            # Finally create conditions table (depends on users)
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS conditions (
-                    id SERIAL PRIMARY KEY,
-                    user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
-                    gorilla_id VARCHAR(255) NOT NULL,
-                    api_response JSONB NOT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    UNIQUE(user_id)
-                )
-            """)
-            
-            # Create family history table
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS family_history (
-                    id SERIAL PRIMARY KEY,
-                    user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
-                    gorilla_id VARCHAR(255),
-                    api_response JSONB,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
-            
+            cur.execute("SELECT refresh_cohort_rollups()")
+            applied = cur.fetchone()[0]
             conn.commit()
+            return applied
         except Exception as e:
             conn.rollback()
-            print(f"Error initializing database: {e}")
+            print(f"Error refreshing cohort rollups: {e}")
+            return None
         finally:
             cur.close()
-            conn.close()
+            release_db_connection(conn)
+    return None
+
+def get_cache_listener_stats():
+    """
+    Get the cache invalidation listener's statistics, or None if it is not running
+    """
+    if _listener is None:
+        return None
+    return _listener.stats()
+
+def _invalidate(kind, user_id):
+    """
+    Drop a user's cached entry after a write so they see their own changes
+    """
+    key = (kind, user_id)
+    _cache.invalidate(key)
+    _note_write(user_id)
+    active = getattr(_local, 'session', None)
+    if active is not None:
+        active._invalidated.add(key)
+
+def init_db():
+    """
+    Bring the database schema up to date.
+    Runs the pending migrations once per process; later calls return
+    immediately, so it is safe to call on every Streamlit rerun.
+    """
+    global _db_initialized
+    if _db_initialized:
+        return True
+    with _init_lock:
+        if _db_initialized:
+            return True
+        # Migrations commit per version, so they never join a session()
+        try:
+            conn = get_pool().getconn()
+        except Exception as e:
+            print(f"Error connecting to database: {e}")
+            return False
+        try:
+            applied = migrations.run_migrations(conn)
+            if applied:
+                print(f"Applied database migrations: {applied}")
+            # Migrations may have created pg_trgm
+            _set_pg_trgm(None)
+            _db_initialized = True
+            return True
+        except Exception as e:
+            print(f"Error initializing database: {e}")
+            return False
+        finally:
+            get_pool().putconn(conn)
 
+@_instrumented
 def create_user(username, email, password_hash):
     conn = get_db_connection()
     if conn:
@@ -94,6 +535,7 @@ def create_user(username, email, password_hash):
             )
             user_id = cur.fetchone()[0]
             conn.commit()
+            _note_write(user_id)
             return user_id
         except Exception as e:
             conn.rollback()
@@ -101,21 +543,36 @@ def create_user(username, email, password_hash):
             return None
         finally:
             cur.close()
-            conn.close()
+            release_db_connection(conn)
 
+@_instrumented
 def get_user_by_username(username):
+    # Login and signup read the primary: a replica may not have a user who
+    # just signed up, or a changed password, yet
     conn = get_db_connection()
     if conn:
         cur = conn.cursor()
         try:
-            cur.execute("SELECT id, username, email, password_hash FROM users WHERE username = %s", (username,))
+            cur.execute("SELECT id, username, email, password_hash FROM users WHERE username = %s", (username,), prepare=True)
             user = cur.fetchone()
             return user
         finally:
             cur.close()
-            conn.close()
+            release_db_connection(conn)
     return None
 
+# Upsert of a user's profile
+_SAVE_PROFILE_SQL = """
+    INSERT INTO profiles (user_id, gorilla_id, profile_data)
+    VALUES (%s, %s, %s)
+    ON CONFLICT (user_id) DO UPDATE
+    SET gorilla_id = EXCLUDED.gorilla_id,
+        profile_data = EXCLUDED.profile_data,
+        updated_at = CURRENT_TIMESTAMP
+    RETURNING id
+"""
+
+@_instrumented
 def save_profile(user_id, gorilla_id, profile_data):
     """
     Save or update a user's profile
@@ -124,44 +581,29 @@ def save_profile(user_id, gorilla_id, profile_data):
     if conn:
         cur = conn.cursor()
         try:
-            # Check if profile exists
-            cur.execute("SELECT id FROM profiles WHERE user_id = %s", (user_id,))
-            profile = cur.fetchone()
-            
-            if profile:
-                # Update existing profile
-                cur.execute("""
-                    UPDATE profiles 
-                    SET gorilla_id = %s, 
-                        profile_data = %s,
-                        updated_at = CURRENT_TIMESTAMP
-                    WHERE user_id = %s
-                    RETURNING id
-                """, (gorilla_id, json.dumps(profile_data), user_id))
-            else:
-                # Create new profile
-                cur.execute("""
-                    INSERT INTO profiles (user_id, gorilla_id, profile_data)
-                    VALUES (%s, %s, %s)
-                    RETURNING id
-                """, (user_id, gorilla_id, json.dumps(profile_data)))
-            
-            profile_id = cur.fetchone()[0]
-            conn.commit()
-            return profile_id
+            # Atomic upsert; the statement and the commit go out in one flight
+            with conn.pipeline():
+                cur.execute(_SAVE_PROFILE_SQL, (user_id, gorilla_id, Jsonb(profile_data)), prepare=True)
+                conn.commit()
+            _invalidate('profile', user_id)
+            return cur.fetchone()[0]
         except Exception as e:
             conn.rollback()
             print(f"Error saving profile: {e}")
             return None
         finally:
             cur.close()
-            conn.close()
+            release_db_connection(conn)
 
+@_instrumented
 def get_profile_by_user_id(user_id):
     """
     Get a user's profile by their user ID
     """
-    conn = get_db_connection()
+    return _cached('profile', user_id, _load_profile)
+
+def _load_profile(user_id, readonly=True):
+    conn = get_db_connection(readonly=readonly, user_id=user_id)
     if conn:
         cur = conn.cursor()
         try:
@@ -169,7 +611,7 @@ def get_profile_by_user_id(user_id):
                 SELECT id, gorilla_id, profile_data, created_at, updated_at 
                 FROM profiles 
                 WHERE user_id = %s
-            """, (user_id,))
+            """, (user_id,), prepare=True)
             profile = cur.fetchone()
             if profile:
                 return {
@@ -182,465 +624,1657 @@ def get_profile_by_user_id(user_id):
             return None
         finally:
             cur.close()
-            conn.close()
+            release_db_connection(conn)
     return None
 
-def check_and_init_db():
-    """
-    Check if database exists and initialize it if it doesn't
-    """
-    try:
-        # Connect to the database
-        conn = get_db_connection()
-        cur = conn.cursor()
-        
-        # Check if users table exists
-        cur.execute("""
-            SELECT EXISTS (
-                SELECT FROM information_schema.tables 
-                WHERE table_name = 'users'
-            );
-        """)
-        users_exists = cur.fetchone()[0]
-        
-        # Check if profiles table exists
-        cur.execute("""
-            SELECT EXISTS (
-                SELECT FROM information_schema.tables 
-                WHERE table_name = 'profiles'
-            );
-        """)
-        profiles_exists = cur.fetchone()[0]
-        
-        # Check if conditions table exists
-        cur.execute("""
-            SELECT EXISTS (
-                SELECT FROM information_schema.tables 
-                WHERE table_name = 'conditions'
-            );
-        """)
-        conditions_exists = cur.fetchone()[0]
-        
-        # Check if family_history table exists
-        cur.execute("""
-            SELECT EXISTS (
-                SELECT FROM information_schema.tables 
-                WHERE table_name = 'family_history'
-            );
-        """)
-        family_history_exists = cur.fetchone()[0]
-        
-        # Create users table if it doesn't exist
-        if not users_exists:
-            cur.execute("""
-                CREATE TABLE users (
-                    id SERIAL PRIMARY KEY,
-                    username VARCHAR(50) UNIQUE NOT NULL,
-                    password_hash VARCHAR(255) NOT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                );
-            """)
-        
-        # Create profiles table if it doesn't exist
-        if not profiles_exists:
-            cur.execute("""
-                CREATE TABLE profiles (
-                    id SERIAL PRIMARY KEY,
-                    user_id INTEGER REFERENCES users(id),
-                    gorilla_id VARCHAR(50),
-                    profile_data JSONB,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                );
-            """)
-        
-        # Create conditions table if it doesn't exist
-        if not conditions_exists:
-            cur.execute("""
-                CREATE TABLE conditions (
-                    id SERIAL PRIMARY KEY,
-                    user_id INTEGER REFERENCES users(id),
-                    gorilla_id VARCHAR(50),
-                    api_response JSONB,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                );
-            """)
-        else:
-            # Alter existing conditions table to make gorilla_id nullable
-            cur.execute("""
-                ALTER TABLE conditions 
-                ALTER COLUMN gorilla_id DROP NOT NULL;
-            """)
-        
-        # Create family_history table if it doesn't exist
-        if not family_history_exists:
-            cur.execute("""
-                CREATE TABLE family_history (
-                    id SERIAL PRIMARY KEY,
-                    user_id INTEGER REFERENCES users(id),
-                    gorilla_id VARCHAR(50),
-                    api_response JSONB,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                );
-            """)
-        
-        conn.commit()
-        cur.close()
-        conn.close()
-        return True
-    except Exception as e:
-        print(f"Error initializing database: {str(e)}")
-        return False
+# Upsert of a user's conditions; with %(expected)s set, only over that version
+_SAVE_CONDITIONS_SQL = """
+    INSERT INTO conditions (
+        user_id, gorilla_id, api_response
+    ) VALUES (%(user_id)s, %(gorilla_id)s, %(document)s)
+    ON CONFLICT (user_id) DO UPDATE
+    SET api_response = EXCLUDED.api_response,
+        gorilla_id = EXCLUDED.gorilla_id,
+        version = conditions.version + 1,
+        updated_at = CURRENT_TIMESTAMP
+    WHERE %(expected)s::integer IS NULL OR conditions.version = %(expected)s
+    RETURNING id
+"""
 
-def save_conditions(user_id, gorilla_id, api_response):
+@_instrumented
+def save_conditions(user_id, gorilla_id, api_response, expected_version=None):
     """
     Save conditions API response for a user
+    With expected_version (the version read with get_conditions_by_user_id,
+    0 if there was no row), the save only applies if nobody else has written
+    since, and raises VersionConflict otherwise.
     """
-    # Ensure database is initialized
-    check_and_init_db()
-    
     conn = get_db_connection()
     if conn:
         cur = conn.cursor()
         try:
-            # Check if conditions exist for this user
-            cur.execute("SELECT id FROM conditions WHERE user_id = %s", (user_id,))
-            existing = cur.fetchone()
-            
-            if existing:
-                # Update existing conditions
-                cur.execute("""
-                    UPDATE conditions 
-                    SET api_response = %s,
-                        gorilla_id = %s,
-                        updated_at = CURRENT_TIMESTAMP
-                    WHERE user_id = %s
-                    RETURNING id
-                """, (json.dumps(api_response), gorilla_id, user_id))
-            else:
-                # Insert new conditions
-                cur.execute("""
-                    INSERT INTO conditions (
-                        user_id, gorilla_id, api_response
-                    ) VALUES (%s, %s, %s)
-                    RETURNING id
-                """, (user_id, gorilla_id, json.dumps(api_response)))
-            
-            condition_id = cur.fetchone()[0]
-            conn.commit()
-            return condition_id
+            # Atomic upsert; the statement and the commit go out in one flight
+            with conn.pipeline():
+                cur.execute(_SAVE_CONDITIONS_SQL, {
+                    'user_id': user_id, 'gorilla_id': gorilla_id, 'document': Jsonb(_minimizer.minimize(api_response)),
+                    'expected': expected_version
+                }, prepare=True)
+                conn.commit()
+            _invalidate('conditions', user_id)
+            result = cur.fetchone()
         except Exception as e:
             conn.rollback()
             print(f"Error saving conditions: {e}")
             return None
         finally:
             cur.close()
-            conn.close()
+            release_db_connection(conn)
+        if result is None:
+            raise VersionConflict('conditions', user_id, expected_version)
+        return result[0]
 
+@_instrumented
 def get_conditions_by_user_id(user_id):
     """
     Get conditions API response for a user
     """
-    # Ensure database is initialized
-    check_and_init_db()
-    
-    conn = get_db_connection()
+    return _cached('conditions', user_id, _load_conditions)
+
+def _load_conditions(user_id, readonly=True):
+    conn = get_db_connection(readonly=readonly, user_id=user_id)
     if conn:
         cur = conn.cursor()
         try:
             cur.execute("""
-                SELECT id, gorilla_id, api_response, created_at, updated_at
+                SELECT id, gorilla_id, api_response, created_at, updated_at, version
                 FROM conditions
                 WHERE user_id = %s
-            """, (user_id,))
+            """, (user_id,), prepare=True)
             result = cur.fetchone()
             if result:
                 return {
                     'id': result[0],
                     'gorilla_id': result[1],
-                    'api_response': result[2],  # No need for json.loads as it's already in JSON format
+                    'api_response': _minimizer.rehydrate(result[2]),
                     'created_at': result[3],
-                    'updated_at': result[4]
+                    'updated_at': result[4],
+                    'version': result[5]
                 }
             return None
         finally:
             cur.close()
-            conn.close()
+            release_db_connection(conn)
     return None
 
-def check_duplicate_condition(user_id, new_condition):
+def _document_entries(document):
     """
-    Check if a condition already exists in the database for a user
-    Returns True if duplicate found, False otherwise
+    Get the list of entries from a stored document, which is either a plain
+    list of entries or a FHIR Bundle with an 'entry' list
     """
-    conn = get_db_connection()
-    if conn:
-        cur = conn.cursor()
-        try:
-            # Get existing conditions
-            cur.execute("""
-                SELECT api_response 
-                FROM conditions 
-                WHERE user_id = %s
-            """, (user_id,))
-            result = cur.fetchone()
-            
-            if not result or not result[0]:
-                return False
-                
-            existing_conditions = result[0]
-            
-            # Extract key fields from new condition
-            new_resource = new_condition.get('resource', {}) if isinstance(new_condition, dict) else {}
-            new_code = new_resource.get('code', {}) if isinstance(new_resource, dict) else {}
-            new_name = new_code.get('text', '')
-            if not new_name and isinstance(new_code.get('coding'), list) and new_code.get('coding'):
-                new_name = new_code['coding'][0].get('display', '')
-            
-            new_date = new_resource.get('assertedDate', '')
-            new_status = new_resource.get('clinicalStatus', '')
-            
-            # Check each existing condition
-            for entry in existing_conditions:
-                # Ensure entry is a dictionary
-                if not isinstance(entry, dict):
-                    continue
-                    
-                existing_resource = entry.get('resource', {}) if isinstance(entry.get('resource'), dict) else entry
-                existing_code = existing_resource.get('code', {}) if isinstance(existing_resource, dict) else {}
-                existing_name = existing_code.get('text', '')
-                if not existing_name and isinstance(existing_code.get('coding'), list) and existing_code.get('coding'):
-                    existing_name = existing_code['coding'][0].get('display', '')
-                
-                existing_date = existing_resource.get('assertedDate', '') if isinstance(existing_resource, dict) else ''
-                existing_status = existing_resource.get('clinicalStatus', '') if isinstance(existing_resource, dict) else ''
-                
-                # Compare key fields
-                if (new_name == existing_name and 
-                    new_date == existing_date and 
-                    new_status == existing_status):
-                    return True
-            
-            return False
-        finally:
-            cur.close()
-            conn.close()
-    return False
+    if isinstance(document, list):
+        return document
+    if isinstance(document, dict) and isinstance(document.get('entry'), list):
+        return document['entry']
+    return []
 
-def save_family_history(user_id, gorilla_id, api_response):
+def _entry_resource(entry):
     """
-    Save family history API response for a user
+    Get the FHIR resource of an entry, handling both wrapped and bare resources
     """
-    # Ensure database is initialized
-    check_and_init_db()
-    
-    conn = get_db_connection()
+    if not isinstance(entry, dict):
+        return {}
+    return entry['resource'] if isinstance(entry.get('resource'), dict) else entry
+
+def _codeable_text(concept):
+    """
+    Get the display text of a CodeableConcept: its text, else the first coding's display
+    """
+    if not isinstance(concept, dict):
+        return ''
+    text = concept.get('text', '')
+    if not text and isinstance(concept.get('coding'), list) and concept['coding']:
+        coding = concept['coding'][0]
+        text = coding.get('display', '') if isinstance(coding, dict) else ''
+    return text
+
+def _clinical_status_code(resource):
+    """
+    Get the clinical status code of a Condition ('unknown' if missing)
+    """
+    status = resource.get('clinicalStatus', {})
+    if isinstance(status, dict):
+        coding = status.get('coding', [{}])
+        coding = coding[0] if isinstance(coding, list) and coding else {}
+        if isinstance(coding, dict):
+            return coding.get('code', 'unknown')
+    elif isinstance(status, str):
+        return status.lower()
+    return 'unknown'
+
+# Fingerprint of each candidate entry (migration 9) and whether the user
+# already has it saved; one index probe per candidate
+_FINGERPRINT_LOOKUP_SQL = """
+    SELECT c.fingerprint, EXISTS (
+        SELECT 1 FROM entry_fingerprints f
+        WHERE f.user_id = %(user_id)s AND f.kind = %(kind)s AND f.fingerprint = c.fingerprint
+    )
+    FROM (
+        SELECT e.pos, fhir_entry_fingerprint(%(kind)s, e.entry) AS fingerprint
+        FROM jsonb_array_elements(%(entries)s) WITH ORDINALITY AS e(entry, pos)
+    ) c
+    ORDER BY c.pos
+"""
+
+def _split_duplicates(candidates, rows):
+    """
+    Partition candidates into (duplicates, new_entries) given their
+    (fingerprint, saved) rows from _FINGERPRINT_LOOKUP_SQL. A candidate that
+    repeats an earlier candidate is also a duplicate.
+    """
+    seen = set()
+    duplicates = []
+    new_entries = []
+    for entry, (fingerprint, saved) in zip(candidates, rows):
+        if saved or fingerprint in seen:
+            duplicates.append(entry)
+        else:
+            seen.add(fingerprint)
+            new_entries.append(entry)
+    return duplicates, new_entries
+
+def _split_saved_duplicates(kind, user_id, candidates):
+    conn = get_db_connection(readonly=True, user_id=user_id)
     if conn:
         cur = conn.cursor()
         try:
-            # Check if family history exists for this user
-            cur.execute("SELECT id FROM family_history WHERE user_id = %s", (user_id,))
-            existing = cur.fetchone()
-            
-            if existing:
-                # Update existing family history
-                cur.execute("""
-                    UPDATE family_history 
-                    SET api_response = %s,
-                        updated_at = CURRENT_TIMESTAMP
-                    WHERE user_id = %s
-                    RETURNING id
-                """, (json.dumps(api_response), user_id))
-            else:
-                # Insert new family history
-                cur.execute("""
-                    INSERT INTO family_history (
-                        user_id, gorilla_id, api_response
-                    ) VALUES (%s, %s, %s)
-                    RETURNING id
-                """, (user_id, gorilla_id, json.dumps(api_response)))
-            
-            history_id = cur.fetchone()[0]
-            conn.commit()
-            return history_id
+            cur.execute(_FINGERPRINT_LOOKUP_SQL, {
+                'user_id': user_id, 'kind': kind, 'entries': Jsonb(list(candidates))
+            }, prepare=True)
+            return _split_duplicates(candidates, cur.fetchall())
         except Exception as e:
             conn.rollback()
-            print(f"Error saving family history: {e}")
+            print(f"Error checking {kind} for duplicates: {e}")
             return None
         finally:
             cur.close()
-            conn.close()
+            release_db_connection(conn)
+    return None
 
-def get_family_history_by_user_id(user_id):
+# Saved condition names (migration 10) similar to those of the candidate
+# entries, best matches first; the trigram GIN index serves the % match
+_NEAR_DUPLICATES_SQL = """
+    SELECT c.display, s.display, s.score
+    FROM jsonb_array_elements(%(entries)s) WITH ORDINALITY AS e(entry, pos)
+    CROSS JOIN LATERAL fhir_entry_condition_names(%(kind)s, e.entry) c
+    CROSS JOIN LATERAL (
+        SELECT n.display, similarity(n.name, c.name) AS score
+        FROM entry_condition_names n
+        WHERE n.user_id = %(user_id)s AND n.kind = %(kind)s
+          AND n.context = c.context AND n.name %% c.name
+        ORDER BY score DESC
+        LIMIT %(limit)s
+    ) s
+    WHERE c.name <> ''
+    ORDER BY e.pos, s.score DESC
+"""
+
+# Without pg_trgm: the candidates' condition names and the user's saved
+# names, compared by _match_near_duplicates
+_CANDIDATE_NAMES_SQL = """
+    SELECT c.context, c.name, c.display
+    FROM jsonb_array_elements(%(entries)s) WITH ORDINALITY AS e(entry, pos)
+    CROSS JOIN LATERAL fhir_entry_condition_names(%(kind)s, e.entry) c
+    WHERE c.name <> ''
+    ORDER BY e.pos
+"""
+_SAVED_NAMES_SQL = """
+    SELECT context, name, display FROM entry_condition_names
+    WHERE user_id = %(user_id)s AND kind = %(kind)s
+"""
+
+_HAS_PG_TRGM_SQL = "SELECT EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm')"
+
+# Whether pg_trgm is installed and when that was looked up. init_db() and
+# a trigram query failing for want of the extension clear it, and a missing
+# extension is looked up again after PG_TRGM_RECHECK_SECONDS in case it was
+# installed since
+_pg_trgm_installed = None
+_pg_trgm_checked_at = 0.0
+PG_TRGM_RECHECK_SECONDS = 300
+
+def _pg_trgm_unknown():
+    return _pg_trgm_installed is None or (
+        not _pg_trgm_installed and time.monotonic() - _pg_trgm_checked_at > PG_TRGM_RECHECK_SECONDS)
+
+def _set_pg_trgm(installed):
+    global _pg_trgm_installed, _pg_trgm_checked_at
+    _pg_trgm_installed = installed
+    _pg_trgm_checked_at = time.monotonic()
+
+def _trigrams(text):
     """
-    Get family history API response for a user
+    The trigrams of text as pg_trgm makes them: lower-cased alphanumeric
+    words, each padded with two spaces in front and one behind
     """
-    # Ensure database is initialized
-    check_and_init_db()
-    
-    conn = get_db_connection()
+    grams = set()
+    for word in re.findall(r'[^\W_]+', text.lower()):
+        word = f"  {word} "
+        grams.update(word[i:i + 3] for i in range(len(word) - 2))
+    return grams
+
+def _trigram_similarity(a, b):
+    """
+    pg_trgm's similarity(): shared trigrams over all trigrams of a and b
+    """
+    a, b = _trigrams(a), _trigrams(b)
+    return len(a & b) / len(a | b) if a or b else 0.0
+
+def _match_near_duplicates(candidates, saved, threshold, limit):
+    """
+    In-process _NEAR_DUPLICATES_SQL over (context, name, display) rows of
+    the candidates and of the saved names
+    """
+    rows = []
+    for context, name, display in candidates:
+        scores = [(existing, _trigram_similarity(saved_name, name))
+                  for saved_context, saved_name, existing in saved if saved_context == context]
+        scores = sorted((s for s in scores if s[1] >= threshold), key=lambda s: -s[1])
+        rows.extend((display, existing, score) for existing, score in scores[:limit])
+    return rows
+
+def _find_near_duplicates(kind, user_id, candidates, threshold, limit):
+    conn = get_db_connection(readonly=True, user_id=user_id)
     if conn:
         cur = conn.cursor()
         try:
-            cur.execute("""
-                SELECT id, gorilla_id, api_response, created_at, updated_at
-                FROM family_history
-                WHERE user_id = %s
-            """, (user_id,))
-            result = cur.fetchone()
-            if result:
-                return {
-                    'id': result[0],
-                    'gorilla_id': result[1],
-                    'api_response': result[2],  # No need for json.loads as it's already in JSON format
-                    'created_at': result[3],
-                    'updated_at': result[4]
-                }
+            params = {'user_id': user_id, 'kind': kind, 'entries': Jsonb(list(candidates)), 'limit': limit}
+            if _pg_trgm_unknown():
+                cur.execute(_HAS_PG_TRGM_SQL)
+                _set_pg_trgm(cur.fetchone()[0])
+            rows = None
+            if _pg_trgm_installed:
+                try:
+                    with conn.pipeline():
+                        # Transaction-local threshold for the % operator, set
+                        # on its own cursor so that cur holds only the matches
+                        conn.execute("SELECT set_config('pg_trgm.similarity_threshold', %s, true)",
+                                     (str(threshold),), prepare=True)
+                        cur.execute(_NEAR_DUPLICATES_SQL, params, prepare=True)
+                    rows = cur.fetchall()
+                except psycopg.errors.UndefinedFunction:
+                    # pg_trgm was dropped since it was looked up
+                    conn.rollback()
+                    _set_pg_trgm(False)
+            if rows is None:
+                cur.execute(_CANDIDATE_NAMES_SQL, params, prepare=True)
+                names = cur.fetchall()
+                cur.execute(_SAVED_NAMES_SQL, params, prepare=True)
+                rows = _match_near_duplicates(names, cur.fetchall(), threshold, limit)
+            conn.commit()
+            return [{'name': name, 'existing': existing, 'similarity': score}
+                    for name, existing, score in rows]
+        except Exception as e:
+            conn.rollback()
+            print(f"Error finding similar {kind}: {e}")
             return None
         finally:
             cur.close()
-            conn.close()
+            release_db_connection(conn)
     return None
 
-def check_duplicate_family_history(user_id, new_history):
+@_instrumented
+def split_duplicate_conditions(user_id, new_conditions):
     """
-    Check if a family history entry already exists in the database for a user
+    Check a batch of conditions against the user's saved conditions by
+    their fingerprints (code or name, asserted date and clinical status).
+    Returns (duplicates, new_conditions), or None on error
+    """
+    return _split_saved_duplicates('conditions', user_id, new_conditions)
+
+@_instrumented
+def check_duplicate_condition(user_id, new_condition):
+    """
+    Check if a condition already exists in the database for a user
     Returns True if duplicate found, False otherwise
     """
-    conn = get_db_connection()
-    if conn:
-        cur = conn.cursor()
-        try:
-            # Get existing family history
+    result = split_duplicate_conditions(user_id, [new_condition])
+    return bool(result and result[0])
+
+@_instrumented
+def find_similar_conditions(user_id, new_conditions, threshold=None, limit=5):
+    """
+    Find saved conditions whose names look like those of new_conditions
+    (e.g. "Type 2 diabetes" and "Diabetes type 2"), by trigram similarity
+    of at least threshold (default NEAR_DUPLICATE_THRESHOLD).
+    Returns [{'name', 'existing', 'similarity'}, ...], best matches first
+    for each new condition, or None on error
+    """
+    threshold = NEAR_DUPLICATE_THRESHOLD if threshold is None else threshold
+    return _find_near_duplicates('conditions', user_id, new_conditions, threshold, limit)
+
+# Condition summary fields that get_condition_summaries() can project, as
+# SQL over the entry (e.entry) and its resource (r.resource)
+_CONDITION_SUMMARY_FIELDS = {
+    'id': "COALESCE(r.resource->>'id', e.entry->>'id')",
+    'name': "fhir_codeable_text(r.resource->'code')",
+    # The minimizer drops a div that only repeats the name
+    'text': "COALESCE(regexp_replace(r.resource->'text'->>'div', '<[^<]+?>', '', 'g'), "
+            "fhir_codeable_text(r.resource->'code'))",
+    'recorded_date': "fhir_date(r.resource->>'assertedDate')",
+    'status': "fhir_condition_status(r.resource)",
+    'category': "COALESCE(r.resource->'category'->0->'coding'->0->>'display', '')",
+    'onset_date': "fhir_date(r.resource->'onsetPeriod'->>'start')",
+    'code': "r.resource->'code'->'coding'->0->>'code'",
+    'code_system': "r.resource->'code'->'coding'->0->>'system'",
+}
+
+# What a condition card on the conditions page shows
+CONDITION_CARD_FIELDS = ('name', 'text', 'recorded_date', 'status', 'category', 'onset_date')
+
+# Every condition entry of a user with its resource; callers add the
+# projection and filters
+_CONDITION_ENTRIES_SQL = """
+    FROM conditions c
+    CROSS JOIN LATERAL jsonb_array_elements(fhir_document_entries(c.api_response))
+        WITH ORDINALITY AS e(entry, pos)
+    CROSS JOIN LATERAL (SELECT fhir_entry_resource(e.entry) AS resource) r
+    WHERE c.user_id = %(user_id)s
+      AND r.resource <> '{}'::jsonb
+"""
+
+@_instrumented
+def get_condition_summaries(user_id, status=None, year=None, fields=CONDITION_CARD_FIELDS):
+    """
+    Get compact summaries of a user's saved conditions, filtered and
+    projected in the database so the full document never leaves Postgres.
+    status is a clinical status code or a list of them, year filters on the
+    recorded date and fields picks keys from _CONDITION_SUMMARY_FIELDS.
+    Returns a list of dicts in saved order
+    """
+    unknown = [field for field in fields if field not in _CONDITION_SUMMARY_FIELDS]
+    if unknown:
+        raise ValueError(f"Unknown condition summary fields: {unknown}")
+    if isinstance(status, str):
+        status = [status]
+    columns = ', '.join(f"{_CONDITION_SUMMARY_FIELDS[field]} AS {field}" for field in fields)
+    conn = get_db_connection(readonly=True, user_id=user_id)
+    if conn:
+        cur = conn.cursor()
+        try:
+            cur.execute(f"""
+                SELECT {columns}
+                {_CONDITION_ENTRIES_SQL}
+                  AND (%(status)s::text[] IS NULL OR fhir_condition_status(r.resource) = ANY(%(status)s))
+                  AND (%(year)s::text IS NULL OR left(fhir_date(r.resource->>'assertedDate'), 4) = %(year)s)
+                ORDER BY e.pos
+            """, {
+                'user_id': user_id,
+                'status': list(status) if status else None,
+                'year': str(year) if year else None,
+            }, prepare=True)
+            return [dict(zip(fields, row)) for row in cur.fetchall()]
+        except Exception as e:
+            conn.rollback()
+            print(f"Error getting condition summaries: {e}")
+            return []
+        finally:
+            cur.close()
+            release_db_connection(conn)
+    return []
+
+@_instrumented
+def get_condition_years(user_id):
+    """
+    Get the distinct years in which a user's saved conditions were recorded,
+    newest first
+    """
+    conn = get_db_connection(readonly=True, user_id=user_id)
+    if conn:
+        cur = conn.cursor()
+        try:
+            cur.execute(f"""
+                SELECT DISTINCT left(fhir_date(r.resource->>'assertedDate'), 4) AS year
+                {_CONDITION_ENTRIES_SQL}
+                  AND fhir_date(r.resource->>'assertedDate') <> ''
+                ORDER BY year DESC
+            """, {'user_id': user_id}, prepare=True)
+            return [row[0] for row in cur.fetchall()]
+        except Exception as e:
+            conn.rollback()
+            print(f"Error getting condition years: {e}")
+            return []
+        finally:
+            cur.close()
+            release_db_connection(conn)
+    return []
+
+def _encode_cursor(sort_date, seq):
+    """
+    Opaque page token for the entry after which the next page starts
+    """
+    return base64.urlsafe_b64encode(json.dumps([sort_date, seq]).encode()).decode()
+
+def _decode_cursor(cursor):
+    try:
+        sort_date, seq = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return str(sort_date), int(seq)
+    except Exception:
+        raise ValueError(f"Invalid page cursor: {cursor!r}")
+
+def _fetch_page(cur, sql, params, after, limit):
+    """
+    Run a keyset page query whose last two columns are the sort date and the
+    sequence number of a document_entries row, starting after the decoded
+    cursor after. Returns (rows without those columns, next cursor or None)
+    """
+    after_date, after_seq = after or (None, None)
+    cur.execute(sql, dict(params, after_date=after_date, after_seq=after_seq, limit=limit + 1),
+                prepare=True)
+    rows = cur.fetchall()
+    next_cursor = _encode_cursor(*rows[limit - 1][-2:]) if len(rows) > limit else None
+    return [row[:-2] for row in rows[:limit]], next_cursor
+
+# One row per saved entry (migration 14); pages walk its
+# (sort_date DESC, seq DESC) index, which keeps the same order when other
+# entries are replaced or deleted
+_PAGE_ENTRIES_SQL = """
+    FROM document_entries e
+    CROSS JOIN LATERAL (SELECT fhir_entry_resource(e.entry) AS resource) r
+    WHERE e.user_id = %(user_id)s AND e.kind = '{kind}'
+"""
+
+@_instrumented
+def get_conditions_page(user_id, status=None, year=None, cursor=None, limit=25,
+                        fields=CONDITION_CARD_FIELDS):
+    """
+    Get one page of a user's condition summaries, newest first, filtered
+    like get_condition_summaries(). Pass the returned cursor back to get the
+    next page; it is None on the last page.
+    Returns (summaries, next_cursor)
+    """
+    unknown = [field for field in fields if field not in _CONDITION_SUMMARY_FIELDS]
+    if unknown:
+        raise ValueError(f"Unknown condition summary fields: {unknown}")
+    if isinstance(status, str):
+        status = [status]
+    columns = ', '.join(f"{_CONDITION_SUMMARY_FIELDS[field]} AS {field}" for field in fields)
+    after = _decode_cursor(cursor) if cursor else None
+    conn = get_db_connection(readonly=True, user_id=user_id)
+    if conn:
+        cur = conn.cursor()
+        try:
+            rows, next_cursor = _fetch_page(cur, f"""
+                SELECT {columns}, e.sort_date, e.seq
+                {_PAGE_ENTRIES_SQL.format(kind='conditions')}
+                  AND (%(status)s::text[] IS NULL OR fhir_condition_status(r.resource) = ANY(%(status)s))
+                  AND (%(year)s::text IS NULL OR left(fhir_date(r.resource->>'assertedDate'), 4) = %(year)s)
+                  AND (%(after_date)s::text IS NULL
+                       OR (e.sort_date, e.seq) < (%(after_date)s::text, %(after_seq)s::bigint))
+                ORDER BY e.sort_date DESC, e.seq DESC
+                LIMIT %(limit)s
+            """, {
+                'user_id': user_id,
+                'status': list(status) if status else None,
+                'year': str(year) if year else None,
+            }, after, limit)
+            return [dict(zip(fields, row)) for row in rows], next_cursor
+        except Exception as e:
+            conn.rollback()
+            print(f"Error getting conditions page: {e}")
+            return [], None
+        finally:
+            cur.close()
+            release_db_connection(conn)
+    return [], None
+
+@_instrumented
+def get_condition_status_counts(user_id, year=None):
+    """
+    Count a user's saved conditions per clinical status, optionally for the
+    year they were recorded in. Returns {status: count}
+    """
+    conn = get_db_connection(readonly=True, user_id=user_id)
+    if conn:
+        cur = conn.cursor()
+        try:
+            cur.execute(f"""
+                SELECT fhir_condition_status(r.resource) AS status, count(*)
+                {_CONDITION_ENTRIES_SQL}
+                  AND (%(year)s::text IS NULL OR left(fhir_date(r.resource->>'assertedDate'), 4) = %(year)s)
+                GROUP BY status
+            """, {'user_id': user_id, 'year': str(year) if year else None}, prepare=True)
+            return dict(cur.fetchall())
+        except Exception as e:
+            conn.rollback()
+            print(f"Error counting conditions: {e}")
+            return {}
+        finally:
+            cur.close()
+            release_db_connection(conn)
+    return {}
+
+# Upsert of a user's family history; with %(expected)s set, only over that version
+_SAVE_FAMILY_HISTORY_SQL = """
+    INSERT INTO family_history (
+        user_id, gorilla_id, api_response
+    ) VALUES (%(user_id)s, %(gorilla_id)s, %(document)s)
+    ON CONFLICT (user_id) DO UPDATE
+    SET api_response = EXCLUDED.api_response,
+        version = family_history.version + 1,
+        updated_at = CURRENT_TIMESTAMP
+    WHERE %(expected)s::integer IS NULL OR family_history.version = %(expected)s
+    RETURNING id
+"""
+
+@_instrumented
+def save_family_history(user_id, gorilla_id, api_response, expected_version=None):
+    """
+    Save family history API response for a user
+    With expected_version (the version read with
+    get_family_history_by_user_id, 0 if there was no row), the save only
+    applies if nobody else has written since, and raises VersionConflict
+    otherwise.
+    """
+    conn = get_db_connection()
+    if conn:
+        cur = conn.cursor()
+        try:
+            # Atomic upsert; the statement and the commit go out in one flight.
+            # An existing row keeps its original gorilla_id.
+            with conn.pipeline():
+                cur.execute(_SAVE_FAMILY_HISTORY_SQL, {
+                    'user_id': user_id, 'gorilla_id': gorilla_id, 'document': Jsonb(_minimizer.minimize(api_response)),
+                    'expected': expected_version
+                }, prepare=True)
+                conn.commit()
+            _invalidate('family_history', user_id)
+            result = cur.fetchone()
+        except Exception as e:
+            conn.rollback()
+            print(f"Error saving family history: {e}")
+            return None
+        finally:
+            cur.close()
+            release_db_connection(conn)
+        if result is None:
+            raise VersionConflict('family_history', user_id, expected_version)
+        return result[0]
+
+@_instrumented
+def get_family_history_by_user_id(user_id):
+    """
+    Get family history API response for a user
+    """
+    return _cached('family_history', user_id, _load_family_history)
+
+def _load_family_history(user_id, readonly=True):
+    conn = get_db_connection(readonly=readonly, user_id=user_id)
+    if conn:
+        cur = conn.cursor()
+        try:
             cur.execute("""
-                SELECT api_response 
-                FROM family_history 
+                SELECT id, gorilla_id, api_response, created_at, updated_at, version
+                FROM family_history
                 WHERE user_id = %s
-            """, (user_id,))
+            """, (user_id,), prepare=True)
             result = cur.fetchone()
-            
-            if not result or not result[0]:
-                return False
-                
-            existing_history = result[0]
-            
-            # Extract key fields from new history entry
-            new_resource = new_history.get('resource', {})
-            new_relationship = new_resource.get('relationship', {})
-            new_relationship_text = new_relationship.get('text', '')
-            if not new_relationship_text and 'coding' in new_relationship:
-                new_relationship_text = new_relationship['coding'][0].get('display', '')
-            
-            new_gender = new_resource.get('gender', '')
-            new_born_date = new_resource.get('bornDate', '')
-            
-            # Check each existing history entry
-            for entry in existing_history.get('entry', []):
-                existing_resource = entry.get('resource', {})
-                existing_relationship = existing_resource.get('relationship', {})
-                existing_relationship_text = existing_relationship.get('text', '')
-                if not existing_relationship_text and 'coding' in existing_relationship:
-                    existing_relationship_text = existing_relationship['coding'][0].get('display', '')
-                
-                existing_gender = existing_resource.get('gender', '')
-                existing_born_date = existing_resource.get('bornDate', '')
-                
-                # Compare key fields
-                if (new_relationship_text == existing_relationship_text and 
-                    new_gender == existing_gender and 
-                    new_born_date == existing_born_date):
-                    return True
-            
+            if result:
+                return {
+                    'id': result[0],
+                    'gorilla_id': result[1],
+                    'api_response': _minimizer.rehydrate(result[2]),
+                    'created_at': result[3],
+                    'updated_at': result[4],
+                    'version': result[5]
+                }
+            return None
+        finally:
+            cur.close()
+            release_db_connection(conn)
+    return None
+
+@_instrumented
+def split_duplicate_family_history(user_id, new_entries):
+    """
+    Check a batch of family history entries against the user's saved
+    family history by their fingerprints (relationship, gender, birth date,
+    name and conditions). Returns (duplicates, new_entries), or None on error
+    """
+    return _split_saved_duplicates('family_history', user_id, new_entries)
+
+@_instrumented
+def check_duplicate_family_history(user_id, new_history):
+    """
+    Check if a family history entry already exists in the database for a user
+    Returns True if duplicate found, False otherwise
+    """
+    result = split_duplicate_family_history(user_id, [new_history])
+    return bool(result and result[0])
+
+@_instrumented
+def find_similar_family_history(user_id, new_entries, threshold=None, limit=5):
+    """
+    Find conditions already saved for the same relatives whose names look
+    like the conditions of new_entries (see find_similar_conditions).
+    Returns [{'name', 'existing', 'similarity'}, ...], or None on error
+    """
+    threshold = NEAR_DUPLICATE_THRESHOLD if threshold is None else threshold
+    return _find_near_duplicates('family_history', user_id, new_entries, threshold, limit)
+
+# Family history entries with their resource; callers add the projection
+_FAMILY_HISTORY_ENTRIES_SQL = """
+    FROM family_history f
+    CROSS JOIN LATERAL jsonb_array_elements(fhir_document_entries(f.api_response))
+        WITH ORDINALITY AS e(entry, pos)
+    CROSS JOIN LATERAL (SELECT fhir_entry_resource(e.entry) AS resource) r
+    WHERE f.user_id = %(user_id)s
+      AND r.resource <> '{}'::jsonb
+"""
+
+@_instrumented
+def get_family_history_page(user_id, cursor=None, limit=20):
+    """
+    Get one page of a user's saved family history entries, newest first.
+    Pass the returned cursor back to get the next page; it is None on the
+    last page.
+    Returns (entries, next_cursor)
+    """
+    after = _decode_cursor(cursor) if cursor else None
+    conn = get_db_connection(readonly=True, user_id=user_id)
+    if conn:
+        cur = conn.cursor()
+        try:
+            rows, next_cursor = _fetch_page(cur, f"""
+                SELECT e.entry, e.sort_date, e.seq
+                {_PAGE_ENTRIES_SQL.format(kind='family_history')}
+                  AND (%(after_date)s::text IS NULL
+                       OR (e.sort_date, e.seq) < (%(after_date)s::text, %(after_seq)s::bigint))
+                ORDER BY e.sort_date DESC, e.seq DESC
+                LIMIT %(limit)s
+            """, {'user_id': user_id}, after, limit)
+            return [_minimizer.rehydrate(row[0]) for row in rows], next_cursor
+        except Exception as e:
+            conn.rollback()
+            print(f"Error getting family history page: {e}")
+            return [], None
+        finally:
+            cur.close()
+            release_db_connection(conn)
+    return [], None
+
+@_instrumented
+def count_family_history(user_id):
+    """
+    Count a user's saved family history entries
+    """
+    conn = get_db_connection(readonly=True, user_id=user_id)
+    if conn:
+        cur = conn.cursor()
+        try:
+            cur.execute(f"SELECT count(*) {_FAMILY_HISTORY_ENTRIES_SQL}",
+                        {'user_id': user_id}, prepare=True)
+            return cur.fetchone()[0]
+        except Exception as e:
+            conn.rollback()
+            print(f"Error counting family history: {e}")
+            return 0
+        finally:
+            cur.close()
+            release_db_connection(conn)
+    return 0
+
+USER_SUMMARY_FIELDS = ('conditions_total', 'conditions_active', 'conditions_inactive', 'conditions_unknown',
+                       'condition_status_counts', 'condition_years', 'relatives', 'relatives_cause_of_death',
+                       'conditions_version', 'family_history_version')
+
+# One row per user, kept up to date by triggers on conditions and
+# family_history (see migration 11), plus the version of each document
+_USER_SUMMARY_SQL = f"""
+    SELECT {', '.join(USER_SUMMARY_FIELDS[:-2])},
+           COALESCE((SELECT version FROM conditions WHERE user_id = %(user_id)s), 0),
+           COALESCE((SELECT version FROM family_history WHERE user_id = %(user_id)s), 0)
+    FROM user_summary WHERE user_id = %(user_id)s
+"""
+
+def _user_summary(row):
+    """
+    Turn a user_summary row (or None, for a user with nothing saved) into a dict
+    """
+    if row is None:
+        summary = dict.fromkeys(USER_SUMMARY_FIELDS, 0)
+        summary.update(condition_status_counts={}, condition_years=[])
+        return summary
+    return dict(zip(USER_SUMMARY_FIELDS, row))
+
+@_instrumented
+def get_user_summary(user_id):
+    """
+    Get a user's condition counts (total, active, inactive, other and per
+    status), the years conditions were recorded in, newest first, the
+    number of relatives, and the version of each document, from the
+    trigger-maintained user_summary row
+    """
+    conn = get_db_connection(readonly=True, user_id=user_id)
+    if conn:
+        cur = conn.cursor()
+        try:
+            cur.execute(_USER_SUMMARY_SQL, {'user_id': user_id}, prepare=True)
+            return _user_summary(cur.fetchone())
+        except Exception as e:
+            conn.rollback()
+            print(f"Error getting user summary: {e}")
+            return None
+        finally:
+            cur.close()
+            release_db_connection(conn)
+    return None
+
+def _with_entry_ids(entries):
+    """
+    Return copies of the entries where every resource has an id, so that
+    single entries can later be replaced or deleted by id
+    """
+    result = []
+    for entry in entries:
+        if isinstance(entry, dict) and isinstance(entry.get('resource'), dict):
+            if not entry['resource'].get('id'):
+                entry = dict(entry, resource=dict(entry['resource'], id=uuid.uuid4().hex))
+        elif isinstance(entry, dict) and not entry.get('id'):
+            entry = dict(entry, id=uuid.uuid4().hex)
+        result.append(entry)
+    return result
+
+# Appends entries to a user's conditions, which may be a plain list or a Bundle
+_APPEND_CONDITIONS_SQL = """
+    INSERT INTO conditions (
+        user_id, gorilla_id, api_response
+    ) VALUES (%(user_id)s, %(gorilla_id)s, %(entries)s)
+    ON CONFLICT (user_id) DO UPDATE
+    SET api_response = CASE jsonb_typeof(conditions.api_response)
+            WHEN 'array' THEN conditions.api_response || EXCLUDED.api_response
+            WHEN 'object' THEN jsonb_set(
+                conditions.api_response, '{entry}',
+                COALESCE(conditions.api_response->'entry', '[]'::jsonb) || EXCLUDED.api_response)
+            ELSE EXCLUDED.api_response
+        END,
+        gorilla_id = COALESCE(EXCLUDED.gorilla_id, conditions.gorilla_id),
+        version = conditions.version + 1,
+        updated_at = CURRENT_TIMESTAMP
+    WHERE %(expected)s::integer IS NULL OR conditions.version = %(expected)s
+    RETURNING id
+"""
+
+@_instrumented
+def append_conditions(user_id, gorilla_id, new_conditions, expected_version=None):
+    """
+    Append condition entries to a user's saved conditions in a single write,
+    without reading the existing document back.
+    Entries without a resource id are given one.
+    With expected_version, raises VersionConflict if the conditions changed
+    since that version was read.
+    Returns the conditions row id
+    """
+    new_conditions = _with_entry_ids(new_conditions)
+    conn = get_db_connection()
+    if conn:
+        cur = conn.cursor()
+        try:
+            with conn.pipeline():
+                cur.execute(_APPEND_CONDITIONS_SQL, {
+                    'user_id': user_id, 'gorilla_id': gorilla_id, 'entries': Jsonb(_minimizer.minimize(new_conditions)),
+                    'expected': expected_version
+                }, prepare=True)
+                conn.commit()
+            _invalidate('conditions', user_id)
+            result = cur.fetchone()
+        except Exception as e:
+            conn.rollback()
+            print(f"Error appending conditions: {e}")
+            return None
+        finally:
+            cur.close()
+            release_db_connection(conn)
+        if result is None:
+            raise VersionConflict('conditions', user_id, expected_version)
+        return result[0]
+    return None
+
+# Appends the entries of a Bundle to a user's family history Bundle
+_APPEND_FAMILY_HISTORY_SQL = """
+    INSERT INTO family_history (
+        user_id, gorilla_id, api_response
+    ) VALUES (%(user_id)s, %(gorilla_id)s, %(history)s)
+    ON CONFLICT (user_id) DO UPDATE
+    SET api_response = CASE jsonb_typeof(family_history.api_response)
+            WHEN 'object' THEN jsonb_set(
+                family_history.api_response, '{entry}',
+                COALESCE(family_history.api_response->'entry', '[]'::jsonb)
+                    || (EXCLUDED.api_response->'entry'))
+            ELSE EXCLUDED.api_response
+        END,
+        version = family_history.version + 1,
+        updated_at = CURRENT_TIMESTAMP
+    WHERE %(expected)s::integer IS NULL OR family_history.version = %(expected)s
+    RETURNING id
+"""
+
+@_instrumented
+def append_family_history_entries(user_id, gorilla_id, new_entries, expected_version=None):
+    """
+    Append entries to a user's family history Bundle in a single write,
+    without reading the existing Bundle back.
+    Entries without a resource id are given one.
+    With expected_version, raises VersionConflict if the family history
+    changed since that version was read.
+    Returns the family_history row id
+    """
+    new_history = {
+        'resourceType': 'Bundle',
+        'type': 'searchset',
+        'entry': _with_entry_ids(new_entries)
+    }
+    conn = get_db_connection()
+    if conn:
+        cur = conn.cursor()
+        try:
+            with conn.pipeline():
+                cur.execute(_APPEND_FAMILY_HISTORY_SQL, {
+                    'user_id': user_id, 'gorilla_id': gorilla_id, 'history': Jsonb(_minimizer.minimize(new_history)),
+                    'expected': expected_version
+                }, prepare=True)
+                conn.commit()
+            _invalidate('family_history', user_id)
+            result = cur.fetchone()
+        except Exception as e:
+            conn.rollback()
+            print(f"Error appending family history: {e}")
+            return None
+        finally:
+            cur.close()
+            release_db_connection(conn)
+        if result is None:
+            raise VersionConflict('family_history', user_id, expected_version)
+        return result[0]
+    return None
+
+# Claims the fingerprints of the candidate entries for the user; the unique
+# index hands each one to exactly one writer, even across concurrent
+# transactions. "fresh" holds the entries whose fingerprint was claimed
+# (the first of any repeats), which the statements below append.
+_CLAIM_ENTRIES_CTE = """
+    WITH candidates AS (
+        SELECT e.entry, e.pos, fhir_entry_fingerprint('{kind}', e.entry) AS fingerprint
+        FROM jsonb_array_elements(%(entries)s) WITH ORDINALITY AS e(entry, pos)
+    ), claimed AS (
+        INSERT INTO entry_fingerprints (user_id, kind, fingerprint)
+        SELECT DISTINCT %(user_id)s::integer, '{kind}', fingerprint FROM candidates
+        ON CONFLICT DO NOTHING
+        RETURNING fingerprint
+    ), fresh AS (
+        SELECT DISTINCT ON (c.fingerprint) c.entry, c.pos
+        FROM candidates c JOIN claimed USING (fingerprint)
+        ORDER BY c.fingerprint, c.pos
+    )
+"""
+
+# Appends the conditions not saved yet; returns the positions appended
+_APPEND_NEW_CONDITIONS_SQL = _CLAIM_ENTRIES_CTE.format(kind='conditions') + """
+    , saved AS (
+        INSERT INTO conditions (user_id, gorilla_id, api_response)
+        SELECT %(user_id)s, %(gorilla_id)s, jsonb_agg(entry ORDER BY pos) FROM fresh
+        HAVING count(*) > 0
+        ON CONFLICT (user_id) DO UPDATE
+        SET api_response = CASE jsonb_typeof(conditions.api_response)
+                WHEN 'array' THEN conditions.api_response || EXCLUDED.api_response
+                WHEN 'object' THEN jsonb_set(
+                    conditions.api_response, '{entry}',
+                    COALESCE(conditions.api_response->'entry', '[]'::jsonb) || EXCLUDED.api_response)
+                ELSE EXCLUDED.api_response
+            END,
+            gorilla_id = COALESCE(EXCLUDED.gorilla_id, conditions.gorilla_id),
+            version = conditions.version + 1,
+            updated_at = CURRENT_TIMESTAMP
+        RETURNING id
+    )
+    SELECT ARRAY(SELECT pos FROM fresh ORDER BY pos)
+"""
+
+# Appends the family history entries not saved yet; returns the positions appended
+_APPEND_NEW_FAMILY_HISTORY_SQL = _CLAIM_ENTRIES_CTE.format(kind='family_history') + """
+    , saved AS (
+        INSERT INTO family_history (user_id, gorilla_id, api_response)
+        SELECT %(user_id)s, %(gorilla_id)s, jsonb_build_object(
+            'resourceType', 'Bundle', 'type', 'searchset', 'entry', jsonb_agg(entry ORDER BY pos))
+        FROM fresh
+        HAVING count(*) > 0
+        ON CONFLICT (user_id) DO UPDATE
+        SET api_response = CASE jsonb_typeof(family_history.api_response)
+                WHEN 'object' THEN jsonb_set(
+                    family_history.api_response, '{entry}',
+                    COALESCE(family_history.api_response->'entry', '[]'::jsonb)
+                        || (EXCLUDED.api_response->'entry'))
+                ELSE EXCLUDED.api_response
+            END,
+            version = family_history.version + 1,
+            updated_at = CURRENT_TIMESTAMP
+        RETURNING id
+    )
+    SELECT ARRAY(SELECT pos FROM fresh ORDER BY pos)
+"""
+
+def _split_appended(candidates, positions):
+    """
+    Partition candidates into (duplicates, new_entries) given the 1-based
+    positions that were appended
+    """
+    appended = set(positions)
+    duplicates = [entry for pos, entry in enumerate(candidates, 1) if pos not in appended]
+    new_entries = [entry for pos, entry in enumerate(candidates, 1) if pos in appended]
+    return duplicates, new_entries
+
+def _append_new(sql, kind, user_id, gorilla_id, candidates):
+    """
+    Append the candidates whose fingerprint the user does not have yet in a
+    single statement. Returns (duplicates, new_entries), or None on error
+    """
+    candidates = _with_entry_ids(candidates)
+    conn = get_db_connection()
+    if conn:
+        cur = conn.cursor()
+        try:
+            with conn.pipeline():
+                cur.execute(sql, {
+                    'user_id': user_id, 'gorilla_id': gorilla_id, 'entries': Jsonb(_minimizer.minimize(candidates))
+                }, prepare=True)
+                conn.commit()
+            positions = cur.fetchone()[0]
+            if positions:
+                _invalidate(kind, user_id)
+            return _split_appended(candidates, positions)
+        except Exception as e:
+            conn.rollback()
+            print(f"Error appending {kind}: {e}")
+            return None
+        finally:
+            cur.close()
+            release_db_connection(conn)
+    return None
+
+@_instrumented
+def append_new_conditions(user_id, gorilla_id, new_conditions):
+    """
+    Append the conditions that are not saved yet, without losing or
+    duplicating entries when two writers append at the same time.
+    Entries without a resource id are given one.
+    Returns (duplicates, new_conditions), or None if saving failed
+    """
+    return _append_new(_APPEND_NEW_CONDITIONS_SQL, 'conditions', user_id, gorilla_id, new_conditions)
+
+@_instrumented
+def append_new_family_history_entries(user_id, gorilla_id, new_entries):
+    """
+    Append the family history entries that are not saved yet, without losing
+    or duplicating entries when two writers append at the same time.
+    Entries without a resource id are given one.
+    Returns (duplicates, new_entries), or None if saving failed
+    """
+    return _append_new(_APPEND_NEW_FAMILY_HISTORY_SQL, 'family_history', user_id, gorilla_id, new_entries)
+
+# Locates one entry of a stored document by resource id and yields the
+# jsonb path to it. {table} is always one of our own table names.
+_ENTRY_PATH_CTE = """
+    WITH target AS (
+        SELECT t.id,
+               CASE jsonb_typeof(t.api_response)
+                   WHEN 'array' THEN ARRAY[(e.pos - 1)::text]
+                   ELSE ARRAY['entry', (e.pos - 1)::text]
+               END AS path
+        FROM {table} t
+        CROSS JOIN LATERAL jsonb_array_elements(
+            CASE
+                WHEN jsonb_typeof(t.api_response) = 'array' THEN t.api_response
+                WHEN jsonb_typeof(t.api_response->'entry') = 'array' THEN t.api_response->'entry'
+                ELSE '[]'::jsonb
+            END
+        ) WITH ORDINALITY AS e(entry, pos)
+        WHERE t.user_id = %s
+          AND COALESCE(e.entry->'resource'->>'id', e.entry->>'id') = %s
+        LIMIT 1
+        FOR UPDATE OF t
+    )
+"""
+
+def _update_entry(table, user_id, entry_id, new_entry=None):
+    """
+    Replace (or, without new_entry, delete) one entry of a user's stored
+    document in place. Returns True if an entry was changed.
+    """
+    if new_entry is None:
+        new_value = "t.api_response #- target.path"
+        params = (user_id, entry_id)
+    else:
+        new_value = "jsonb_set(t.api_response, target.path, %s)"
+        params = (user_id, entry_id, Jsonb(_minimizer.minimize(new_entry)))
+    conn = get_db_connection()
+    if conn:
+        cur = conn.cursor()
+        try:
+            with conn.pipeline():
+                cur.execute(_ENTRY_PATH_CTE.format(table=table) + f"""
+                    UPDATE {table} t
+                    SET api_response = {new_value},
+                        version = t.version + 1,
+                        updated_at = CURRENT_TIMESTAMP
+                    FROM target
+                    WHERE t.id = target.id
+                """, params, prepare=True)
+                conn.commit()
+            _invalidate(table, user_id)
+            return cur.rowcount > 0
+        except Exception as e:
+            conn.rollback()
+            print(f"Error updating {table} entry: {e}")
+            return False
+        finally:
+            cur.close()
+            release_db_connection(conn)
+    return False
+
+@_instrumented
+def replace_condition_entry(user_id, entry_id, new_condition):
+    """
+    Replace the saved condition whose resource id is entry_id
+    Returns True if the condition was found and replaced
+    """
+    return _update_entry('conditions', user_id, entry_id, new_condition)
+
+@_instrumented
+def delete_condition_entry(user_id, entry_id):
+    """
+    Delete the saved condition whose resource id is entry_id
+    Returns True if the condition was found and deleted
+    """
+    return _update_entry('conditions', user_id, entry_id)
+
+@_instrumented
+def replace_family_history_entry(user_id, entry_id, new_entry):
+    """
+    Replace the family history entry whose resource id is entry_id
+    Returns True if the entry was found and replaced
+    """
+    return _update_entry('family_history', user_id, entry_id, new_entry)
+
+@_instrumented
+def delete_family_history_entry(user_id, entry_id):
+    """
+    Delete the family history entry whose resource id is entry_id
+    Returns True if the entry was found and deleted
+    """
+    return _update_entry('family_history', user_id, entry_id)
+
+# Resource types accepted by the fhir_resources store; these are the types
+# the LOF backend exposes
+FHIR_RESOURCE_TYPES = (
+    'Condition',
+    'AllergyIntolerance',
+    'MedicationRequest',
+    'Immunization',
+    'Procedure',
+    'FamilyMemberHistory',
+)
+
+# Per resource type: the CodeableConcept stored in the code columns, the
+# status field, and the candidate fields for the asserted and onset dates
+_RESOURCE_FIELDS = {
+    'Condition': ('code', 'clinicalStatus', ('assertedDate', 'recordedDate'),
+                  ('onsetDateTime', 'onsetPeriod')),
+    'AllergyIntolerance': ('code', 'clinicalStatus', ('assertedDate', 'recordedDate'),
+                           ('onsetDateTime', 'onsetPeriod')),
+    'MedicationRequest': ('medicationCodeableConcept', 'status', ('authoredOn',), ()),
+    'Immunization': ('vaccineCode', 'status', ('date', 'occurrenceDateTime', 'recorded'), ()),
+    'Procedure': ('code', 'status', ('performedDateTime', 'performedPeriod'),
+                  ('performedDateTime', 'performedPeriod')),
+    'FamilyMemberHistory': ('relationship', 'status', ('date',), ()),
+}
+
+def _parse_fhir_date(value):
+    """
+    Parse a FHIR date, dateTime or Period into a date (partial dates are
+    rounded down to the first month/day); None if missing or invalid
+    """
+    if isinstance(value, dict):
+        value = value.get('start')
+    if not isinstance(value, str) or len(value) < 4:
+        return None
+    parts = value[:10].split('-')
+    try:
+        return datetime(
+            int(parts[0]),
+            int(parts[1]) if len(parts) > 1 else 1,
+            int(parts[2]) if len(parts) > 2 else 1
+        ).date()
+    except ValueError:
+        return None
+
+def _resource_id(resource):
+    """
+    Get the id of a resource, or a stable content hash for resources without one
+    """
+    if resource.get('id'):
+        return str(resource['id'])
+    canonical = json.dumps(resource, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
+def _resource_row(user_id, entry):
+    """
+    Build the fhir_resources column values for a resource (or wrapped entry)
+    """
+    resource = _entry_resource(entry)
+    resource_type = resource.get('resourceType')
+    if resource_type not in FHIR_RESOURCE_TYPES:
+        raise ValueError(f"Unsupported FHIR resource type: {resource_type!r}")
+
+    code_field, status_field, asserted_fields, onset_fields = _RESOURCE_FIELDS[resource_type]
+    concept = resource.get(code_field) or {}
+    coding = concept.get('coding') if isinstance(concept, dict) else None
+    coding = coding[0] if isinstance(coding, list) and coding and isinstance(coding[0], dict) else {}
+
+    if status_field == 'clinicalStatus':
+        status = _clinical_status_code(resource)
+    else:
+        status = resource.get(status_field) or None
+
+    asserted = next((d for d in (_parse_fhir_date(resource.get(f)) for f in asserted_fields) if d), None)
+    onset = next((d for d in (_parse_fhir_date(resource.get(f)) for f in onset_fields) if d), None)
+
+    return (
+        user_id,
+        resource_type,
+        _resource_id(resource),
+        Jsonb(resource),
+        coding.get('system'),
+        coding.get('code'),
+        _codeable_text(concept) or None,
+        status,
+        asserted,
+        onset
+    )
+
+_UPSERT_RESOURCE_SQL = """
+    INSERT INTO fhir_resources (
+        user_id, resource_type, resource_id, resource, code_system, code,
+        display, clinical_status, asserted_date, onset_date
+    ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+    ON CONFLICT (user_id, resource_type, resource_id) DO UPDATE
+    SET resource = EXCLUDED.resource,
+        code_system = EXCLUDED.code_system,
+        code = EXCLUDED.code,
+        display = EXCLUDED.display,
+        clinical_status = EXCLUDED.clinical_status,
+        asserted_date = EXCLUDED.asserted_date,
+        onset_date = EXCLUDED.onset_date,
+        updated_at = CURRENT_TIMESTAMP
+"""
+
+@_instrumented
+def save_resource(user_id, resource):
+    """
+    Save or update a single FHIR resource in the resource store
+    Returns the resource_id
+    """
+    try:
+        row = _resource_row(user_id, resource)
+    except ValueError as e:
+        print(f"Error saving resource: {e}")
+        return None
+    conn = get_db_connection()
+    if conn:
+        cur = conn.cursor()
+        try:
+            with conn.pipeline():
+                cur.execute(_UPSERT_RESOURCE_SQL, row, prepare=True)
+                conn.commit()
+            return row[2]
+        except Exception as e:
+            conn.rollback()
+            print(f"Error saving resource: {e}")
+            return None
+        finally:
+            cur.close()
+            release_db_connection(conn)
+    return None
+
+@_instrumented
+def save_resources(user_id, resources):
+    """
+    Save or update many FHIR resources (or Bundle entries) in one transaction
+    Returns the list of saved resource_ids
+    """
+    try:
+        rows = [_resource_row(user_id, resource) for resource in resources]
+    except ValueError as e:
+        print(f"Error saving resources: {e}")
+        return None
+    if not rows:
+        return []
+    conn = get_db_connection()
+    if conn:
+        cur = conn.cursor()
+        try:
+            # executemany pipelines the statements into a single flight
+            cur.executemany(_UPSERT_RESOURCE_SQL, rows)
+            conn.commit()
+            return [row[2] for row in rows]
+        except Exception as e:
+            conn.rollback()
+            print(f"Error saving resources: {e}")
+            return None
+        finally:
+            cur.close()
+            release_db_connection(conn)
+    return None
+
+def _resource_dict(row):
+    """
+    Convert a fhir_resources row selected with _RESOURCE_COLUMNS into a dictionary
+    """
+    return {
+        'resource_type': row[0],
+        'resource_id': row[1],
+        'resource': row[2],
+        'code_system': row[3],
+        'code': row[4],
+        'display': row[5],
+        'clinical_status': row[6],
+        'asserted_date': row[7],
+        'onset_date': row[8],
+        'created_at': row[9],
+        'updated_at': row[10]
+    }
+
+_RESOURCE_COLUMNS = """
+    resource_type, resource_id, resource, code_system, code, display,
+    clinical_status, asserted_date, onset_date, created_at, updated_at
+"""
+
+@_instrumented
+def get_resource(user_id, resource_type, resource_id):
+    """
+    Get a single FHIR resource from the resource store
+    """
+    conn = get_db_connection(readonly=True, user_id=user_id)
+    if conn:
+        cur = conn.cursor()
+        try:
+            cur.execute(
+                "SELECT" + _RESOURCE_COLUMNS + """
+                FROM fhir_resources
+                WHERE user_id = %s AND resource_type = %s AND resource_id = %s
+            """, (user_id, resource_type, resource_id), prepare=True)
+            result = cur.fetchone()
+            return _resource_dict(result) if result else None
+        finally:
+            cur.close()
+            release_db_connection(conn)
+    return None
+
+@_instrumented
+def get_resources(user_id, resource_type=None, clinical_status=None):
+    """
+    Get a user's FHIR resources from the resource store, optionally filtered
+    by type and status, most recently asserted first
+    """
+    conn = get_db_connection(readonly=True, user_id=user_id)
+    if conn:
+        cur = conn.cursor()
+        try:
+            cur.execute(
+                "SELECT" + _RESOURCE_COLUMNS + """
+                FROM fhir_resources
+                WHERE user_id = %s
+                  AND (%s::text IS NULL OR resource_type = %s)
+                  AND (%s::text IS NULL OR clinical_status = %s)
+                ORDER BY asserted_date DESC NULLS LAST, resource_id
+            """, (user_id, resource_type, resource_type, clinical_status, clinical_status))
+            return [_resource_dict(row) for row in cur.fetchall()]
+        finally:
+            cur.close()
+            release_db_connection(conn)
+    return []
+
+@_instrumented
+def delete_resource(user_id, resource_type, resource_id):
+    """
+    Delete a single FHIR resource from the resource store
+    Returns True if a resource was deleted
+    """
+    conn = get_db_connection()
+    if conn:
+        cur = conn.cursor()
+        try:
+            cur.execute("""
+                DELETE FROM fhir_resources
+                WHERE user_id = %s AND resource_type = %s AND resource_id = %s
+            """, (user_id, resource_type, resource_id))
+            conn.commit()
+            return cur.rowcount > 0
+        except Exception as e:
+            conn.rollback()
+            print(f"Error deleting resource: {e}")
             return False
         finally:
             cur.close()
-            conn.close()
+            release_db_connection(conn)
     return False
 
+@_instrumented
+def delete_resources(user_id, resource_type=None):
+    """
+    Delete all of a user's FHIR resources, or only those of one type
+    Returns the number of resources deleted
+    """
+    conn = get_db_connection()
+    if conn:
+        cur = conn.cursor()
+        try:
+            cur.execute("""
+                DELETE FROM fhir_resources
+                WHERE user_id = %s AND (%s::text IS NULL OR resource_type = %s)
+            """, (user_id, resource_type, resource_type))
+            conn.commit()
+            return cur.rowcount
+        except Exception as e:
+            conn.rollback()
+            print(f"Error deleting resources: {e}")
+            return 0
+        finally:
+            cur.close()
+            release_db_connection(conn)
+    return 0
+
+# One JSON document per user, built entirely in Postgres. Timestamps are
+# formatted server-side in the same ISO 8601 layout as datetime.isoformat().
+_USER_DOCUMENT_SQL = """
+    SELECT u.id AS user_id, json_build_object(
+        'user_info', json_build_object(
+            'id', u.id,
+            'username', u.username,
+            'email', u.email,
+            'created_at', to_char(u.created_at, 'YYYY-MM-DD"T"HH24:MI:SS.US')
+        ),
+        'profile', CASE WHEN p.user_id IS NULL THEN NULL ELSE json_build_object(
+            'gorilla_id', p.gorilla_id,
+            'profile_data', p.profile_data,
+            'created_at', to_char(p.created_at, 'YYYY-MM-DD"T"HH24:MI:SS.US'),
+            'updated_at', to_char(p.updated_at, 'YYYY-MM-DD"T"HH24:MI:SS.US')
+        ) END,
+        'conditions', CASE WHEN c.user_id IS NULL THEN NULL ELSE json_build_object(
+            'gorilla_id', c.gorilla_id,
+            'api_response', c.api_response,
+            'created_at', to_char(c.created_at, 'YYYY-MM-DD"T"HH24:MI:SS.US'),
+            'updated_at', to_char(c.updated_at, 'YYYY-MM-DD"T"HH24:MI:SS.US')
+        ) END,
+        'family_history', CASE WHEN f.user_id IS NULL THEN NULL ELSE json_build_object(
+            'gorilla_id', f.gorilla_id,
+            'api_response', f.api_response,
+            'created_at', to_char(f.created_at, 'YYYY-MM-DD"T"HH24:MI:SS.US'),
+            'updated_at', to_char(f.updated_at, 'YYYY-MM-DD"T"HH24:MI:SS.US')
+        ) END
+    ) AS document
+    FROM users u
+    LEFT JOIN profiles p ON p.user_id = u.id
+    LEFT JOIN conditions c ON c.user_id = u.id
+    LEFT JOIN family_history f ON f.user_id = u.id
+"""
+
+def _rehydrate_user_document(document):
+    for section in ('conditions', 'family_history'):
+        if document.get(section):
+            _minimizer.rehydrate(document[section]['api_response'])
+    return document
+
+def _rehydrate_user_json(document_json, indent=None):
+    """
+    Rehydrate a user document built as JSON text, indented by indent spaces
+    if given; skipped when minimizing is off and no indent is asked for, so
+    exports keep streaming the text untouched
+    """
+    if _minimizer.mode == 'off' and indent is None:
+        return document_json
+    return json.dumps(_rehydrate_user_document(json.loads(document_json)), indent=indent)
+
+@_instrumented
 def get_all_user_data(user_id):
     """
     Get all data for a user from all tables
     Returns a dictionary containing all user data
     """
-    conn = get_db_connection()
+    conn = get_db_connection(readonly=True, user_id=user_id)
     if conn:
         cur = conn.cursor()
         try:
-            # Initialize result dictionary
-            user_data = {
+            cur.execute(_USER_DOCUMENT_SQL + "WHERE u.id = %s", (user_id,), prepare=True)
+            result = cur.fetchone()
+            if result:
+                return _rehydrate_user_document(result[1])
+            return {
                 "user_info": None,
                 "profile": None,
                 "conditions": None,
                 "family_history": None
             }
-            
-            # Get user info
-            cur.execute("""
-                SELECT id, username, email, created_at 
-                FROM users 
-                WHERE id = %s
-            """, (user_id,))
-            user = cur.fetchone()
-            if user:
-                user_data["user_info"] = {
-                    "id": user[0],
-                    "username": user[1],
-                    "email": user[2],
-                    "created_at": user[3].isoformat() if user[3] else None
-                }
-            
-            # Get profile data
+        except Exception as e:
+            print(f"Error getting all user data: {e}")
+            return None
+        finally:
+            cur.close()
+            release_db_connection(conn)
+    return None
+
+@_instrumented
+def get_all_user_data_json(user_id, indent=None):
+    """
+    Get all data for a user as a raw JSON string, ready to stream to a file
+    or download without going through json.loads/json.dumps. With indent
+    (as in json.dumps) the text is re-serialized, indented, instead
+    """
+    conn = get_db_connection(readonly=True, user_id=user_id)
+    if conn:
+        cur = conn.cursor()
+        try:
+            cur.execute(
+                "SELECT document::text FROM (" + _USER_DOCUMENT_SQL + "WHERE u.id = %s) AS d",
+                (user_id,), prepare=True
+            )
+            result = cur.fetchone()
+            return _rehydrate_user_json(result[0], indent) if result else None
+        except Exception as e:
+            print(f"Error getting all user data: {e}")
+            return None
+        finally:
+            cur.close()
+            release_db_connection(conn)
+    return None
+
+def iter_user_documents(after_user_id=0, fetch_size=500):
+    """
+    Stream every user's document (as in get_all_user_data_json) in user id
+    order, starting after after_user_id.
+    Yields (user_id, document_json). Rows come from a named server-side
+    cursor fetch_size at a time, so memory stays bounded however many users
+    there are, and the whole export reads one consistent snapshot.
+    """
+    conn = get_db_connection(readonly=True, user_id=None)
+    if not conn:
+        return
+    cur = conn.cursor(name=f"user_export_{uuid.uuid4().hex[:8]}")
+    cur.itersize = fetch_size
+    try:
+        cur.execute(
+            "SELECT user_id, document::text FROM (" + _USER_DOCUMENT_SQL + "WHERE u.id > %s) AS d "
+            "ORDER BY user_id",
+            (after_user_id,)
+        )
+        for user_id, document_json in cur:
+            yield user_id, _rehydrate_user_json(document_json)
+    finally:
+        cur.close()
+        release_db_connection(conn)
+
+# Staging table for bulk_import_users(); COPY fills it, then set-based
+# statements move each column into its table
+_IMPORT_STAGE_SQL = """
+    CREATE TEMP TABLE bulk_import_stage (
+        username VARCHAR(50) NOT NULL,
+        email VARCHAR(100) NOT NULL,
+        password_hash VARCHAR(255) NOT NULL,
+        gorilla_id VARCHAR(255),
+        profile_data JSONB,
+        conditions JSONB,
+        family_history JSONB,
+        user_id INTEGER
+    ) ON COMMIT DROP
+"""
+
+# Appends the imported entries a user does not have saved yet (by the
+# fingerprints of migration 9) to their existing document, so entries they
+# added themselves are kept. {table} is conditions or family_history, which
+# is also the staging column.
+_IMPORT_MERGE_SQL = """
+    UPDATE {table} t
+    SET api_response = CASE jsonb_typeof(t.api_response)
+            WHEN 'array' THEN t.api_response || n.entries
+            WHEN 'object' THEN jsonb_set(
+                t.api_response, '{{entry}}', COALESCE(t.api_response->'entry', '[]'::jsonb) || n.entries)
+            ELSE n.document
+        END,
+        gorilla_id = COALESCE(n.gorilla_id, t.gorilla_id),
+        version = t.version + 1,
+        updated_at = CURRENT_TIMESTAMP
+    FROM (
+        SELECT s.user_id, s.gorilla_id, s.{table} AS document, (
+            SELECT jsonb_agg(e.entry ORDER BY e.pos)
+            FROM jsonb_array_elements(fhir_document_entries(s.{table})) WITH ORDINALITY AS e(entry, pos)
+            WHERE NOT EXISTS (
+                SELECT 1 FROM entry_fingerprints f
+                WHERE f.user_id = s.user_id AND f.kind = '{table}'
+                  AND f.fingerprint = fhir_entry_fingerprint('{table}', e.entry))
+        ) AS entries
+        FROM bulk_import_stage s
+        WHERE s.user_id IS NOT NULL AND s.{table} IS NOT NULL
+    ) n
+    WHERE t.user_id = n.user_id AND n.entries IS NOT NULL
+"""
+
+@_instrumented
+def bulk_import_users(records):
+    """
+    Create users with their profile, conditions and family history in one
+    transaction. Each record is a dictionary with username, email,
+    password_hash, gorilla_id and optionally profile_data (a Patient
+    resource), conditions and family_history (lists of Bundle entries).
+    Rows are loaded with COPY into a staging table and moved into the
+    TheraCare tables with one statement per table. A username that is
+    already taken is only reused when that user's profile has the record's
+    gorilla_id (the same patient imported again); their profile is replaced
+    and the imported conditions and family history entries they do not have
+    yet are appended, keeping the entries they added themselves. Other taken
+    usernames are reported and skipped, never written to.
+    Returns a dictionary mapping the imported usernames to user ids, or None
+    on error
+    """
+    # A username repeated within the batch keeps its last record
+    records = list({record['username']: record for record in records}.values())
+    if not records:
+        return {}
+    conn = get_db_connection()
+    if conn:
+        cur = conn.cursor()
+        try:
+            cur.execute(_IMPORT_STAGE_SQL)
+            with cur.copy("""
+                COPY bulk_import_stage (
+                    username, email, password_hash, gorilla_id,
+                    profile_data, conditions, family_history
+                ) FROM STDIN
+            """) as copy:
+                for record in records:
+                    conditions = record.get('conditions')
+                    family_history = record.get('family_history')
+                    copy.write_row((
+                        record['username'],
+                        record['email'],
+                        record['password_hash'],
+                        record.get('gorilla_id'),
+                        Jsonb(record['profile_data']) if record.get('profile_data') else None,
+                        Jsonb(_minimizer.minimize(_with_entry_ids(conditions))) if conditions else None,
+                        Jsonb(_minimizer.minimize({
+                            'resourceType': 'Bundle',
+                            'type': 'searchset',
+                            'entry': _with_entry_ids(family_history)
+                        })) if family_history else None
+                    ))
+            # Users created by this batch, and existing users only when they
+            # are the same patient
             cur.execute("""
-                SELECT gorilla_id, profile_data, created_at, updated_at 
-                FROM profiles 
-                WHERE user_id = %s
-            """, (user_id,))
-            profile = cur.fetchone()
-            if profile:
-                user_data["profile"] = {
-                    "gorilla_id": profile[0],
-                    "profile_data": profile[1],
-                    "created_at": profile[2].isoformat() if profile[2] else None,
-                    "updated_at": profile[3].isoformat() if profile[3] else None
-                }
-            
-            # Get conditions data
+                WITH inserted AS (
+                    INSERT INTO users (username, email, password_hash)
+                    SELECT username, email, password_hash FROM bulk_import_stage
+                    ON CONFLICT DO NOTHING
+                    RETURNING id, username
+                )
+                UPDATE bulk_import_stage s SET user_id = i.id
+                FROM inserted i
+                WHERE i.username = s.username
+            """)
             cur.execute("""
-                SELECT gorilla_id, api_response, created_at, updated_at 
-                FROM conditions 
-                WHERE user_id = %s
-            """, (user_id,))
-            conditions = cur.fetchone()
-            if conditions:
-                user_data["conditions"] = {
-                    "gorilla_id": conditions[0],
-                    "api_response": conditions[1],
-                    "created_at": conditions[2].isoformat() if conditions[2] else None,
-                    "updated_at": conditions[3].isoformat() if conditions[3] else None
-                }
-            
-            # Get family history data
+                UPDATE bulk_import_stage s SET user_id = u.id
+                FROM users u JOIN profiles p ON p.user_id = u.id
+                WHERE s.user_id IS NULL AND u.username = s.username AND p.gorilla_id = s.gorilla_id
+            """)
             cur.execute("""
-                SELECT gorilla_id, api_response, created_at, updated_at 
-                FROM family_history 
-                WHERE user_id = %s
-            """, (user_id,))
-            family_history = cur.fetchone()
-            if family_history:
-                user_data["family_history"] = {
-                    "gorilla_id": family_history[0],
-                    "api_response": family_history[1],
-                    "created_at": family_history[2].isoformat() if family_history[2] else None,
-                    "updated_at": family_history[3].isoformat() if family_history[3] else None
-                }
-            
-            return user_data
+                INSERT INTO profiles (user_id, gorilla_id, profile_data)
+                SELECT s.user_id, s.gorilla_id, s.profile_data
+                FROM bulk_import_stage s
+                WHERE s.user_id IS NOT NULL AND s.profile_data IS NOT NULL AND s.gorilla_id IS NOT NULL
+                ON CONFLICT (user_id) DO UPDATE
+                SET gorilla_id = EXCLUDED.gorilla_id,
+                    profile_data = EXCLUDED.profile_data,
+                    updated_at = CURRENT_TIMESTAMP
+            """)
+            for table in ('conditions', 'family_history'):
+                cur.execute(_IMPORT_MERGE_SQL.format(table=table))
+                cur.execute(f"""
+                    INSERT INTO {table} (user_id, gorilla_id, api_response)
+                    SELECT s.user_id, s.gorilla_id, s.{table}
+                    FROM bulk_import_stage s
+                    WHERE s.user_id IS NOT NULL AND s.{table} IS NOT NULL
+                    ON CONFLICT (user_id) DO NOTHING
+                """)
+            cur.execute("SELECT username, user_id FROM bulk_import_stage")
+            user_ids = {}
+            conflicts = []
+            for username, user_id in cur.fetchall():
+                if user_id is None:
+                    conflicts.append(username)
+                else:
+                    user_ids[username] = user_id
+            # Dropped explicitly so a session() can import several batches
+            cur.execute("DROP TABLE bulk_import_stage")
+            conn.commit()
+            if conflicts:
+                print(f"Skipped importing {len(conflicts)} users whose username or email belongs to "
+                      f"another account: {', '.join(sorted(conflicts))}")
+            for user_id in user_ids.values():
+                _invalidate('profile', user_id)
+                _invalidate('conditions', user_id)
+                _invalidate('family_history', user_id)
+            return user_ids
         except Exception as e:
-            print(f"Error getting all user data: {e}")
+            conn.rollback()
+            print(f"Error importing users: {e}")
             return None
         finally:
             cur.close()
-            conn.close()
-    return None 
\ No newline at end of file
+            release_db_connection(conn)
+    return None
@@ -0,0 +1,849 @@
+"""
+asyncio twin of database.py on psycopg 3 AsyncConnections.
+
+The functions have the same names, arguments and return values as their
+database.py counterparts but are coroutines, so independent reads can run
+at the same time on separate pooled connections:
+
+    sections = await database_async.get_user_sections(user_id)
+
+The SQL, the read cache and the helpers are shared with database.py, so a
+write through either module invalidates the cached reads of both.
+
+Synchronous callers such as Streamlit pages can use run(), which executes a
+coroutine on one long-lived background event loop so the pool and its
+connections survive between reruns:
+
+    sections = database_async.run(database_async.get_user_sections(user_id))
+"""
+import asyncio
+import copy
+import os
+import threading
+
+import psycopg
+from psycopg.types.json import Jsonb
+
+import database
+from database import (
+    CONDITION_CARD_FIELDS,
+    VersionConflict,
+    _cache,
+    _connect_kwargs,
+    _note_write,
+    _minimizer,
+    _rehydrate_user_document,
+    _rehydrate_user_json,
+    _split_duplicates,
+    _split_appended,
+    _with_entry_ids,
+    _encode_cursor,
+    _decode_cursor,
+    _resource_row,
+    _resource_dict,
+    _CONDITION_SUMMARY_FIELDS,
+    _CONDITION_ENTRIES_SQL,
+    _USER_SUMMARY_SQL,
+    _user_summary,
+    _FAMILY_HISTORY_ENTRIES_SQL,
+    _PAGE_ENTRIES_SQL,
+    _SAVE_PROFILE_SQL,
+    _SAVE_CONDITIONS_SQL,
+    _SAVE_FAMILY_HISTORY_SQL,
+    _APPEND_CONDITIONS_SQL,
+    _APPEND_FAMILY_HISTORY_SQL,
+    _APPEND_NEW_CONDITIONS_SQL,
+    _APPEND_NEW_FAMILY_HISTORY_SQL,
+    _FINGERPRINT_LOOKUP_SQL,
+    _NEAR_DUPLICATES_SQL,
+    _CANDIDATE_NAMES_SQL,
+    _SAVED_NAMES_SQL,
+    _HAS_PG_TRGM_SQL,
+    _match_near_duplicates,
+    _ENTRY_PATH_CTE,
+    _UPSERT_RESOURCE_SQL,
+    _RESOURCE_COLUMNS,
+    _USER_DOCUMENT_SQL,
+)
+from db_cache import MISSING
+from db_pool import AsyncConnectionPool
+
+# One pool per event loop: asyncio connections cannot move between loops
+_pools = {}
+_pools_lock = threading.Lock()
+
+_loop = None
+_loop_lock = threading.Lock()
+
+async def _connect():
+    # The primary, configured as for database.py
+    return await psycopg.AsyncConnection.connect(**_connect_kwargs())
+
+def _invalidate(kind, user_id):
+    """
+    Drop a user's cached entry after a write and send database.py's reads of
+    the user to the primary for a while, as database._invalidate does
+    """
+    _cache.invalidate((kind, user_id))
+    _note_write(user_id)
+
+def get_pool():
+    """
+    Get the connection pool of the running event loop, creating it on first
+    use. Sized from the same DB_POOL_* environment variables as database.py.
+    """
+    loop = asyncio.get_running_loop()
+    with _pools_lock:
+        pool = _pools.get(loop)
+        if pool is None:
+            # Drop the pools of loops that have since been closed
+            for old in [old for old in _pools if old.is_closed()]:
+                del _pools[old]
+            pool = _pools[loop] = AsyncConnectionPool(
+                _connect,
+                min_size=int(os.getenv('DB_POOL_MIN_SIZE', '1')),
+                max_size=int(os.getenv('DB_POOL_MAX_SIZE', '10')),
+                max_lifetime=float(os.getenv('DB_POOL_MAX_LIFETIME', '1800')),
+                timeout=float(os.getenv('DB_POOL_TIMEOUT', '30')),
+                pre_ping=os.getenv('DB_POOL_PRE_PING', 'true').lower() in ('1', 'true', 'yes'),
+                ping_idle=float(os.getenv('DB_POOL_PING_IDLE', '30'))
+            )
+            # The cache is shared with database.py, and so is its listener
+            database.start_cache_listener()
+    return pool
+
+def get_pool_stats():
+    """
+    Get connection pool statistics for the running event loop or, called
+    from synchronous code, for the background loop run() uses. None if that
+    loop has no pool yet
+    """
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        loop = _loop
+    pool = _pools.get(loop)
+    return pool.stats() if pool else None
+
+def run(coro, timeout=None):
+    """
+    Run a coroutine from synchronous code on the module's background event
+    loop and return its result
+    """
+    global _loop
+    if _loop is None:
+        with _loop_lock:
+            if _loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="database-async", daemon=True).start()
+                _loop = loop
+    return asyncio.run_coroutine_threadsafe(coro, _loop).result(timeout)
+
+async def get_db_connection():
+    """
+    Borrow a connection from the pool. Return it with release_db_connection().
+    """
+    try:
+        return await get_pool().getconn()
+    except Exception as e:
+        print(f"Error connecting to database: {e}")
+        return None
+
+async def release_db_connection(conn):
+    """
+    Return a connection borrowed with get_db_connection() to the pool
+    """
+    if conn is not None:
+        await get_pool().putconn(conn)
+
+async def init_db():
+    """
+    Bring the database schema up to date (see database.init_db)
+    """
+    return await asyncio.to_thread(database.init_db)
+
+async def _cached(kind, user_id, load):
+    """
+    Return await load(user_id) through the read cache shared with database.py
+    """
+    key = (kind, user_id)
+    value = _cache.get(key)
+    if value is not MISSING:
+        return value
+    generation = _cache.generation(key)
+    value = await load(user_id)
+    if value is not None:
+        _cache.set(key, value, generation)
+        value = copy.deepcopy(value)
+    return value
+
+async def create_user(username, email, password_hash):
+    conn = await get_db_connection()
+    if conn:
+        cur = conn.cursor()
+        try:
+            await cur.execute(
+                "INSERT INTO users (username, email, password_hash) VALUES (%s, %s, %s) RETURNING id",
+                (username, email, password_hash)
+            )
+            user_id = (await cur.fetchone())[0]
+            await conn.commit()
+            _note_write(user_id)
+            return user_id
+        except Exception as e:
+            await conn.rollback()
+            print(f"Error creating user: {e}")
+            return None
+        finally:
+            await cur.close()
+            await release_db_connection(conn)
+
+async def get_user_by_username(username):
+    conn = await get_db_connection()
+    if conn:
+        cur = conn.cursor()
+        try:
+            await cur.execute("SELECT id, username, email, password_hash FROM users WHERE username = %s",
+                              (username,), prepare=True)
+            return await cur.fetchone()
+        finally:
+            await cur.close()
+            await release_db_connection(conn)
+    return None
+
+async def _upsert(sql, params, kind, user_id, error):
+    """
+    Run one of the shared upsert statements and its commit in one flight.
+    Returns the row id, or raises VersionConflict if an expected version in
+    params did not match
+    """
+    conn = await get_db_connection()
+    if conn:
+        cur = conn.cursor()
+        try:
+            async with conn.pipeline():
+                await cur.execute(sql, params, prepare=True)
+                await conn.commit()
+            _invalidate(kind, user_id)
+            result = await cur.fetchone()
+        except Exception as e:
+            await conn.rollback()
+            print(f"Error {error}: {e}")
+            return None
+        finally:
+            await cur.close()
+            await release_db_connection(conn)
+        if result is None:
+            raise VersionConflict(kind, user_id, params.get('expected'))
+        return result[0]
+    return None
+
+async def save_profile(user_id, gorilla_id, profile_data):
+    """
+    Save or update a user's profile
+    """
+    conn = await get_db_connection()
+    if conn:
+        cur = conn.cursor()
+        try:
+            async with conn.pipeline():
+                await cur.execute(_SAVE_PROFILE_SQL, (user_id, gorilla_id, Jsonb(profile_data)), prepare=True)
+                await conn.commit()
+            _invalidate('profile', user_id)
+            return (await cur.fetchone())[0]
+        except Exception as e:
+            await conn.rollback()
+            print(f"Error saving profile: {e}")
+            return None
+        finally:
+            await cur.close()
+            await release_db_connection(conn)
+    return None
+
+async def get_profile_by_user_id(user_id):
+    """
+    Get a user's profile by their user ID
+    """
+    return await _cached('profile', user_id, _load_profile)
+
+async def _load_profile(user_id):
+    conn = await get_db_connection()
+    if conn:
+        cur = conn.cursor()
+        try:
+            await cur.execute("""
+                SELECT id, gorilla_id, profile_data, created_at, updated_at
+                FROM profiles
+                WHERE user_id = %s
+            """, (user_id,), prepare=True)
+            profile = await cur.fetchone()
+            if profile:
+                return {
+                    'id': profile[0],
+                    'gorilla_id': profile[1],
+                    'profile_data': profile[2],
+                    'created_at': profile[3],
+                    'updated_at': profile[4]
+                }
+            return None
+        finally:
+            await cur.close()
+            await release_db_connection(conn)
+    return None
+
+async def _load_document(table, user_id):
+    conn = await get_db_connection()
+    if conn:
+        cur = conn.cursor()
+        try:
+            # table is always conditions or family_history
+            await cur.execute(f"""
+                SELECT id, gorilla_id, api_response, created_at, updated_at, version
+                FROM {table}
+                WHERE user_id = %s
+            """, (user_id,), prepare=True)
+            result = await cur.fetchone()
+            if result:
+                return {
+                    'id': result[0],
+                    'gorilla_id': result[1],
+                    'api_response': _minimizer.rehydrate(result[2]),
+                    'created_at': result[3],
+                    'updated_at': result[4],
+                    'version': result[5]
+                }
+            return None
+        finally:
+            await cur.close()
+            await release_db_connection(conn)
+    return None
+
+async def _load_conditions(user_id):
+    return await _load_document('conditions', user_id)
+
+async def _load_family_history(user_id):
+    return await _load_document('family_history', user_id)
+
+async def save_conditions(user_id, gorilla_id, api_response, expected_version=None):
+    """
+    Save conditions API response for a user (see database.save_conditions)
+    """
+    return await _upsert(_SAVE_CONDITIONS_SQL, {
+        'user_id': user_id, 'gorilla_id': gorilla_id, 'document': Jsonb(_minimizer.minimize(api_response)),
+        'expected': expected_version
+    }, 'conditions', user_id, "saving conditions")
+
+async def get_conditions_by_user_id(user_id):
+    """
+    Get conditions API response for a user
+    """
+    return await _cached('conditions', user_id, _load_conditions)
+
+async def save_family_history(user_id, gorilla_id, api_response, expected_version=None):
+    """
+    Save family history API response for a user (see database.save_family_history)
+    """
+    return await _upsert(_SAVE_FAMILY_HISTORY_SQL, {
+        'user_id': user_id, 'gorilla_id': gorilla_id, 'document': Jsonb(_minimizer.minimize(api_response)),
+        'expected': expected_version
+    }, 'family_history', user_id, "saving family history")
+
+async def get_family_history_by_user_id(user_id):
+    """
+    Get family history API response for a user
+    """
+    return await _cached('family_history', user_id, _load_family_history)
+
+async def get_user_sections(user_id):
+    """
+    Get a user's profile, conditions and family history concurrently, each
+    on its own connection.
+    Returns {'profile': ..., 'conditions': ..., 'family_history': ...}
+    """
+    profile, conditions, family_history = await asyncio.gather(
+        get_profile_by_user_id(user_id),
+        get_conditions_by_user_id(user_id),
+        get_family_history_by_user_id(user_id)
+    )
+    return {'profile': profile, 'conditions': conditions, 'family_history': family_history}
+
+async def _split_saved_duplicates(kind, user_id, candidates):
+    rows = await _fetch_all(_FINGERPRINT_LOOKUP_SQL, {
+        'user_id': user_id, 'kind': kind, 'entries': Jsonb(list(candidates))
+    }, f"checking {kind} for duplicates", None)
+    return None if rows is None else _split_duplicates(candidates, rows)
+
+async def split_duplicate_conditions(user_id, new_conditions):
+    """
+    Check a batch of conditions against the user's saved conditions by
+    their fingerprints. Returns (duplicates, new_conditions), or None on error
+    """
+    return await _split_saved_duplicates('conditions', user_id, new_conditions)
+
+async def check_duplicate_condition(user_id, new_condition):
+    """
+    Check if a condition already exists in the database for a user
+    """
+    result = await split_duplicate_conditions(user_id, [new_condition])
+    return bool(result and result[0])
+
+async def split_duplicate_family_history(user_id, new_entries):
+    """
+    Check a batch of family history entries against the user's saved
+    family history by their fingerprints. Returns (duplicates, new_entries),
+    or None on error
+    """
+    return await _split_saved_duplicates('family_history', user_id, new_entries)
+
+async def check_duplicate_family_history(user_id, new_history):
+    """
+    Check if a family history entry already exists in the database for a user
+    """
+    result = await split_duplicate_family_history(user_id, [new_history])
+    return bool(result and result[0])
+
+async def _find_near_duplicates(kind, user_id, candidates, threshold, limit):
+    """
+    Async counterpart of database._find_near_duplicates
+    """
+    if threshold is None:
+        threshold = database.NEAR_DUPLICATE_THRESHOLD
+    conn = await get_db_connection()
+    if conn:
+        cur = conn.cursor()
+        try:
+            params = {'user_id': user_id, 'kind': kind, 'entries': Jsonb(list(candidates)), 'limit': limit}
+            if database._pg_trgm_unknown():
+                await cur.execute(_HAS_PG_TRGM_SQL)
+                database._set_pg_trgm((await cur.fetchone())[0])
+            rows = None
+            if database._pg_trgm_installed:
+                try:
+                    async with conn.pipeline():
+                        await conn.execute("SELECT set_config('pg_trgm.similarity_threshold', %s, true)",
+                                           (str(threshold),), prepare=True)
+                        await cur.execute(_NEAR_DUPLICATES_SQL, params, prepare=True)
+                    rows = await cur.fetchall()
+                except psycopg.errors.UndefinedFunction:
+                    await conn.rollback()
+                    database._set_pg_trgm(False)
+            if rows is None:
+                await cur.execute(_CANDIDATE_NAMES_SQL, params, prepare=True)
+                names = await cur.fetchall()
+                await cur.execute(_SAVED_NAMES_SQL, params, prepare=True)
+                rows = _match_near_duplicates(names, await cur.fetchall(), threshold, limit)
+            await conn.commit()
+            return [{'name': name, 'existing': existing, 'similarity': score}
+                    for name, existing, score in rows]
+        except Exception as e:
+            await conn.rollback()
+            print(f"Error finding similar {kind}: {e}")
+            return None
+        finally:
+            await cur.close()
+            await release_db_connection(conn)
+    return None
+
+async def find_similar_conditions(user_id, new_conditions, threshold=None, limit=5):
+    """
+    Find saved conditions whose names look like those of new_conditions
+    (see database.find_similar_conditions)
+    """
+    return await _find_near_duplicates('conditions', user_id, new_conditions, threshold, limit)
+
+async def find_similar_family_history(user_id, new_entries, threshold=None, limit=5):
+    """
+    Find conditions already saved for the same relatives whose names look
+    like those of new_entries (see database.find_similar_family_history)
+    """
+    return await _find_near_duplicates('family_history', user_id, new_entries, threshold, limit)
+
+def _summary_columns(fields):
+    unknown = [field for field in fields if field not in _CONDITION_SUMMARY_FIELDS]
+    if unknown:
+        raise ValueError(f"Unknown condition summary fields: {unknown}")
+    return ', '.join(f"{_CONDITION_SUMMARY_FIELDS[field]} AS {field}" for field in fields)
+
+async def _fetch_all(sql, params, error, default):
+    """
+    Run a read query and return all its rows, or default on error
+    """
+    conn = await get_db_connection()
+    if conn:
+        cur = conn.cursor()
+        try:
+            await cur.execute(sql, params, prepare=True)
+            return await cur.fetchall()
+        except Exception as e:
+            await conn.rollback()
+            print(f"Error {error}: {e}")
+            return default
+        finally:
+            await cur.close()
+            await release_db_connection(conn)
+    return default
+
+async def get_condition_summaries(user_id, status=None, year=None, fields=CONDITION_CARD_FIELDS):
+    """
+    Get compact summaries of a user's saved conditions (see
+    database.get_condition_summaries)
+    """
+    columns = _summary_columns(fields)
+    if isinstance(status, str):
+        status = [status]
+    rows = await _fetch_all(f"""
+        SELECT {columns}
+        {_CONDITION_ENTRIES_SQL}
+          AND (%(status)s::text[] IS NULL OR fhir_condition_status(r.resource) = ANY(%(status)s))
+          AND (%(year)s::text IS NULL OR left(fhir_date(r.resource->>'assertedDate'), 4) = %(year)s)
+        ORDER BY e.pos
+    """, {
+        'user_id': user_id,
+        'status': list(status) if status else None,
+        'year': str(year) if year else None,
+    }, "getting condition summaries", [])
+    return [dict(zip(fields, row)) for row in rows]
+
+async def get_condition_years(user_id):
+    """
+    Get the distinct years in which a user's saved conditions were recorded,
+    newest first
+    """
+    rows = await _fetch_all(f"""
+        SELECT DISTINCT left(fhir_date(r.resource->>'assertedDate'), 4) AS year
+        {_CONDITION_ENTRIES_SQL}
+          AND fhir_date(r.resource->>'assertedDate') <> ''
+        ORDER BY year DESC
+    """, {'user_id': user_id}, "getting condition years", [])
+    return [row[0] for row in rows]
+
+async def _fetch_page(sql, params, cursor, limit, error):
+    """
+    Async counterpart of database._fetch_page.
+    Returns (rows without the sort columns, next cursor or None)
+    """
+    after_date, after_seq = _decode_cursor(cursor) if cursor else (None, None)
+    rows = await _fetch_all(sql, dict(params, after_date=after_date, after_seq=after_seq, limit=limit + 1),
+                            error, [])
+    next_cursor = _encode_cursor(*rows[limit - 1][-2:]) if len(rows) > limit else None
+    return [row[:-2] for row in rows[:limit]], next_cursor
+
+async def get_conditions_page(user_id, status=None, year=None, cursor=None, limit=25,
+                              fields=CONDITION_CARD_FIELDS):
+    """
+    Get one page of a user's condition summaries, newest first (see
+    database.get_conditions_page). Returns (summaries, next_cursor)
+    """
+    columns = _summary_columns(fields)
+    if isinstance(status, str):
+        status = [status]
+    rows, next_cursor = await _fetch_page(f"""
+        SELECT {columns}, e.sort_date, e.seq
+        {_PAGE_ENTRIES_SQL.format(kind='conditions')}
+          AND (%(status)s::text[] IS NULL OR fhir_condition_status(r.resource) = ANY(%(status)s))
+          AND (%(year)s::text IS NULL OR left(fhir_date(r.resource->>'assertedDate'), 4) = %(year)s)
+          AND (%(after_date)s::text IS NULL
+               OR (e.sort_date, e.seq) < (%(after_date)s::text, %(after_seq)s::bigint))
+        ORDER BY e.sort_date DESC, e.seq DESC
+        LIMIT %(limit)s
+    """, {
+        'user_id': user_id,
+        'status': list(status) if status else None,
+        'year': str(year) if year else None,
+    }, cursor, limit, "getting conditions page")
+    return [dict(zip(fields, row)) for row in rows], next_cursor
+
+async def get_condition_status_counts(user_id, year=None):
+    """
+    Count a user's saved conditions per clinical status. Returns {status: count}
+    """
+    rows = await _fetch_all(f"""
+        SELECT fhir_condition_status(r.resource) AS status, count(*)
+        {_CONDITION_ENTRIES_SQL}
+          AND (%(year)s::text IS NULL OR left(fhir_date(r.resource->>'assertedDate'), 4) = %(year)s)
+        GROUP BY status
+    """, {'user_id': user_id, 'year': str(year) if year else None}, "counting conditions", [])
+    return dict(rows)
+
+async def get_family_history_page(user_id, cursor=None, limit=20):
+    """
+    Get one page of a user's saved family history entries, newest first.
+    Returns (entries, next_cursor)
+    """
+    rows, next_cursor = await _fetch_page(f"""
+        SELECT e.entry, e.sort_date, e.seq
+        {_PAGE_ENTRIES_SQL.format(kind='family_history')}
+          AND (%(after_date)s::text IS NULL
+               OR (e.sort_date, e.seq) < (%(after_date)s::text, %(after_seq)s::bigint))
+        ORDER BY e.sort_date DESC, e.seq DESC
+        LIMIT %(limit)s
+    """, {'user_id': user_id}, cursor, limit, "getting family history page")
+    return [_minimizer.rehydrate(row[0]) for row in rows], next_cursor
+
+async def count_family_history(user_id):
+    """
+    Count a user's saved family history entries
+    """
+    rows = await _fetch_all(f"SELECT count(*) {_FAMILY_HISTORY_ENTRIES_SQL}",
+                            {'user_id': user_id}, "counting family history", [(0,)])
+    return rows[0][0]
+
+async def get_user_summary(user_id):
+    """
+    Get a user's trigger-maintained condition and family history summary
+    (see database.get_user_summary)
+    """
+    rows = await _fetch_all(_USER_SUMMARY_SQL, {'user_id': user_id}, "getting user summary", None)
+    if rows is None:
+        return None
+    return _user_summary(rows[0] if rows else None)
+
+async def append_conditions(user_id, gorilla_id, new_conditions, expected_version=None):
+    """
+    Append condition entries to a user's saved conditions in a single write
+    (see database.append_conditions). Returns the conditions row id
+    """
+    return await _upsert(_APPEND_CONDITIONS_SQL, {
+        'user_id': user_id, 'gorilla_id': gorilla_id, 'entries': Jsonb(_minimizer.minimize(_with_entry_ids(new_conditions))),
+        'expected': expected_version
+    }, 'conditions', user_id, "appending conditions")
+
+async def append_family_history_entries(user_id, gorilla_id, new_entries, expected_version=None):
+    """
+    Append entries to a user's family history Bundle in a single write
+    (see database.append_family_history_entries). Returns the row id
+    """
+    new_history = {
+        'resourceType': 'Bundle',
+        'type': 'searchset',
+        'entry': _with_entry_ids(new_entries)
+    }
+    return await _upsert(_APPEND_FAMILY_HISTORY_SQL, {
+        'user_id': user_id, 'gorilla_id': gorilla_id, 'history': Jsonb(_minimizer.minimize(new_history)),
+        'expected': expected_version
+    }, 'family_history', user_id, "appending family history")
+
+async def _append_new(sql, kind, user_id, gorilla_id, candidates):
+    """
+    Async counterpart of database._append_new
+    """
+    candidates = _with_entry_ids(candidates)
+    conn = await get_db_connection()
+    if conn:
+        cur = conn.cursor()
+        try:
+            async with conn.pipeline():
+                await cur.execute(sql, {
+                    'user_id': user_id, 'gorilla_id': gorilla_id, 'entries': Jsonb(_minimizer.minimize(candidates))
+                }, prepare=True)
+                await conn.commit()
+            positions = (await cur.fetchone())[0]
+            if positions:
+                _invalidate(kind, user_id)
+            return _split_appended(candidates, positions)
+        except Exception as e:
+            await conn.rollback()
+            print(f"Error appending {kind}: {e}")
+            return None
+        finally:
+            await cur.close()
+            await release_db_connection(conn)
+    return None
+
+async def append_new_conditions(user_id, gorilla_id, new_conditions):
+    """
+    Append the conditions that are not saved yet (see
+    database.append_new_conditions). Returns (duplicates, new_conditions)
+    """
+    return await _append_new(_APPEND_NEW_CONDITIONS_SQL, 'conditions', user_id, gorilla_id, new_conditions)
+
+async def append_new_family_history_entries(user_id, gorilla_id, new_entries):
+    """
+    Append the family history entries that are not saved yet (see
+    database.append_new_family_history_entries). Returns (duplicates, new_entries)
+    """
+    return await _append_new(_APPEND_NEW_FAMILY_HISTORY_SQL, 'family_history', user_id, gorilla_id,
+                             new_entries)
+
+async def _update_entry(table, user_id, entry_id, new_entry=None):
+    """
+    Replace (or, without new_entry, delete) one entry of a user's stored
+    document in place. Returns True if an entry was changed.
+    """
+    if new_entry is None:
+        new_value = "t.api_response #- target.path"
+        params = (user_id, entry_id)
+    else:
+        new_value = "jsonb_set(t.api_response, target.path, %s)"
+        params = (user_id, entry_id, Jsonb(_minimizer.minimize(new_entry)))
+    conn = await get_db_connection()
+    if conn:
+        cur = conn.cursor()
+        try:
+            async with conn.pipeline():
+                await cur.execute(_ENTRY_PATH_CTE.format(table=table) + f"""
+                    UPDATE {table} t
+                    SET api_response = {new_value},
+                        version = t.version + 1,
+                        updated_at = CURRENT_TIMESTAMP
+                    FROM target
+                    WHERE t.id = target.id
+                """, params, prepare=True)
+                await conn.commit()
+            _invalidate(table, user_id)
+            return cur.rowcount > 0
+        except Exception as e:
+            await conn.rollback()
+            print(f"Error updating {table} entry: {e}")
+            return False
+        finally:
+            await cur.close()
+            await release_db_connection(conn)
+    return False
+
+async def replace_condition_entry(user_id, entry_id, new_condition):
+    """
+    Replace the saved condition whose resource id is entry_id
+    """
+    return await _update_entry('conditions', user_id, entry_id, new_condition)
+
+async def delete_condition_entry(user_id, entry_id):
+    """
+    Delete the saved condition whose resource id is entry_id
+    """
+    return await _update_entry('conditions', user_id, entry_id)
+
+async def replace_family_history_entry(user_id, entry_id, new_entry):
+    """
+    Replace the family history entry whose resource id is entry_id
+    """
+    return await _update_entry('family_history', user_id, entry_id, new_entry)
+
+async def delete_family_history_entry(user_id, entry_id):
+    """
+    Delete the family history entry whose resource id is entry_id
+    """
+    return await _update_entry('family_history', user_id, entry_id)
+
+async def save_resource(user_id, resource):
+    """
+    Save or update a single FHIR resource in the resource store
+    Returns the resource_id
+    """
+    result = await save_resources(user_id, [resource])
+    return result[0] if result else None
+
+async def save_resources(user_id, resources):
+    """
+    Save or update many FHIR resources (or Bundle entries) in one transaction
+    Returns the list of saved resource_ids
+    """
+    try:
+        rows = [_resource_row(user_id, resource) for resource in resources]
+    except ValueError as e:
+        print(f"Error saving resources: {e}")
+        return None
+    if not rows:
+        return []
+    conn = await get_db_connection()
+    if conn:
+        cur = conn.cursor()
+        try:
+            await cur.executemany(_UPSERT_RESOURCE_SQL, rows)
+            await conn.commit()
+            return [row[2] for row in rows]
+        except Exception as e:
+            await conn.rollback()
+            print(f"Error saving resources: {e}")
+            return None
+        finally:
+            await cur.close()
+            await release_db_connection(conn)
+    return None
+
+async def get_resource(user_id, resource_type, resource_id):
+    """
+    Get a single FHIR resource from the resource store
+    """
+    rows = await _fetch_all("SELECT" + _RESOURCE_COLUMNS + """
+        FROM fhir_resources
+        WHERE user_id = %s AND resource_type = %s AND resource_id = %s
+    """, (user_id, resource_type, resource_id), "getting resource", [])
+    return _resource_dict(rows[0]) if rows else None
+
+async def get_resources(user_id, resource_type=None, clinical_status=None):
+    """
+    Get a user's FHIR resources from the resource store, optionally filtered
+    by type and status, most recently asserted first
+    """
+    rows = await _fetch_all("SELECT" + _RESOURCE_COLUMNS + """
+        FROM fhir_resources
+        WHERE user_id = %s
+          AND (%s::text IS NULL OR resource_type = %s)
+          AND (%s::text IS NULL OR clinical_status = %s)
+        ORDER BY asserted_date DESC NULLS LAST, resource_id
+    """, (user_id, resource_type, resource_type, clinical_status, clinical_status), "getting resources", [])
+    return [_resource_dict(row) for row in rows]
+
+async def _delete(sql, params, error):
+    conn = await get_db_connection()
+    if conn:
+        cur = conn.cursor()
+        try:
+            await cur.execute(sql, params)
+            await conn.commit()
+            return cur.rowcount
+        except Exception as e:
+            await conn.rollback()
+            print(f"Error {error}: {e}")
+            return 0
+        finally:
+            await cur.close()
+            await release_db_connection(conn)
+    return 0
+
+async def delete_resource(user_id, resource_type, resource_id):
+    """
+    Delete a single FHIR resource from the resource store
+    Returns True if a resource was deleted
+    """
+    return await _delete("""
+        DELETE FROM fhir_resources
+        WHERE user_id = %s AND resource_type = %s AND resource_id = %s
+    """, (user_id, resource_type, resource_id), "deleting resource") > 0
+
+async def delete_resources(user_id, resource_type=None):
+    """
+    Delete all of a user's FHIR resources, or only those of one type
+    Returns the number of resources deleted
+    """
+    return await _delete("""
+        DELETE FROM fhir_resources
+        WHERE user_id = %s AND (%s::text IS NULL OR resource_type = %s)
+    """, (user_id, resource_type, resource_type), "deleting resources")
+
+async def get_all_user_data(user_id):
+    """
+    Get all data for a user from all tables in one query
+    """
+    rows = await _fetch_all(_USER_DOCUMENT_SQL + "WHERE u.id = %s", (user_id,), "getting all user data", None)
+    if rows is None:
+        return None
+    if rows:
+        return _rehydrate_user_document(rows[0][1])
+    return {
+        "user_info": None,
+        "profile": None,
+        "conditions": None,
+        "family_history": None
+    }
+
+async def get_all_user_data_json(user_id, indent=None):
+    """
+    Get all data for a user as a raw JSON string (indented with indent)
+    """
+    rows = await _fetch_all(
+        "SELECT document::text FROM (" + _USER_DOCUMENT_SQL + "WHERE u.id = %s) AS d",
+        (user_id,), "getting all user data", []
+    )
+    return _rehydrate_user_json(rows[0][0], indent) if rows else None
@@ -0,0 +1,131 @@
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+MISSING = object()
+
+
+class TTLCache:
+    """
+    Thread-safe, size-bounded LRU cache whose entries expire after ttl seconds.
+
+    Keys are (kind, user_id) tuples. Values are deep-copied on the way out so
+    callers can modify what they get without corrupting the cached copy.
+
+    Every key has a generation number that invalidate() bumps. A reader takes
+    the generation before going to the database and passes it to set(); if a
+    write invalidated the key in the meantime the stale value is dropped.
+    Generations are stamped from one counter and only the most recently
+    invalidated keys keep their own; every other key shares the floor, which
+    is raised past every generation forgotten, so a generation never comes
+    back and the table stays bounded.
+    """
+
+    def __init__(self, max_entries=1024, ttl=30, enabled=True):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.enabled = enabled and max_entries > 0 and ttl > 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+        self._generations = OrderedDict()  # key -> generation, oldest first
+        self._max_generations = max(4 * max_entries, 1024)
+        self._counter = 0
+        self._floor = 0
+        self._epoch = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expirations = 0
+        self._invalidations = 0
+
+    def get(self, key):
+        """
+        Look up a key. Returns the cached value, or MISSING
+        """
+        if not self.enabled:
+            return MISSING
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                self._misses += 1
+                return MISSING
+            expires_at, value = item
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                self._expirations += 1
+                self._misses += 1
+                return MISSING
+            self._entries.move_to_end(key)
+            self._hits += 1
+        return copy.deepcopy(value)
+
+    def generation(self, key):
+        with self._lock:
+            return self._epoch, self._generations.get(key, self._floor)
+
+    def set(self, key, value, generation=None):
+        """
+        Store a value, unless the key was invalidated since generation was taken
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            if generation is not None and (self._epoch, self._generations.get(key, self._floor)) != generation:
+                return
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._counter += 1
+            self._generations[key] = self._counter
+            self._generations.move_to_end(key)
+            if len(self._generations) > self._max_generations:
+                # Readers of the forgotten key now see the floor, which is
+                # past any generation they can hold
+                self._generations.popitem(last=False)
+                self._floor = self._counter
+            self._entries.pop(key, None)
+            self._invalidations += 1
+
+    def invalidate_user(self, user_id, kinds=()):
+        """
+        Drop every cached entry belonging to a user, including the given
+        kinds even if they are not cached right now
+        """
+        with self._lock:
+            keys = {key for key in self._entries if key[1] == user_id}
+        keys.update((kind, user_id) for kind in kinds)
+        for key in keys:
+            self.invalidate(key)
+
+    def clear(self):
+        with self._lock:
+            self._epoch += 1
+            self._entries.clear()
+            # The new epoch already outdates every generation handed out
+            self._generations.clear()
+
+    def stats(self):
+        """
+        Return a snapshot of cache statistics
+        """
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                'enabled': self.enabled,
+                'size': len(self._entries),
+                'generations': len(self._generations),
+                'max_entries': self.max_entries,
+                'ttl': self.ttl,
+                'hits': self._hits,
+                'misses': self._misses,
+                'hit_rate': self._hits / lookups if lookups else 0.0,
+                'evictions': self._evictions,
+                'expirations': self._expirations,
+                'invalidations': self._invalidations,
+            }
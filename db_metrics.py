@@ -0,0 +1,438 @@
+import functools
+import random
+import threading
+import time
+
+import psycopg
+import psycopg.sql
+from contextlib import contextmanager
+
+# Upper bounds (milliseconds) of the latency histogram buckets; the last
+# bucket catches everything slower
+LATENCY_BUCKETS_MS = (0.5, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+_EXPLAINABLE = ('select', 'with')
+
+
+class Histogram:
+    """
+    Fixed-bucket histogram. Recording is one bisect and two additions, so it
+    is cheap enough to do on every call.
+    """
+
+    def __init__(self, bounds=LATENCY_BUCKETS_MS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, value):
+        lo, hi = 0, len(self.bounds)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if value <= self.bounds[mid]:
+                hi = mid
+            else:
+                lo = mid + 1
+        self.counts[lo] += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, q):
+        """
+        Estimate the q-th percentile (0-100) as the upper bound of the bucket
+        it falls in; the slowest bucket reports the maximum seen
+        """
+        n = sum(self.counts)
+        if not n:
+            return 0.0
+        rank = q / 100 * n
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return min(self.bounds[i], self.max) if i < len(self.bounds) else self.max
+        return self.max
+
+    def snapshot(self):
+        n = sum(self.counts)
+        return {
+            'count': n,
+            'mean': self.total / n if n else 0.0,
+            'p50': self.percentile(50),
+            'p95': self.percentile(95),
+            'p99': self.percentile(99),
+            'max': self.max,
+            'buckets': dict(zip([*self.bounds, float('inf')], self.counts)),
+        }
+
+
+class _FunctionStats:
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.wall_ms = Histogram()
+        self.wait_ms = Histogram()
+        self.statements = 0
+        self.round_trips = 0
+        self.rows = 0
+        self.bytes = 0
+
+
+class _Call:
+    """
+    Counters for one in-flight instrumented call, filled in by the cursor
+    and by the connection checkout
+    """
+    __slots__ = ('wait', 'failed', 'statements', 'round_trips', 'rows', 'bytes')
+
+    def __init__(self):
+        self.wait = 0.0
+        self.failed = False
+        self.statements = 0
+        self.round_trips = 0
+        self.rows = 0
+        self.bytes = 0
+
+
+class QueryMetrics:
+    """
+    In-process metrics for the database.py entry points: per-function call
+    and error counts, wall time and connection wait histograms, and the
+    statements, round trips, rows and bytes each function caused.
+
+    Statements that take longer than slow_query_ms are printed with their
+    SQL and redacted parameters. A fraction (explain_rate) of slow SELECTs is
+    run again under EXPLAIN (ANALYZE, BUFFERS) and the plan printed with
+    them. When log_interval is set, a summary is printed that often.
+
+    Measuring a result's bytes copies every value out of it, so only a
+    fraction (bytes_sample_rate) of statements is measured, and each sample
+    counts for 1 / bytes_sample_rate statements; bytes are an estimate
+    unless the rate is 1, and not counted at 0.
+
+    Statements queued in a pipeline are timed as part of their function;
+    their rows and bytes are not counted.
+    """
+
+    def __init__(self, enabled=True, slow_query_ms=500, explain_rate=0.0, log_interval=0,
+                 bytes_sample_rate=0.01):
+        self.enabled = enabled
+        self.slow_query_ms = slow_query_ms
+        self.explain_rate = explain_rate
+        self.log_interval = log_interval
+        self.bytes_sample_rate = bytes_sample_rate
+        self._lock = threading.Lock()
+        self._functions = {}
+        self._slow_queries = 0
+        self._explained = 0
+        self._local = threading.local()
+        self._logger = None
+
+    def _stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _current(self):
+        stack = getattr(self._local, 'stack', None)
+        return stack[-1] if stack else None
+
+    def instrument(self, func):
+        """
+        Decorator recording a database.py entry point. Calls made from inside
+        another instrumented function are recorded on their own and also
+        counted towards the outer call.
+        """
+        name = func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not self.enabled:
+                return func(*args, **kwargs)
+            stack = self._stack()
+            call = _Call()
+            stack.append(call)
+            failed = False
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            except BaseException:
+                failed = True
+                raise
+            finally:
+                elapsed = (time.perf_counter() - start) * 1000
+                stack.pop()
+                if stack:
+                    outer = stack[-1]
+                    outer.wait += call.wait
+                    outer.statements += call.statements
+                    outer.round_trips += call.round_trips
+                    outer.rows += call.rows
+                    outer.bytes += call.bytes
+                # Most functions catch their errors and return None; a
+                # statement that raised still marks the call as failed
+                self._record(name, elapsed, call, failed or call.failed)
+
+        return wrapper
+
+    def _record(self, name, elapsed, call, failed):
+        with self._lock:
+            stats = self._functions.get(name)
+            if stats is None:
+                stats = self._functions[name] = _FunctionStats()
+            stats.calls += 1
+            if failed:
+                stats.errors += 1
+            stats.wall_ms.record(elapsed)
+            stats.wait_ms.record(call.wait * 1000)
+            stats.statements += call.statements
+            stats.round_trips += call.round_trips
+            stats.rows += call.rows
+            stats.bytes += call.bytes
+        if self.log_interval and self._logger is None:
+            self._start_logger()
+
+    def record_wait(self, seconds):
+        """
+        Add connection checkout time to the current call
+        """
+        call = self._current()
+        if call is not None:
+            call.wait += seconds
+
+    def _statement(self, cursor, query, params, elapsed, pipelined, error=False):
+        # The statement has already run; accounting for it must never fail it
+        try:
+            self._count_statement(cursor, query, params, elapsed, pipelined, error)
+        except Exception as e:
+            print(f"Error recording query metrics: {e}")
+
+    def _count_statement(self, cursor, query, params, elapsed, pipelined, error):
+        call = self._current()
+        if call is not None and error:
+            call.failed = True
+        elif call is not None:
+            call.statements += 1
+            if not pipelined:
+                call.round_trips += 1
+            result = cursor.pgresult
+            if result is not None and not pipelined:
+                call.rows += result.ntuples
+                if self.bytes_sample_rate and random.random() < self.bytes_sample_rate:
+                    call.bytes += round(_result_bytes(result) / self.bytes_sample_rate)
+        if elapsed * 1000 >= self.slow_query_ms and not pipelined and not error:
+            self._slow_query(cursor, query, params, elapsed)
+
+    def _round_trip(self):
+        call = self._current()
+        if call is not None:
+            call.round_trips += 1
+
+    def _slow_query(self, cursor, query, params, elapsed):
+        with self._lock:
+            self._slow_queries += 1
+        explain = self.explain_rate and random.random() < self.explain_rate
+        sql = _query_text(cursor, query)
+        print(f"Slow query ({elapsed * 1000:.0f} ms): {' '.join(sql.split())} "
+              f"params={redact(params)}")
+        if explain and sql.lstrip().lower().startswith(_EXPLAINABLE):
+            plan = _explain(cursor.connection, query, params)
+            if plan:
+                with self._lock:
+                    self._explained += 1
+                print("Query plan:\n" + plan)
+
+    def _start_logger(self):
+        with self._lock:
+            if self._logger is not None:
+                return
+            self._logger = threading.Thread(target=self._log_loop, name="db-metrics", daemon=True)
+        self._logger.start()
+
+    def _log_loop(self):
+        while self.log_interval:
+            time.sleep(self.log_interval)
+            print(self.summary())
+
+    def summary(self):
+        """
+        One line per function, busiest first
+        """
+        stats = self.stats()
+        lines = [f"Database metrics: {stats['slow_queries']} slow queries"]
+        for name, fn in sorted(stats['functions'].items(), key=lambda item: -item[1]['wall_ms']['count']):
+            wall = fn['wall_ms']
+            lines.append(
+                f"  {name}: {fn['calls']} calls, {fn['errors']} errors, "
+                f"p50 {wall['p50']:.1f} ms, p95 {wall['p95']:.1f} ms, p99 {wall['p99']:.1f} ms, "
+                f"wait p95 {fn['wait_ms']['p95']:.1f} ms, {fn['round_trips']} round trips, "
+                f"{fn['rows']} rows, {fn['bytes']} bytes")
+        return "\n".join(lines)
+
+    def stats(self):
+        """
+        Return a snapshot of the metrics
+        """
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'slow_query_ms': self.slow_query_ms,
+                'slow_queries': self._slow_queries,
+                'explained': self._explained,
+                'functions': {
+                    name: {
+                        'calls': s.calls,
+                        'errors': s.errors,
+                        'wall_ms': s.wall_ms.snapshot(),
+                        'wait_ms': s.wait_ms.snapshot(),
+                        'statements': s.statements,
+                        'round_trips': s.round_trips,
+                        'rows': s.rows,
+                        'bytes': s.bytes,
+                    }
+                    for name, s in self._functions.items()
+                },
+            }
+
+    def reset(self):
+        with self._lock:
+            self._functions.clear()
+            self._slow_queries = 0
+            self._explained = 0
+
+    def connect(self, **kwargs):
+        """
+        Open a connection whose cursors report to these metrics
+        """
+        conn = InstrumentedConnection.connect(cursor_factory=InstrumentedCursor, **kwargs)
+        conn.metrics = self
+        return conn
+
+
+class InstrumentedConnection(psycopg.Connection):
+    """
+    Connection that counts commits and pipelines as round trips
+    """
+    metrics = None
+    _pipeline_depth = 0
+
+    def commit(self):
+        super().commit()
+        if self.metrics is not None and not self._pipeline_depth:
+            self.metrics._round_trip()
+
+    @contextmanager
+    def pipeline(self):
+        # Everything queued in the pipeline goes out in one flight
+        with super().pipeline() as pipeline:
+            self._pipeline_depth += 1
+            try:
+                yield pipeline
+            finally:
+                self._pipeline_depth -= 1
+        if self.metrics is not None and not self._pipeline_depth:
+            self.metrics._round_trip()
+
+
+class InstrumentedCursor(psycopg.Cursor):
+    """
+    Cursor that reports the time, rows and bytes of every statement to the
+    connection's QueryMetrics
+    """
+
+    def execute(self, query, params=None, **kwargs):
+        metrics = getattr(self.connection, 'metrics', None)
+        if metrics is None or not metrics.enabled:
+            return super().execute(query, params, **kwargs)
+        pipelined = bool(getattr(self.connection, '_pipeline_depth', 0))
+        start = time.perf_counter()
+        try:
+            result = super().execute(query, params, **kwargs)
+        except Exception:
+            metrics._statement(self, query, params, time.perf_counter() - start, pipelined, error=True)
+            raise
+        metrics._statement(self, query, params, time.perf_counter() - start, pipelined)
+        return result
+
+    def executemany(self, query, params_seq, **kwargs):
+        metrics = getattr(self.connection, 'metrics', None)
+        if metrics is None or not metrics.enabled:
+            return super().executemany(query, params_seq, **kwargs)
+        start = time.perf_counter()
+        try:
+            result = super().executemany(query, params_seq, **kwargs)
+        except Exception:
+            metrics._statement(self, query, None, time.perf_counter() - start, False, error=True)
+            raise
+        # executemany pipelines its statements into one flight
+        metrics._statement(self, query, None, time.perf_counter() - start, False)
+        return result
+
+
+def _result_bytes(result):
+    """
+    Size of a result's values on the wire
+    """
+    total = 0
+    for row in range(result.ntuples):
+        for col in range(result.nfields):
+            total += len(result.get_value(row, col) or b'')
+    return total
+
+
+def _query_text(cursor, query):
+    if isinstance(query, str):
+        return query
+    try:
+        return query.as_string(cursor)
+    except Exception:
+        return str(query)
+
+
+def redact(params):
+    """
+    Describe query parameters by type and size only, so that no patient data
+    ends up in the logs
+    """
+    if params is None:
+        return None
+    if isinstance(params, dict):
+        return {key: _redact_value(value) for key, value in params.items()}
+    return [_redact_value(value) for value in params]
+
+
+def _redact_value(value):
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    obj = getattr(value, 'obj', value)  # Jsonb wrapper
+    size = len(obj) if hasattr(obj, '__len__') else None
+    kind = type(value).__name__
+    return f"<{kind} len={size}>" if size is not None else f"<{kind}>"
+
+
+def _explain(conn, query, params):
+    """
+    Run a statement again under EXPLAIN (ANALYZE, BUFFERS) on a plain cursor,
+    in a savepoint that is always rolled back: a failure cannot abort the
+    caller's transaction, and a data-modifying WITH leaves no changes behind
+    """
+    try:
+        with conn.transaction(force_rollback=True):
+            cur = psycopg.Cursor(conn)
+            try:
+                # Not through InstrumentedCursor: the plan must not count
+                # towards the caller or log itself as slow
+                if isinstance(query, str):
+                    query = "EXPLAIN (ANALYZE, BUFFERS) " + query
+                else:
+                    query = psycopg.sql.Composed([psycopg.sql.SQL("EXPLAIN (ANALYZE, BUFFERS) "), query])
+                cur.execute(query, params)
+                return "\n".join(row[0] for row in cur.fetchall())
+            finally:
+                cur.close()
+    except Exception as e:
+        return f"(EXPLAIN failed: {e})"
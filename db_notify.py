@@ -0,0 +1,87 @@
+import threading
+import time
+
+import psycopg.sql
+
+
+class NotificationListener:
+    """
+    Background thread that LISTENs on a Postgres channel over its own
+    connection and passes every notification's payload to callback.
+
+    If the connection drops it is reopened after retry_interval seconds.
+    Notifications sent while disconnected are lost, so on_reconnect() is
+    called after every reconnect to let the caller discard whatever state
+    the notifications would have invalidated.
+    """
+
+    def __init__(self, connect, channel, callback, on_reconnect=None, retry_interval=5):
+        self._connect = connect
+        self.channel = channel
+        self._callback = callback
+        self._on_reconnect = on_reconnect
+        self.retry_interval = retry_interval
+        self._lock = threading.Lock()
+        self._thread = None
+        self._connected = False
+
+        self._notifications = 0
+        self._reconnects = 0
+        self._errors = 0
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name=f"listen-{self.channel}", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        first = True
+        while True:
+            conn = None
+            try:
+                conn = self._connect()
+                conn.autocommit = True
+                conn.execute(psycopg.sql.SQL("LISTEN {}").format(psycopg.sql.Identifier(self.channel)))
+                with self._lock:
+                    self._connected = True
+                    if not first:
+                        self._reconnects += 1
+                if not first and self._on_reconnect is not None:
+                    self._on_reconnect()
+                first = False
+                for notify in conn.notifies():
+                    with self._lock:
+                        self._notifications += 1
+                    try:
+                        self._callback(notify.payload)
+                    except Exception as e:
+                        print(f"Error handling {self.channel} notification: {e}")
+            except Exception as e:
+                with self._lock:
+                    self._errors += 1
+                print(f"Error listening on {self.channel}: {e}")
+            finally:
+                with self._lock:
+                    self._connected = False
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+            time.sleep(self.retry_interval)
+
+    def stats(self):
+        """
+        Return a snapshot of listener statistics
+        """
+        with self._lock:
+            return {
+                'channel': self.channel,
+                'running': self._thread is not None,
+                'connected': self._connected,
+                'notifications': self._notifications,
+                'reconnects': self._reconnects,
+                'errors': self._errors,
+            }
@@ -0,0 +1,532 @@
+import asyncio
+import threading
+import time
+from collections import deque
+
+
+class PoolTimeout(Exception):
+    """
+    Raised when no connection becomes available within the checkout timeout
+    """
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of database connections.
+
+    Streamlit runs every session on its own thread, so connections are handed
+    out to one thread at a time and returned with putconn(). Idle connections
+    are reused in LIFO order and recycled once they are older than
+    max_lifetime seconds. With pre_ping, a connection that sat idle for more
+    than ping_idle seconds (when the server or a proxy may have dropped it)
+    is pinged before being handed out; recently used ones are not, so a busy
+    pool pays no extra round trips. Connections found broken on return are
+    discarded either way.
+    """
+
+    def __init__(self, connect, min_size=1, max_size=10, max_lifetime=1800,
+                 timeout=30, pre_ping=True, ping_idle=30):
+        if max_size < 1:
+            raise ValueError("max_size must be at least 1")
+        self._connect = connect
+        self.min_size = max(0, min(min_size, max_size))
+        self.max_size = max_size
+        self.max_lifetime = max_lifetime
+        self.timeout = timeout
+        self.pre_ping = pre_ping
+        self.ping_idle = ping_idle
+
+        self._lock = threading.Condition()
+        self._idle = deque()  # (conn, created_at, idle_since)
+        self._created_at = {}  # id(conn) -> created_at for checked out connections
+        self._size = 0
+        self._closed = False
+
+        # Statistics
+        self._requests = 0
+        self._waiting = 0
+        self._wait_time_total = 0.0
+        self._wait_time_max = 0.0
+        self._timeouts = 0
+        self._connections_created = 0
+        self._connections_discarded = 0
+        self._ping_failures = 0
+
+        for _ in range(self.min_size):
+            self._idle.append(self._new_connection())
+
+    def _new_connection(self):
+        conn = self._connect()
+        with self._lock:
+            self._size += 1
+            self._connections_created += 1
+        now = time.monotonic()
+        return conn, now, now
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._lock:
+            self._size -= 1
+            self._connections_discarded += 1
+            self._lock.notify()
+
+    def _expired(self, created_at):
+        return self.max_lifetime and time.monotonic() - created_at > self.max_lifetime
+
+    def _needs_ping(self, idle_since):
+        return self.pre_ping and time.monotonic() - idle_since > self.ping_idle
+
+    def _ping(self, conn):
+        try:
+            cur = conn.cursor()
+            try:
+                cur.execute("SELECT 1")
+                cur.fetchone()
+            finally:
+                cur.close()
+            conn.rollback()
+            return True
+        except Exception:
+            with self._lock:
+                self._ping_failures += 1
+            return False
+
+    def getconn(self, timeout=None):
+        """
+        Borrow a connection, waiting up to timeout seconds for one to free up
+        """
+        timeout = self.timeout if timeout is None else timeout
+        start = time.monotonic()
+        deadline = start + timeout
+
+        while True:
+            conn = created_at = None
+            create = False
+            with self._lock:
+                if self._closed:
+                    raise PoolTimeout("connection pool is closed")
+                if self._idle:
+                    conn, created_at, idle_since = self._idle.pop()
+                elif self._size < self.max_size:
+                    # Reserve the slot before connecting outside the lock
+                    self._size += 1
+                    create = True
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._timeouts += 1
+                        raise PoolTimeout(
+                            f"no connection available after {timeout}s "
+                            f"({self._size} of {self.max_size} in use)"
+                        )
+                    self._waiting += 1
+                    try:
+                        self._lock.wait(remaining)
+                    finally:
+                        self._waiting -= 1
+                    continue
+
+            if create:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._lock:
+                        self._size -= 1
+                        self._lock.notify()
+                    raise
+                created_at = time.monotonic()
+                with self._lock:
+                    self._connections_created += 1
+            elif getattr(conn, 'closed', False) or self._expired(created_at) or \
+                    (self._needs_ping(idle_since) and not self._ping(conn)):
+                self._discard(conn)
+                continue
+
+            waited = time.monotonic() - start
+            with self._lock:
+                self._created_at[id(conn)] = created_at
+                self._requests += 1
+                self._wait_time_total += waited
+                self._wait_time_max = max(self._wait_time_max, waited)
+            return conn
+
+    def putconn(self, conn):
+        """
+        Return a borrowed connection to the pool
+        """
+        with self._lock:
+            created_at = self._created_at.pop(id(conn), None)
+        if created_at is None:
+            # Not one of ours (or already returned); just close it
+            try:
+                conn.close()
+            except Exception:
+                pass
+            return
+
+        broken = getattr(conn, 'closed', False)
+        if not broken:
+            try:
+                # Never hand out a connection with an open transaction
+                conn.rollback()
+            except Exception:
+                broken = True
+
+        if broken or self._closed or self._expired(created_at):
+            self._discard(conn)
+            return
+
+        with self._lock:
+            self._idle.append((conn, created_at, time.monotonic()))
+            self._lock.notify()
+
+    def close(self):
+        """
+        Close all idle connections; checked out connections are closed on return
+        """
+        with self._lock:
+            self._closed = True
+            idle = list(self._idle)
+            self._idle.clear()
+            self._lock.notify_all()
+        for conn, _, _ in idle:
+            self._discard(conn)
+
+    def stats(self):
+        """
+        Return a snapshot of pool usage statistics
+        """
+        with self._lock:
+            in_use = len(self._created_at)
+            idle = len(self._idle)
+            requests = self._requests
+            return {
+                'max_size': self.max_size,
+                'min_size': self.min_size,
+                'size': self._size,
+                'in_use': in_use,
+                'idle': idle,
+                'waiting': self._waiting,
+                'requests': requests,
+                'wait_time_total': self._wait_time_total,
+                'wait_time_avg': self._wait_time_total / requests if requests else 0.0,
+                'wait_time_max': self._wait_time_max,
+                'timeouts': self._timeouts,
+                'connections_created': self._connections_created,
+                'connections_discarded': self._connections_discarded,
+                'ping_failures': self._ping_failures,
+            }
+
+
+class AsyncConnectionPool:
+    """
+    asyncio counterpart of ConnectionPool for psycopg AsyncConnections.
+
+    Connections are handed out to one task at a time and returned with
+    putconn(). Reuse, pre-ping and max_lifetime recycling work as in
+    ConnectionPool. The pool must only be used from the event loop that
+    created it. connect is a coroutine function that opens a connection.
+    """
+
+    def __init__(self, connect, min_size=1, max_size=10, max_lifetime=1800,
+                 timeout=30, pre_ping=True, ping_idle=30):
+        if max_size < 1:
+            raise ValueError("max_size must be at least 1")
+        self._connect = connect
+        self.min_size = max(0, min(min_size, max_size))
+        self.max_size = max_size
+        self.max_lifetime = max_lifetime
+        self.timeout = timeout
+        self.pre_ping = pre_ping
+        self.ping_idle = ping_idle
+
+        self._cond = asyncio.Condition()
+        self._idle = deque()  # (conn, created_at, idle_since)
+        self._created_at = {}  # id(conn) -> created_at for checked out connections
+        self._size = 0
+        self._closed = False
+
+        self._requests = 0
+        self._waiting = 0
+        self._wait_time_total = 0.0
+        self._wait_time_max = 0.0
+        self._timeouts = 0
+        self._connections_created = 0
+        self._connections_discarded = 0
+        self._ping_failures = 0
+
+    async def open(self):
+        """
+        Open min_size connections up front
+        """
+        while self._size < self.min_size:
+            conn = await self._connect()
+            async with self._cond:
+                self._size += 1
+                self._connections_created += 1
+                self._idle.append((conn, time.monotonic(), time.monotonic()))
+
+    def _expired(self, created_at):
+        return self.max_lifetime and time.monotonic() - created_at > self.max_lifetime
+
+    def _needs_ping(self, idle_since):
+        return self.pre_ping and time.monotonic() - idle_since > self.ping_idle
+
+    async def _discard(self, conn):
+        try:
+            await conn.close()
+        except Exception:
+            pass
+        async with self._cond:
+            self._size -= 1
+            self._connections_discarded += 1
+            self._cond.notify()
+
+    async def _ping(self, conn):
+        try:
+            await conn.execute("SELECT 1")
+            await conn.rollback()
+            return True
+        except Exception:
+            self._ping_failures += 1
+            return False
+
+    async def getconn(self, timeout=None):
+        """
+        Borrow a connection, waiting up to timeout seconds for one to free up
+        """
+        timeout = self.timeout if timeout is None else timeout
+        start = time.monotonic()
+        deadline = start + timeout
+
+        while True:
+            conn = created_at = None
+            create = False
+            async with self._cond:
+                if self._closed:
+                    raise PoolTimeout("connection pool is closed")
+                if self._idle:
+                    conn, created_at, idle_since = self._idle.pop()
+                elif self._size < self.max_size:
+                    # Reserve the slot before connecting outside the lock
+                    self._size += 1
+                    create = True
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._timeouts += 1
+                        raise PoolTimeout(
+                            f"no connection available after {timeout}s "
+                            f"({self._size} of {self.max_size} in use)"
+                        )
+                    self._waiting += 1
+                    try:
+                        await asyncio.wait_for(self._cond.wait(), remaining)
+                    except asyncio.TimeoutError:
+                        pass
+                    finally:
+                        self._waiting -= 1
+                    continue
+
+            if create:
+                try:
+                    conn = await self._connect()
+                except Exception:
+                    async with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+                created_at = time.monotonic()
+                self._connections_created += 1
+            elif getattr(conn, 'closed', False) or self._expired(created_at) or \
+                    (self._needs_ping(idle_since) and not await self._ping(conn)):
+                await self._discard(conn)
+                continue
+
+            waited = time.monotonic() - start
+            self._created_at[id(conn)] = created_at
+            self._requests += 1
+            self._wait_time_total += waited
+            self._wait_time_max = max(self._wait_time_max, waited)
+            return conn
+
+    async def putconn(self, conn):
+        """
+        Return a borrowed connection to the pool
+        """
+        created_at = self._created_at.pop(id(conn), None)
+        if created_at is None:
+            try:
+                await conn.close()
+            except Exception:
+                pass
+            return
+
+        broken = getattr(conn, 'closed', False)
+        if not broken:
+            try:
+                # Never hand out a connection with an open transaction
+                await conn.rollback()
+            except Exception:
+                broken = True
+
+        if broken or self._closed or self._expired(created_at):
+            await self._discard(conn)
+            return
+
+        async with self._cond:
+            self._idle.append((conn, created_at, time.monotonic()))
+            self._cond.notify()
+
+    async def close(self):
+        """
+        Close all idle connections; checked out connections are closed on return
+        """
+        async with self._cond:
+            self._closed = True
+            idle = list(self._idle)
+            self._idle.clear()
+            self._cond.notify_all()
+        for conn, _, _ in idle:
+            await self._discard(conn)
+
+    def stats(self):
+        """
+        Return a snapshot of pool usage statistics
+        """
+        requests = self._requests
+        return {
+            'max_size': self.max_size,
+            'min_size': self.min_size,
+            'size': self._size,
+            'in_use': len(self._created_at),
+            'idle': len(self._idle),
+            'waiting': self._waiting,
+            'requests': requests,
+            'wait_time_total': self._wait_time_total,
+            'wait_time_avg': self._wait_time_total / requests if requests else 0.0,
+            'wait_time_max': self._wait_time_max,
+            'timeouts': self._timeouts,
+            'connections_created': self._connections_created,
+            'connections_discarded': self._connections_discarded,
+            'ping_failures': self._ping_failures,
+        }
+
+
+class ReplicaSet:
+    """
+    Round robin over a set of read replicas, one ConnectionPool each.
+
+    A replica that cannot connect is skipped for retry_interval seconds.
+    Every check_interval seconds a borrowed connection is also passed to
+    check(conn), which returns False when the replica is unusable (e.g.
+    lagging too far behind); it is then skipped the same way. A replica
+    whose pool has no free connection within checkout_timeout seconds is
+    only busy: the read moves on to the next replica without marking it
+    down. getconn() returns None when no replica is usable, so the caller
+    can fall back to the primary.
+    """
+
+    def __init__(self, pools, check=None, check_interval=10, retry_interval=30, checkout_timeout=0.25):
+        self._pools = list(pools)
+        self._check = check
+        self.check_interval = check_interval
+        self.retry_interval = retry_interval
+        self.checkout_timeout = checkout_timeout
+        self._lock = threading.Lock()
+        self._next = 0
+        self._down_until = [0.0] * len(self._pools)
+        self._checked_at = [0.0] * len(self._pools)
+        self._owner = {}  # id(conn) -> replica index
+
+        self._requests = [0] * len(self._pools)
+        self._failures = [0] * len(self._pools)
+        self._busy = [0] * len(self._pools)
+        self._fallbacks = 0
+
+    def __len__(self):
+        return len(self._pools)
+
+    def _mark_down(self, index):
+        with self._lock:
+            self._down_until[index] = time.monotonic() + self.retry_interval
+            self._failures[index] += 1
+
+    def getconn(self, timeout=None):
+        """
+        Borrow a connection from the next healthy replica that has one free
+        within timeout (default checkout_timeout) seconds, or None
+        """
+        timeout = self.checkout_timeout if timeout is None else timeout
+        for _ in range(len(self._pools)):
+            with self._lock:
+                index = self._next
+                self._next = (self._next + 1) % len(self._pools)
+                if self._down_until[index] > time.monotonic():
+                    continue
+                due = self._check is not None and \
+                    time.monotonic() - self._checked_at[index] >= self.check_interval
+                if due:
+                    self._checked_at[index] = time.monotonic()
+            pool = self._pools[index]
+            try:
+                conn = pool.getconn(timeout)
+            except PoolTimeout:
+                with self._lock:
+                    self._busy[index] += 1
+                continue
+            except Exception:
+                self._mark_down(index)
+                continue
+            if due:
+                try:
+                    healthy = self._check(conn)
+                except Exception:
+                    healthy = False
+                if not healthy:
+                    pool.putconn(conn)
+                    self._mark_down(index)
+                    continue
+            with self._lock:
+                self._owner[id(conn)] = index
+                self._requests[index] += 1
+            return conn
+        with self._lock:
+            self._fallbacks += 1
+        return None
+
+    def owns(self, conn):
+        with self._lock:
+            return id(conn) in self._owner
+
+    def putconn(self, conn):
+        """
+        Return a connection borrowed with getconn() to its replica's pool
+        """
+        with self._lock:
+            index = self._owner.pop(id(conn))
+        self._pools[index].putconn(conn)
+
+    def close(self):
+        for pool in self._pools:
+            pool.close()
+
+    def stats(self):
+        """
+        Return per-replica health and usage statistics
+        """
+        now = time.monotonic()
+        with self._lock:
+            replicas = [{
+                'healthy': self._down_until[i] <= now,
+                'requests': self._requests[i],
+                'failures': self._failures[i],
+                'busy': self._busy[i],
+            } for i in range(len(self._pools))]
+            fallbacks = self._fallbacks
+        for replica, pool in zip(replicas, self._pools):
+            replica['pool'] = pool.stats()
+        return {'replicas': replicas, 'fallbacks': fallbacks}
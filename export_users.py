@@ -0,0 +1,91 @@
+"""
+Export every user's profile, conditions and family history as NDJSON, one
+JSON document per line in user id order (the same document as the
+Dashboard's "Download Profile").
+
+Rows are streamed through a server-side cursor, so memory use does not grow
+with the number of users. Progress (users, rows/s, bytes, last user id) is
+reported on stderr; after an interruption, pass the last reported user id to
+--after-user-id with --append to carry on where the export stopped.
+
+Usage:
+    python export_users.py --output users.ndjson.gz
+    python export_users.py --output users.ndjson.gz --after-user-id 41200 --append
+    python export_users.py --output - | jq .user_info.username
+"""
+import argparse
+import gzip
+import sys
+import time
+
+import database
+
+
+def open_output(path, append, compress):
+    if path == '-':
+        return sys.stdout.buffer
+    mode = 'ab' if append else 'wb'
+    if compress:
+        # Appending adds a new gzip member; readers see one continuous stream
+        return gzip.open(path, mode, compresslevel=6)
+    return open(path, mode)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--output', '-o', default='-',
+                        help="output file, or - for stdout (default)")
+    parser.add_argument('--gzip', action='store_true',
+                        help="gzip the output (implied by a .gz output file)")
+    parser.add_argument('--after-user-id', type=int, default=0,
+                        help="only export users with a higher id, to resume an export")
+    parser.add_argument('--append', action='store_true',
+                        help="append to the output file instead of replacing it")
+    parser.add_argument('--fetch-size', type=int, default=500,
+                        help="rows fetched from the server per round trip (default 500)")
+    parser.add_argument('--progress-interval', type=float, default=5.0,
+                        help="seconds between progress reports (default 5)")
+    args = parser.parse_args()
+
+    if not database.init_db():
+        sys.exit("Could not initialize the database")
+
+    compress = args.gzip or args.output.endswith('.gz')
+    out = open_output(args.output, args.append, compress)
+
+    users = 0
+    written = 0
+    last_user_id = args.after_user_id
+    start = last_report = time.monotonic()
+
+    def report(final=False):
+        elapsed = time.monotonic() - start
+        rate = users / elapsed if elapsed > 0 else 0.0
+        label = "exported" if final else "exporting"
+        print(f"{label}: {users} users, {rate:,.0f} rows/s, {written / 1e6:,.1f} MB, "
+              f"last user_id {last_user_id}", file=sys.stderr)
+
+    try:
+        for user_id, document in database.iter_user_documents(args.after_user_id, args.fetch_size):
+            line = document.encode() + b'\n'
+            out.write(line)
+            users += 1
+            written += len(line)
+            last_user_id = user_id
+            now = time.monotonic()
+            if now - last_report >= args.progress_interval:
+                report()
+                last_report = now
+    except KeyboardInterrupt:
+        report()
+        sys.exit(f"Interrupted; resume with --after-user-id {last_user_id} --append")
+    finally:
+        if out is not sys.stdout.buffer:
+            out.close()
+        else:
+            out.flush()
+    report(final=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,260 @@
+"""
+Shrink the FHIR documents stored in conditions and family_history.
+
+Upstream and form-built resources carry parts the app never reads: XHTML
+narrative wrappers that repeat the condition name, meta blocks, the fixed
+code system URLs of status and category codings, and the IMO search data
+that the family history form copies onto every condition of a relative.
+
+In lossless mode only what rehydrate() can restore exactly is removed:
+
+- a generated narrative's <div xmlns="..."> wrapper, and the whole div when
+  it only repeats the condition's name; a '~div' marker in the narrative
+  records which, so rehydrate() rebuilds only the divs it took away
+- the FHIR-defined system URLs of clinicalStatus, verificationStatus and
+  category codings, stored as short '~' aliases
+- IMO extensions repeated from the previous condition of the same family
+  member, replaced by one placeholder extension
+
+Lossy mode also drops meta blocks, redundant narratives and those system
+URLs outright, drops the IMO titles that repeat the search result's own
+title and removes null values; rehydrate() cannot bring them back.
+
+Codes, names, dates and statuses are never touched (every IMO extension
+keeps its codes), so the SQL helpers, fingerprints, summaries and cohort
+analytics read minimized and original documents alike.
+"""
+import copy
+import json
+
+MODES = ('off', 'lossless', 'lossy')
+
+XHTML_DIV_OPEN = '<div xmlns="http://www.w3.org/1999/xhtml">'
+XHTML_DIV_CLOSE = '</div>'
+
+# Code systems FHIR binds these Condition elements to, by alias
+SYSTEM_ALIASES = {
+    'condition-clinical': 'http://terminology.hl7.org/CodeSystem/condition-clinical',
+    'condition-ver-status': 'http://terminology.hl7.org/CodeSystem/condition-ver-status',
+    'condition-category': 'http://terminology.hl7.org/CodeSystem/condition-category',
+}
+_ALIAS_OF = {url: '~' + alias for alias, url in SYSTEM_ALIASES.items()}
+_ALIASED_ELEMENTS = ('clinicalStatus', 'verificationStatus', 'category')
+
+IMO_EXTENSION_URL = 'https://www.healthgorilla.com/fhir/StructureDefinition/imo-core-search-data'
+# Stands in for the IMO extensions of the previous condition
+IMO_AS_PREVIOUS_URL = 'urn:theracare:minimized:imo-as-previous'
+# IMO search data titles lossy mode drops when they repeat kndg_title
+IMO_TITLE_FIELDS = ('ICD10CM_TITLE', 'SNOMEDCT_TITLE')
+
+# Narrative key recording what lossless mode removed from the div
+NARRATIVE_MARKER = '~div'
+_NAME_ONLY = 'name'
+_UNWRAPPED = 'unwrapped'
+
+
+class PayloadMinimizer:
+    """
+    Minimizes documents (a list of entries, a Bundle, an entry or a bare
+    resource) on the way into the database and rehydrates them on the way
+    out. rehydrate() only restores what minimize() marked, so it is safe on
+    documents that were never minimized; with mode 'off' it does nothing.
+    """
+
+    def __init__(self, mode='off'):
+        if mode not in MODES:
+            raise ValueError(f"Unknown minimizer mode {mode!r}, expected one of {MODES}")
+        self.mode = mode
+
+    def minimize(self, document):
+        """
+        Return a minimized copy of document (document itself when off)
+        """
+        if self.mode == 'off':
+            return document
+        document = copy.deepcopy(document)
+        lossy = self.mode == 'lossy'
+        for resource in _resources(document):
+            _minimize_narrative(resource, lossy)
+            _minimize_systems(resource, lossy)
+            if resource.get('resourceType') == 'FamilyMemberHistory':
+                _minimize_imo_extensions(resource, lossy)
+            if lossy:
+                resource.pop('meta', None)
+                _drop_nulls(resource)
+        return document
+
+    def rehydrate(self, document):
+        """
+        Restore, in place, what lossless minimization removed. Returns document
+        """
+        if self.mode == 'off':
+            return document
+        for resource in _resources(document):
+            _rehydrate_narrative(resource)
+            _rehydrate_systems(resource)
+            if resource.get('resourceType') == 'FamilyMemberHistory':
+                _rehydrate_imo_extensions(resource)
+        return document
+
+
+def _resources(document):
+    if isinstance(document, list):
+        entries = document
+    elif isinstance(document, dict) and isinstance(document.get('entry'), list):
+        entries = document['entry']
+    elif isinstance(document, dict):
+        entries = [document]
+    else:
+        entries = []
+    for entry in entries:
+        if not isinstance(entry, dict):
+            continue
+        resource = entry['resource'] if isinstance(entry.get('resource'), dict) else entry
+        if resource.get('resourceType'):
+            yield resource
+
+
+def _code_text(resource):
+    concept = resource.get('code')
+    if not isinstance(concept, dict):
+        return ''
+    text = concept.get('text') or ''
+    coding = concept.get('coding')
+    if not text and isinstance(coding, list) and coding and isinstance(coding[0], dict):
+        text = coding[0].get('display') or ''
+    return text
+
+
+def _minimize_narrative(resource, lossy):
+    text = resource.get('text')
+    if not isinstance(text, dict):
+        return
+    div = text.get('div')
+    if not (isinstance(div, str) and div.startswith(XHTML_DIV_OPEN) and div.endswith(XHTML_DIV_CLOSE)):
+        return
+    inner = div[len(XHTML_DIV_OPEN):-len(XHTML_DIV_CLOSE)]
+    if inner == _code_text(resource) and resource.get('resourceType') == 'Condition':
+        # Only repeats the name: restored from the code
+        if lossy:
+            del resource['text']
+        else:
+            del text['div']
+            text[NARRATIVE_MARKER] = _NAME_ONLY
+    else:
+        text['div'] = inner
+        text[NARRATIVE_MARKER] = _UNWRAPPED
+
+
+def _rehydrate_narrative(resource):
+    text = resource.get('text')
+    if not isinstance(text, dict):
+        return
+    marker = text.pop(NARRATIVE_MARKER, None)
+    if marker == _NAME_ONLY:
+        text['div'] = XHTML_DIV_OPEN + _code_text(resource) + XHTML_DIV_CLOSE
+    elif marker == _UNWRAPPED and isinstance(text.get('div'), str):
+        text['div'] = XHTML_DIV_OPEN + text['div'] + XHTML_DIV_CLOSE
+
+
+def _codings(resource):
+    for name in _ALIASED_ELEMENTS:
+        concepts = resource.get(name)
+        for concept in concepts if isinstance(concepts, list) else [concepts]:
+            if isinstance(concept, dict) and isinstance(concept.get('coding'), list):
+                for coding in concept['coding']:
+                    if isinstance(coding, dict):
+                        yield coding
+
+
+def _minimize_systems(resource, lossy):
+    for coding in _codings(resource):
+        alias = _ALIAS_OF.get(coding.get('system'))
+        if alias is None:
+            continue
+        if lossy:
+            del coding['system']
+        else:
+            coding['system'] = alias
+
+
+def _rehydrate_systems(resource):
+    for coding in _codings(resource):
+        system = coding.get('system')
+        if isinstance(system, str) and system.startswith('~'):
+            coding['system'] = SYSTEM_ALIASES.get(system[1:], system)
+
+
+def _imo_span(extensions):
+    """
+    (start, IMO extensions) if the IMO extensions are one contiguous run,
+    else None
+    """
+    positions = [i for i, ext in enumerate(extensions)
+                 if isinstance(ext, dict) and ext.get('url') == IMO_EXTENSION_URL]
+    if not positions or positions[-1] - positions[0] + 1 != len(positions):
+        return None
+    return positions[0], extensions[positions[0]:positions[-1] + 1]
+
+
+def _trim_imo_titles(extension):
+    """
+    Copy of an IMO extension without null fields and the titles that repeat
+    kndg_title; codes are kept
+    """
+    try:
+        data = json.loads(extension.get('valueString') or '{}')
+    except (TypeError, ValueError):
+        return extension
+    if not isinstance(data, dict):
+        return extension
+    trimmed = {key: value for key, value in data.items()
+               if value is not None and not (key in IMO_TITLE_FIELDS and value == data.get('kndg_title'))}
+    return dict(extension, valueString=json.dumps(trimmed))
+
+
+def _minimize_imo_extensions(resource, lossy):
+    previous = None
+    for condition in resource.get('condition') or []:
+        extensions = condition.get('extension') if isinstance(condition, dict) else None
+        if not isinstance(extensions, list):
+            previous = None
+            continue
+        span = _imo_span(extensions)
+        if span is None:
+            previous = None
+            continue
+        start, imo = span
+        if lossy:
+            imo = [_trim_imo_titles(ext) for ext in imo]
+            extensions = condition['extension'] = extensions[:start] + imo + extensions[start + len(imo):]
+        if imo == previous:
+            condition['extension'] = (extensions[:start] + [{'url': IMO_AS_PREVIOUS_URL}]
+                                      + extensions[start + len(imo):])
+        previous = imo
+
+
+def _rehydrate_imo_extensions(resource):
+    previous = None
+    for condition in resource.get('condition') or []:
+        extensions = condition.get('extension') if isinstance(condition, dict) else None
+        if not isinstance(extensions, list):
+            previous = None
+            continue
+        for i, ext in enumerate(extensions):
+            if isinstance(ext, dict) and ext.get('url') == IMO_AS_PREVIOUS_URL and previous:
+                condition['extension'] = extensions[:i] + copy.deepcopy(previous) + extensions[i + 1:]
+                break
+        span = _imo_span(condition['extension'])
+        previous = span[1] if span else None
+
+
+def _drop_nulls(value):
+    if isinstance(value, dict):
+        for key in [key for key, item in value.items() if item is None]:
+            del value[key]
+        for item in value.values():
+            _drop_nulls(item)
+    elif isinstance(value, list):
+        for item in value:
+            _drop_nulls(item)
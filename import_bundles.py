@@ -0,0 +1,174 @@
+"""
+Bulk-load patients from FHIR Bundles, e.g. when onboarding a clinic.
+
+Every Bundle holds one patient: a Patient resource plus their Condition and
+FamilyMemberHistory resources. Each patient becomes a TheraCare user (the
+username is the Patient id) with their profile, conditions and family
+history. Bundles are read from .json files (one Bundle each) and .ndjson
+files (one Bundle per line), or from every such file in a directory.
+
+Batches of patients are written with COPY, one transaction per batch, on
+--workers connections in parallel. Progress (patients, patients/s, batches)
+is reported on stderr. Re-importing a patient replaces their profile and
+adds the conditions and family history entries they do not have yet. A
+patient whose id is already the username (or whose email is already the
+email) of another account is skipped and reported, and that account is
+left untouched.
+
+Imported users get a random password that is never shown to anyone, so
+they cannot log in until a password is set for them. --workers beyond
+DB_POOL_MAX_SIZE only queue for a connection.
+
+Usage:
+    python import_bundles.py clinic_export/
+    python import_bundles.py patients.ndjson --batch-size 1000 --workers 4
+"""
+import argparse
+import gzip
+import json
+import os
+import secrets
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import auth
+import database
+
+
+def iter_files(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if name.endswith(('.json', '.ndjson', '.ndjson.gz')):
+                    yield os.path.join(path, name)
+        else:
+            yield path
+
+
+def iter_bundles(paths):
+    for path in iter_files(paths):
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'rt', encoding='utf-8') as f:
+            if '.ndjson' in path:
+                for line in f:
+                    if line.strip():
+                        yield path, json.loads(line)
+            else:
+                yield path, json.load(f)
+
+
+def patient_record(bundle, password_hash):
+    """
+    Turn one patient's Bundle into a database.bulk_import_users() record,
+    or None if it has no Patient resource
+    """
+    patient = None
+    conditions = []
+    family_history = []
+    for entry in bundle.get('entry') or []:
+        resource = entry.get('resource') if isinstance(entry, dict) else None
+        if not isinstance(resource, dict):
+            continue
+        resource_type = resource.get('resourceType')
+        if resource_type == 'Patient' and patient is None:
+            patient = resource
+        elif resource_type == 'Condition':
+            conditions.append({'resource': resource})
+        elif resource_type == 'FamilyMemberHistory':
+            family_history.append({'resource': resource})
+    if not patient or not patient.get('id'):
+        return None
+
+    gorilla_id = str(patient['id'])
+    email = next((t.get('value') for t in patient.get('telecom') or []
+                  if isinstance(t, dict) and t.get('system') == 'email' and t.get('value')),
+                 f"{gorilla_id}@patients.invalid")
+    return {
+        'username': gorilla_id[:50],
+        'email': email[:100],
+        'password_hash': password_hash,
+        'gorilla_id': gorilla_id,
+        'profile_data': patient,
+        'conditions': conditions,
+        'family_history': family_history
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('paths', nargs='+',
+                        help=".json/.ndjson files, or directories of them")
+    parser.add_argument('--batch-size', type=int, default=500,
+                        help="patients written per COPY and transaction (default 500)")
+    parser.add_argument('--workers', type=int, default=4,
+                        help="batches written in parallel (default 4)")
+    parser.add_argument('--progress-interval', type=float, default=5.0,
+                        help="seconds between progress reports (default 5)")
+    args = parser.parse_args()
+
+    if not database.init_db():
+        sys.exit("Could not initialize the database")
+
+    # One hash for the whole run: nobody knows the password behind it
+    password_hash = auth.hash_password(secrets.token_urlsafe(32))
+
+    imported = 0
+    skipped = 0
+    failed = 0
+    batches = 0
+    start = last_report = time.monotonic()
+
+    def report(final=False):
+        elapsed = time.monotonic() - start
+        rate = imported / elapsed if elapsed > 0 else 0.0
+        label = "imported" if final else "importing"
+        print(f"{label}: {imported} patients, {rate:,.0f} patients/s, {batches} batches, "
+              f"{skipped} skipped, {failed} failed", file=sys.stderr)
+
+    def collect(done):
+        nonlocal imported, skipped, failed, batches
+        for future in done:
+            size = pending.pop(future)
+            user_ids = future.result()
+            batches += 1
+            if user_ids is None:
+                failed += size
+            else:
+                imported += len(user_ids)
+                skipped += size - len(user_ids)
+
+    pending = {}
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        def submit(batch):
+            # Keep at most two batches per worker in memory
+            while len(pending) >= args.workers * 2:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+            pending[executor.submit(database.bulk_import_users, batch)] = len(batch)
+
+        batch = []
+        for path, bundle in iter_bundles(args.paths):
+            record = patient_record(bundle, password_hash)
+            if record is None:
+                print(f"{path}: skipping a Bundle without a Patient id", file=sys.stderr)
+                skipped += 1
+                continue
+            batch.append(record)
+            if len(batch) >= args.batch_size:
+                submit(batch)
+                batch = []
+            now = time.monotonic()
+            if now - last_report >= args.progress_interval:
+                report()
+                last_report = now
+        if batch:
+            submit(batch)
+        collect(wait(pending).done)
+    report(final=True)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,1383 @@
+"""
+Versioned schema migrations for the TheraCare database.
+
+Each migration is a (version, description, sql) tuple. Migrations are applied
+in version order, each in its own transaction, and recorded in the
+schema_version table so they only ever run once per database. Append new
+migrations to the end of MIGRATIONS; never edit one that has shipped.
+"""
+
+# Arbitrary key for pg_advisory_lock so that concurrent app processes
+# starting at the same time do not apply the same migration twice
+MIGRATION_LOCK_ID = 7215001
+
+MIGRATIONS = [
+    (1, "Create users, profiles, conditions and family_history tables", """
+        CREATE TABLE IF NOT EXISTS users (
+            id SERIAL PRIMARY KEY,
+            username VARCHAR(50) UNIQUE NOT NULL,
+            email VARCHAR(100) UNIQUE NOT NULL,
+            password_hash VARCHAR(255) NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+
+        CREATE TABLE IF NOT EXISTS profiles (
+            id SERIAL PRIMARY KEY,
+            user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
+            gorilla_id VARCHAR(255) NOT NULL,
+            profile_data JSONB NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE(user_id)
+        );
+
+        CREATE TABLE IF NOT EXISTS conditions (
+            id SERIAL PRIMARY KEY,
+            user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
+            gorilla_id VARCHAR(255) NOT NULL,
+            api_response JSONB NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE(user_id)
+        );
+
+        CREATE TABLE IF NOT EXISTS family_history (
+            id SERIAL PRIMARY KEY,
+            user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
+            gorilla_id VARCHAR(255),
+            api_response JSONB,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+    """),
+
+    (2, "Reconcile tables created by the old check_and_init_db", """
+        -- check_and_init_db created users without an email column
+        ALTER TABLE users ADD COLUMN IF NOT EXISTS email VARCHAR(100);
+
+        -- Manually entered conditions have no Health Gorilla ID
+        ALTER TABLE conditions ALTER COLUMN gorilla_id DROP NOT NULL;
+    """),
+
+    (3, "Index user_id on profiles, conditions and family_history", """
+        -- Tables created by init_db already have UNIQUE(user_id); only add an
+        -- index where no index on user_id exists yet
+        DO $$
+        DECLARE
+            tbl TEXT;
+        BEGIN
+            FOREACH tbl IN ARRAY ARRAY['profiles', 'conditions', 'family_history'] LOOP
+                IF NOT EXISTS (
+                    SELECT 1
+                    FROM pg_index i
+                    JOIN pg_attribute a
+                      ON a.attrelid = i.indrelid AND a.attnum = i.indkey[0]
+                    WHERE i.indrelid = tbl::regclass
+                      AND a.attname = 'user_id'
+                ) THEN
+                    EXECUTE format('CREATE INDEX %I ON %I (user_id)',
+                                   'idx_' || tbl || '_user_id', tbl);
+                END IF;
+            END LOOP;
+        END $$;
+    """),
+
+    (4, "Collapse duplicate rows and add UNIQUE(user_id) for upserts", """
+        -- Merge the entries of duplicate family_history rows into the most
+        -- recent row for each user, keeping the first copy of each entry
+        WITH ranked AS (
+            SELECT id, user_id, api_response,
+                   row_number() OVER (PARTITION BY user_id
+                                      ORDER BY updated_at DESC NULLS LAST, id DESC) AS rn
+            FROM family_history
+            WHERE user_id IS NOT NULL
+        ),
+        duplicated AS (
+            SELECT user_id FROM ranked GROUP BY user_id HAVING count(*) > 1
+        ),
+        merged AS (
+            SELECT user_id, jsonb_agg(entry ORDER BY rn DESC, pos) AS entries
+            FROM (
+                SELECT DISTINCT ON (r.user_id, e.entry) r.user_id, e.entry, r.rn, e.pos
+                FROM ranked r
+                JOIN duplicated d ON d.user_id = r.user_id
+                CROSS JOIN LATERAL jsonb_array_elements(
+                    CASE WHEN jsonb_typeof(r.api_response->'entry') = 'array'
+                         THEN r.api_response->'entry' ELSE '[]'::jsonb END
+                ) WITH ORDINALITY AS e(entry, pos)
+                ORDER BY r.user_id, e.entry, r.rn DESC, e.pos
+            ) AS entries
+            GROUP BY user_id
+        )
+        UPDATE family_history f
+        SET api_response = jsonb_set(
+                COALESCE(f.api_response, '{"resourceType": "Bundle", "type": "searchset"}'::jsonb),
+                '{entry}', m.entries),
+            updated_at = CURRENT_TIMESTAMP
+        FROM ranked r
+        JOIN merged m ON m.user_id = r.user_id
+        WHERE f.id = r.id AND r.rn = 1;
+
+        -- Same for conditions, stored as a list of entries or as a Bundle
+        WITH ranked AS (
+            SELECT id, user_id, api_response,
+                   row_number() OVER (PARTITION BY user_id
+                                      ORDER BY updated_at DESC NULLS LAST, id DESC) AS rn
+            FROM conditions
+            WHERE user_id IS NOT NULL
+        ),
+        duplicated AS (
+            SELECT user_id FROM ranked GROUP BY user_id HAVING count(*) > 1
+        ),
+        merged AS (
+            SELECT user_id, jsonb_agg(entry ORDER BY rn DESC, pos) AS entries
+            FROM (
+                SELECT DISTINCT ON (r.user_id, e.entry) r.user_id, e.entry, r.rn, e.pos
+                FROM ranked r
+                JOIN duplicated d ON d.user_id = r.user_id
+                CROSS JOIN LATERAL jsonb_array_elements(
+                    CASE WHEN jsonb_typeof(r.api_response) = 'array' THEN r.api_response
+                         WHEN jsonb_typeof(r.api_response->'entry') = 'array' THEN r.api_response->'entry'
+                         ELSE '[]'::jsonb END
+                ) WITH ORDINALITY AS e(entry, pos)
+                ORDER BY r.user_id, e.entry, r.rn DESC, e.pos
+            ) AS entries
+            GROUP BY user_id
+        )
+        UPDATE conditions c
+        SET api_response = CASE
+                WHEN jsonb_typeof(c.api_response) = 'object' THEN jsonb_set(c.api_response, '{entry}', m.entries)
+                ELSE m.entries
+            END,
+            updated_at = CURRENT_TIMESTAMP
+        FROM ranked r
+        JOIN merged m ON m.user_id = r.user_id
+        WHERE c.id = r.id AND r.rn = 1;
+
+        -- Rows removed below are kept here as they were, so no patient data
+        -- is lost (profiles cannot be merged)
+        CREATE TABLE IF NOT EXISTS migration_archive (
+            id SERIAL PRIMARY KEY,
+            migration INTEGER NOT NULL,
+            table_name TEXT NOT NULL,
+            row_data JSONB NOT NULL,
+            archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+
+        -- Keep only the most recent row per user in every per-user table
+        DO $$
+        DECLARE
+            tbl TEXT;
+            archived INTEGER;
+        BEGIN
+            FOREACH tbl IN ARRAY ARRAY['profiles', 'conditions', 'family_history'] LOOP
+                EXECUTE format('
+                    WITH removed AS (
+                        DELETE FROM %I t
+                        USING (
+                            SELECT id, row_number() OVER (PARTITION BY user_id
+                                                          ORDER BY updated_at DESC NULLS LAST, id DESC) AS rn
+                            FROM %I
+                            WHERE user_id IS NOT NULL
+                        ) r
+                        WHERE t.id = r.id AND r.rn > 1
+                        RETURNING t.*
+                    )
+                    INSERT INTO migration_archive (migration, table_name, row_data)
+                    SELECT 4, %L, to_jsonb(removed) FROM removed', tbl, tbl, tbl);
+                GET DIAGNOSTICS archived = ROW_COUNT;
+                IF archived > 0 THEN
+                    RAISE NOTICE 'Archived % duplicate % rows in migration_archive', archived, tbl;
+                END IF;
+
+                IF NOT EXISTS (
+                    SELECT 1
+                    FROM pg_index i
+                    JOIN pg_attribute a
+                      ON a.attrelid = i.indrelid AND a.attnum = i.indkey[0]
+                    WHERE i.indrelid = tbl::regclass
+                      AND i.indisunique
+                      AND i.indnatts = 1
+                      AND a.attname = 'user_id'
+                ) THEN
+                    EXECUTE format('ALTER TABLE %I ADD CONSTRAINT %I UNIQUE (user_id)',
+                                   tbl, tbl || '_user_id_key');
+                END IF;
+            END LOOP;
+        END $$;
+
+        -- The unique constraints make the plain indexes from migration 3 redundant
+        DROP INDEX IF EXISTS idx_profiles_user_id;
+        DROP INDEX IF EXISTS idx_conditions_user_id;
+        DROP INDEX IF EXISTS idx_family_history_user_id;
+    """),
+
+    (5, "Create the per-resource fhir_resources store", """
+        CREATE TABLE IF NOT EXISTS fhir_resources (
+            user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+            resource_type VARCHAR(64) NOT NULL CHECK (resource_type IN (
+                'Condition', 'AllergyIntolerance', 'MedicationRequest',
+                'Immunization', 'Procedure', 'FamilyMemberHistory'
+            )),
+            resource_id VARCHAR(255) NOT NULL,
+            resource JSONB NOT NULL,
+            code_system VARCHAR(255),
+            code VARCHAR(255),
+            display TEXT,
+            clinical_status VARCHAR(64),
+            asserted_date DATE,
+            onset_date DATE,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (user_id, resource_type, resource_id)
+        );
+
+        CREATE INDEX IF NOT EXISTS idx_fhir_resources_user_asserted
+            ON fhir_resources (user_id, resource_type, asserted_date DESC);
+        CREATE INDEX IF NOT EXISTS idx_fhir_resources_user_status
+            ON fhir_resources (user_id, resource_type, clinical_status);
+        CREATE INDEX IF NOT EXISTS idx_fhir_resources_code
+            ON fhir_resources (resource_type, code);
+    """),
+
+    (6, "Add SQL helpers for reading FHIR entries out of stored documents", """
+        -- Entries of a stored document: a plain array of entries or a Bundle
+        CREATE OR REPLACE FUNCTION fhir_document_entries(document JSONB)
+        RETURNS JSONB LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+            SELECT CASE
+                WHEN jsonb_typeof(document) = 'array' THEN document
+                WHEN jsonb_typeof(document->'entry') = 'array' THEN document->'entry'
+                ELSE '[]'::jsonb
+            END
+        $$;
+
+        -- The resource of an entry, for both wrapped and bare resources
+        CREATE OR REPLACE FUNCTION fhir_entry_resource(entry JSONB)
+        RETURNS JSONB LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+            SELECT CASE
+                WHEN jsonb_typeof(entry->'resource') = 'object' THEN entry->'resource'
+                WHEN jsonb_typeof(entry) = 'object' THEN entry
+                ELSE '{}'::jsonb
+            END
+        $$;
+
+        -- Display text of a CodeableConcept: its text, else the first coding's display
+        CREATE OR REPLACE FUNCTION fhir_codeable_text(concept JSONB)
+        RETURNS TEXT LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+            SELECT COALESCE(NULLIF(concept->>'text', ''), concept->'coding'->0->>'display', '')
+        $$;
+
+        -- Clinical status code of a Condition ('unknown' if missing)
+        CREATE OR REPLACE FUNCTION fhir_condition_status(resource JSONB)
+        RETURNS TEXT LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+            SELECT CASE jsonb_typeof(resource->'clinicalStatus')
+                WHEN 'object' THEN COALESCE(resource->'clinicalStatus'->'coding'->0->>'code', 'unknown')
+                WHEN 'string' THEN lower(resource->>'clinicalStatus')
+                ELSE 'unknown'
+            END
+        $$;
+
+        -- Date part (YYYY-MM-DD) of a FHIR date or dateTime, '' if missing
+        CREATE OR REPLACE FUNCTION fhir_date(value TEXT)
+        RETURNS TEXT LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+            SELECT split_part(COALESCE(value, ''), 'T', 1)
+        $$;
+    """),
+
+    (7, "Add a version column to conditions and family_history", """
+        -- Bumped by every write; writers pass the version they read to
+        -- detect concurrent changes
+        ALTER TABLE conditions ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 1;
+        ALTER TABLE family_history ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 1;
+    """),
+
+    (8, "Notify other app processes when a user's cached rows change", """
+        -- Sends '<kind>:<user_id>' on the cache_invalidation channel for
+        -- every row written, delivered when the writing transaction commits
+        CREATE OR REPLACE FUNCTION notify_cache_invalidation()
+        RETURNS TRIGGER LANGUAGE plpgsql AS $$
+        DECLARE
+            changed_user INTEGER;
+        BEGIN
+            IF TG_OP = 'DELETE' THEN
+                changed_user := OLD.user_id;
+            ELSE
+                changed_user := NEW.user_id;
+            END IF;
+            PERFORM pg_notify('cache_invalidation', TG_ARGV[0] || ':' || changed_user);
+            RETURN NULL;
+        END
+        $$;
+
+        DROP TRIGGER IF EXISTS profiles_cache_invalidation ON profiles;
+        CREATE TRIGGER profiles_cache_invalidation
+            AFTER INSERT OR UPDATE OR DELETE ON profiles
+            FOR EACH ROW EXECUTE FUNCTION notify_cache_invalidation('profile');
+
+        DROP TRIGGER IF EXISTS conditions_cache_invalidation ON conditions;
+        CREATE TRIGGER conditions_cache_invalidation
+            AFTER INSERT OR UPDATE OR DELETE ON conditions
+            FOR EACH ROW EXECUTE FUNCTION notify_cache_invalidation('conditions');
+
+        DROP TRIGGER IF EXISTS family_history_cache_invalidation ON family_history;
+        CREATE TRIGGER family_history_cache_invalidation
+            AFTER INSERT OR UPDATE OR DELETE ON family_history
+            FOR EACH ROW EXECUTE FUNCTION notify_cache_invalidation('family_history');
+    """),
+
+    (9, "Index a content fingerprint of every condition and family member", """
+        -- Lowercased text with runs of whitespace collapsed
+        CREATE OR REPLACE FUNCTION fhir_normalize_text(value TEXT)
+        RETURNS TEXT LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+            SELECT lower(regexp_replace(btrim(COALESCE(value, '')), '[[:space:]]+', ' ', 'g'))
+        $$;
+
+        -- A CodeableConcept's first coding as system|code, else its normalized text
+        CREATE OR REPLACE FUNCTION fhir_concept_key(concept JSONB)
+        RETURNS TEXT LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+            SELECT COALESCE(
+                NULLIF(lower(COALESCE(concept->'coding'->0->>'system', '')) || '|'
+                       || COALESCE(concept->'coding'->0->>'code', ''), '|'),
+                fhir_normalize_text(fhir_codeable_text(concept)))
+        $$;
+
+        -- Identity of a condition: code (or name), asserted date and clinical status
+        CREATE OR REPLACE FUNCTION fhir_condition_fingerprint(resource JSONB)
+        RETURNS TEXT LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+            SELECT md5(concat_ws(chr(31),
+                fhir_concept_key(resource->'code'),
+                fhir_date(resource->>'assertedDate'),
+                lower(fhir_condition_status(resource))))
+        $$;
+
+        -- Identity of a family member: relationship, gender and birth date
+        CREATE OR REPLACE FUNCTION fhir_family_member_fingerprint(resource JSONB)
+        RETURNS TEXT LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+            SELECT md5(concat_ws(chr(31),
+                fhir_concept_key(resource->'relationship'),
+                fhir_normalize_text(resource->>'gender'),
+                fhir_date(resource->>'bornDate')))
+        $$;
+
+        CREATE OR REPLACE FUNCTION fhir_entry_fingerprint(kind TEXT, entry JSONB)
+        RETURNS TEXT LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+            SELECT CASE kind
+                WHEN 'conditions' THEN fhir_condition_fingerprint(fhir_entry_resource(entry))
+                ELSE fhir_family_member_fingerprint(fhir_entry_resource(entry))
+            END
+        $$;
+
+        -- The set of fingerprints present in each user's stored documents;
+        -- kind is the document's table
+        CREATE TABLE IF NOT EXISTS entry_fingerprints (
+            user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+            kind TEXT NOT NULL,
+            fingerprint TEXT NOT NULL,
+            PRIMARY KEY (user_id, kind, fingerprint)
+        );
+
+        -- Keeps entry_fingerprints in step with every write to a document.
+        -- Appends have already claimed their fingerprints, so this only
+        -- adds what other writes introduced and drops what they removed.
+        CREATE OR REPLACE FUNCTION sync_entry_fingerprints()
+        RETURNS TRIGGER LANGUAGE plpgsql AS $$
+        BEGIN
+            IF TG_OP = 'DELETE' THEN
+                DELETE FROM entry_fingerprints
+                WHERE user_id = OLD.user_id AND kind = TG_ARGV[0];
+                RETURN NULL;
+            END IF;
+            IF NEW.user_id IS NULL THEN
+                RETURN NULL;
+            END IF;
+            IF TG_OP = 'UPDATE' THEN
+                DELETE FROM entry_fingerprints f
+                WHERE f.user_id = NEW.user_id AND f.kind = TG_ARGV[0]
+                  AND f.fingerprint NOT IN (
+                      SELECT fhir_entry_fingerprint(TG_ARGV[0], e)
+                      FROM jsonb_array_elements(fhir_document_entries(NEW.api_response)) e);
+            END IF;
+            INSERT INTO entry_fingerprints (user_id, kind, fingerprint)
+            SELECT DISTINCT NEW.user_id, TG_ARGV[0], fhir_entry_fingerprint(TG_ARGV[0], e)
+            FROM jsonb_array_elements(fhir_document_entries(NEW.api_response)) e
+            ON CONFLICT DO NOTHING;
+            RETURN NULL;
+        END
+        $$;
+
+        DROP TRIGGER IF EXISTS conditions_entry_fingerprints ON conditions;
+        CREATE TRIGGER conditions_entry_fingerprints
+            AFTER INSERT OR UPDATE OF api_response OR DELETE ON conditions
+            FOR EACH ROW EXECUTE FUNCTION sync_entry_fingerprints('conditions');
+
+        DROP TRIGGER IF EXISTS family_history_entry_fingerprints ON family_history;
+        CREATE TRIGGER family_history_entry_fingerprints
+            AFTER INSERT OR UPDATE OF api_response OR DELETE ON family_history
+            FOR EACH ROW EXECUTE FUNCTION sync_entry_fingerprints('family_history');
+
+        INSERT INTO entry_fingerprints (user_id, kind, fingerprint)
+        SELECT DISTINCT t.user_id, 'conditions', fhir_entry_fingerprint('conditions', e)
+        FROM conditions t, jsonb_array_elements(fhir_document_entries(t.api_response)) e
+        WHERE t.user_id IS NOT NULL
+        ON CONFLICT DO NOTHING;
+
+        INSERT INTO entry_fingerprints (user_id, kind, fingerprint)
+        SELECT DISTINCT t.user_id, 'family_history', fhir_entry_fingerprint('family_history', e)
+        FROM family_history t, jsonb_array_elements(fhir_document_entries(t.api_response)) e
+        WHERE t.user_id IS NOT NULL
+        ON CONFLICT DO NOTHING;
+    """),
+
+    (10, "Index condition names by trigram for near-duplicate lookups", """
+        -- pg_trgm and btree_gin (which lets one GIN index cover the user_id
+        -- equality and the trigram match) ship with the contrib package.
+        -- Without them the table below is still kept and the app compares
+        -- the names itself (see database._find_near_duplicates).
+        DO $trgm$
+        BEGIN
+            CREATE EXTENSION IF NOT EXISTS pg_trgm;
+            CREATE EXTENSION IF NOT EXISTS btree_gin;
+        EXCEPTION WHEN OTHERS THEN
+            RAISE NOTICE 'pg_trgm/btree_gin unavailable (%), near-duplicate names are compared in the app', SQLERRM;
+        END
+        $trgm$;
+
+        -- Condition names of an entry with the text shown to the user. For
+        -- a family member, context is the relationship and there is one row
+        -- per condition; for a condition it is ''.
+        CREATE OR REPLACE FUNCTION fhir_entry_condition_names(kind TEXT, entry JSONB)
+        RETURNS TABLE (context TEXT, name TEXT, display TEXT)
+        LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+            SELECT '', fhir_normalize_text(fhir_codeable_text(r->'code')), fhir_codeable_text(r->'code')
+            FROM (SELECT fhir_entry_resource(entry) AS r) x
+            WHERE kind = 'conditions'
+            UNION ALL
+            SELECT fhir_concept_key(r->'relationship'),
+                   fhir_normalize_text(fhir_codeable_text(c->'code')), fhir_codeable_text(c->'code')
+            FROM (SELECT fhir_entry_resource(entry) AS r) x
+            CROSS JOIN LATERAL jsonb_array_elements(
+                CASE WHEN jsonb_typeof(r->'condition') = 'array' THEN r->'condition' ELSE '[]'::jsonb END) c
+            WHERE kind = 'family_history'
+        $$;
+
+        -- Distinct condition names in each user's stored documents
+        CREATE TABLE IF NOT EXISTS entry_condition_names (
+            user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+            kind TEXT NOT NULL,
+            context TEXT NOT NULL,
+            name TEXT NOT NULL,
+            display TEXT NOT NULL,
+            PRIMARY KEY (user_id, kind, context, name)
+        );
+        DO $trgm$
+        BEGIN
+            IF (SELECT count(*) FROM pg_extension WHERE extname IN ('pg_trgm', 'btree_gin')) = 2 THEN
+                EXECUTE 'CREATE INDEX IF NOT EXISTS idx_entry_condition_names_trgm
+                         ON entry_condition_names USING gin (user_id, name gin_trgm_ops)';
+            END IF;
+        END
+        $trgm$;
+
+        CREATE OR REPLACE FUNCTION sync_entry_condition_names()
+        RETURNS TRIGGER LANGUAGE plpgsql AS $$
+        BEGIN
+            IF TG_OP = 'DELETE' THEN
+                DELETE FROM entry_condition_names
+                WHERE user_id = OLD.user_id AND kind = TG_ARGV[0];
+                RETURN NULL;
+            END IF;
+            IF NEW.user_id IS NULL THEN
+                RETURN NULL;
+            END IF;
+            IF TG_OP = 'UPDATE' THEN
+                DELETE FROM entry_condition_names n
+                WHERE n.user_id = NEW.user_id AND n.kind = TG_ARGV[0]
+                  AND (n.context, n.name) NOT IN (
+                      SELECT c.context, c.name
+                      FROM jsonb_array_elements(fhir_document_entries(NEW.api_response)) e,
+                           fhir_entry_condition_names(TG_ARGV[0], e) c);
+            END IF;
+            INSERT INTO entry_condition_names (user_id, kind, context, name, display)
+            SELECT DISTINCT ON (c.context, c.name) NEW.user_id, TG_ARGV[0], c.context, c.name, c.display
+            FROM jsonb_array_elements(fhir_document_entries(NEW.api_response)) e,
+                 fhir_entry_condition_names(TG_ARGV[0], e) c
+            WHERE c.name <> ''
+            ON CONFLICT DO NOTHING;
+            RETURN NULL;
+        END
+        $$;
+
+        DROP TRIGGER IF EXISTS conditions_entry_condition_names ON conditions;
+        CREATE TRIGGER conditions_entry_condition_names
+            AFTER INSERT OR UPDATE OF api_response OR DELETE ON conditions
+            FOR EACH ROW EXECUTE FUNCTION sync_entry_condition_names('conditions');
+
+        DROP TRIGGER IF EXISTS family_history_entry_condition_names ON family_history;
+        CREATE TRIGGER family_history_entry_condition_names
+            AFTER INSERT OR UPDATE OF api_response OR DELETE ON family_history
+            FOR EACH ROW EXECUTE FUNCTION sync_entry_condition_names('family_history');
+
+        INSERT INTO entry_condition_names (user_id, kind, context, name, display)
+        SELECT DISTINCT ON (t.user_id, c.context, c.name) t.user_id, 'conditions', c.context, c.name, c.display
+        FROM conditions t,
+             jsonb_array_elements(fhir_document_entries(t.api_response)) e,
+             fhir_entry_condition_names('conditions', e) c
+        WHERE t.user_id IS NOT NULL AND c.name <> ''
+        ON CONFLICT DO NOTHING;
+
+        INSERT INTO entry_condition_names (user_id, kind, context, name, display)
+        SELECT DISTINCT ON (t.user_id, c.context, c.name) t.user_id, 'family_history', c.context, c.name, c.display
+        FROM family_history t,
+             jsonb_array_elements(fhir_document_entries(t.api_response)) e,
+             fhir_entry_condition_names('family_history', e) c
+        WHERE t.user_id IS NOT NULL AND c.name <> ''
+        ON CONFLICT DO NOTHING;
+    """),
+
+    (11, "Keep a per-user summary of conditions and family history", """
+        -- Condition counts of a stored document: 'active', 'inactive' and
+        -- every other status (as the conditions page groups them), per
+        -- status, and the years conditions were recorded in, newest first
+        CREATE OR REPLACE FUNCTION fhir_condition_summary(document JSONB)
+        RETURNS TABLE (total INTEGER, active INTEGER, inactive INTEGER, unknown INTEGER,
+                       status_counts JSONB, years TEXT[])
+        LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+            WITH c AS (
+                SELECT fhir_condition_status(r.resource) AS status,
+                       left(fhir_date(r.resource->>'assertedDate'), 4) AS year
+                FROM jsonb_array_elements(fhir_document_entries(document)) e
+                CROSS JOIN LATERAL (SELECT fhir_entry_resource(e) AS resource) r
+                WHERE r.resource <> '{}'::jsonb
+            )
+            SELECT (SELECT count(*) FROM c)::integer,
+                   (SELECT count(*) FROM c WHERE status = 'active')::integer,
+                   (SELECT count(*) FROM c WHERE status = 'inactive')::integer,
+                   (SELECT count(*) FROM c WHERE status NOT IN ('active', 'inactive'))::integer,
+                   COALESCE((SELECT jsonb_object_agg(status, n)
+                             FROM (SELECT status, count(*) AS n FROM c GROUP BY status) g), '{}'::jsonb),
+                   ARRAY(SELECT DISTINCT year FROM c WHERE year <> '' ORDER BY year DESC)
+        $$;
+
+        -- Relatives in a stored family history, and how many of them have
+        -- a condition flagged as the cause of death
+        CREATE OR REPLACE FUNCTION fhir_family_summary(document JSONB)
+        RETURNS TABLE (relatives INTEGER, relatives_cause_of_death INTEGER)
+        LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+            WITH m AS (
+                SELECT r.resource
+                FROM jsonb_array_elements(fhir_document_entries(document)) e
+                CROSS JOIN LATERAL (SELECT fhir_entry_resource(e) AS resource) r
+                WHERE r.resource <> '{}'::jsonb
+            )
+            SELECT (SELECT count(*) FROM m)::integer,
+                   (SELECT count(*) FROM m WHERE EXISTS (
+                       SELECT 1
+                       FROM jsonb_array_elements(CASE WHEN jsonb_typeof(m.resource->'condition') = 'array'
+                                                      THEN m.resource->'condition' ELSE '[]'::jsonb END) c
+                       CROSS JOIN LATERAL jsonb_array_elements(CASE WHEN jsonb_typeof(c->'extension') = 'array'
+                                                                    THEN c->'extension' ELSE '[]'::jsonb END) x
+                       WHERE right(x->>'url', 14) = 'cause-of-death'
+                         AND x->'valueBoolean' = 'true'::jsonb))::integer
+        $$;
+
+        CREATE TABLE IF NOT EXISTS user_summary (
+            user_id INTEGER PRIMARY KEY REFERENCES users(id) ON DELETE CASCADE,
+            conditions_total INTEGER NOT NULL DEFAULT 0,
+            conditions_active INTEGER NOT NULL DEFAULT 0,
+            conditions_inactive INTEGER NOT NULL DEFAULT 0,
+            conditions_unknown INTEGER NOT NULL DEFAULT 0,
+            condition_status_counts JSONB NOT NULL DEFAULT '{}'::jsonb,
+            condition_years TEXT[] NOT NULL DEFAULT '{}',
+            relatives INTEGER NOT NULL DEFAULT 0,
+            relatives_cause_of_death INTEGER NOT NULL DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+
+        CREATE OR REPLACE FUNCTION refresh_condition_summary()
+        RETURNS TRIGGER LANGUAGE plpgsql AS $$
+        DECLARE
+            changed_user INTEGER;
+            document JSONB;
+        BEGIN
+            IF TG_OP = 'DELETE' THEN
+                changed_user := OLD.user_id;
+                document := '[]'::jsonb;
+            ELSE
+                changed_user := NEW.user_id;
+                document := NEW.api_response;
+            END IF;
+            -- Nothing to keep when the row goes with its user (ON DELETE CASCADE)
+            IF changed_user IS NULL
+               OR (TG_OP = 'DELETE' AND NOT EXISTS (SELECT 1 FROM users WHERE id = changed_user)) THEN
+                RETURN NULL;
+            END IF;
+            INSERT INTO user_summary AS u (
+                user_id, conditions_total, conditions_active, conditions_inactive,
+                conditions_unknown, condition_status_counts, condition_years
+            )
+            SELECT changed_user, s.* FROM fhir_condition_summary(document) s
+            ON CONFLICT (user_id) DO UPDATE
+            SET conditions_total = EXCLUDED.conditions_total,
+                conditions_active = EXCLUDED.conditions_active,
+                conditions_inactive = EXCLUDED.conditions_inactive,
+                conditions_unknown = EXCLUDED.conditions_unknown,
+                condition_status_counts = EXCLUDED.condition_status_counts,
+                condition_years = EXCLUDED.condition_years,
+                updated_at = CURRENT_TIMESTAMP;
+            RETURN NULL;
+        END
+        $$;
+
+        CREATE OR REPLACE FUNCTION refresh_family_summary()
+        RETURNS TRIGGER LANGUAGE plpgsql AS $$
+        DECLARE
+            changed_user INTEGER;
+            document JSONB;
+        BEGIN
+            IF TG_OP = 'DELETE' THEN
+                changed_user := OLD.user_id;
+                document := '[]'::jsonb;
+            ELSE
+                changed_user := NEW.user_id;
+                document := NEW.api_response;
+            END IF;
+            -- Nothing to keep when the row goes with its user (ON DELETE CASCADE)
+            IF changed_user IS NULL
+               OR (TG_OP = 'DELETE' AND NOT EXISTS (SELECT 1 FROM users WHERE id = changed_user)) THEN
+                RETURN NULL;
+            END IF;
+            INSERT INTO user_summary AS u (user_id, relatives, relatives_cause_of_death)
+            SELECT changed_user, s.* FROM fhir_family_summary(document) s
+            ON CONFLICT (user_id) DO UPDATE
+            SET relatives = EXCLUDED.relatives,
+                relatives_cause_of_death = EXCLUDED.relatives_cause_of_death,
+                updated_at = CURRENT_TIMESTAMP;
+            RETURN NULL;
+        END
+        $$;
+
+        DROP TRIGGER IF EXISTS conditions_user_summary ON conditions;
+        CREATE TRIGGER conditions_user_summary
+            AFTER INSERT OR UPDATE OF api_response OR DELETE ON conditions
+            FOR EACH ROW EXECUTE FUNCTION refresh_condition_summary();
+
+        DROP TRIGGER IF EXISTS family_history_user_summary ON family_history;
+        CREATE TRIGGER family_history_user_summary
+            AFTER INSERT OR UPDATE OF api_response OR DELETE ON family_history
+            FOR EACH ROW EXECUTE FUNCTION refresh_family_summary();
+
+        INSERT INTO user_summary (
+            user_id, conditions_total, conditions_active, conditions_inactive,
+            conditions_unknown, condition_status_counts, condition_years
+        )
+        SELECT c.user_id, s.*
+        FROM conditions c CROSS JOIN LATERAL fhir_condition_summary(c.api_response) s
+        WHERE c.user_id IS NOT NULL
+        ON CONFLICT (user_id) DO NOTHING;
+
+        INSERT INTO user_summary (user_id, relatives, relatives_cause_of_death)
+        SELECT f.user_id, s.*
+        FROM family_history f CROSS JOIN LATERAL fhir_family_summary(f.api_response) s
+        WHERE f.user_id IS NOT NULL
+        ON CONFLICT (user_id) DO UPDATE
+        SET relatives = EXCLUDED.relatives,
+            relatives_cause_of_death = EXCLUDED.relatives_cause_of_death;
+    """),
+
+    (12, "Roll up condition and family history facts for cohort analytics", """
+        -- value::jsonb, or NULL if value is not valid JSON
+        CREATE OR REPLACE FUNCTION fhir_try_jsonb(value TEXT)
+        RETURNS JSONB LANGUAGE plpgsql IMMUTABLE PARALLEL SAFE AS $$
+        BEGIN
+            RETURN value::jsonb;
+        EXCEPTION WHEN others THEN
+            RETURN NULL;
+        END
+        $$;
+
+        -- An ICD-10 code upper-cased, with the dot after the category
+        -- ('e119' and 'E11.9' both become 'E11.9')
+        CREATE OR REPLACE FUNCTION fhir_icd10_normalize(code TEXT)
+        RETURNS TEXT LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+            SELECT CASE
+                WHEN length(c) > 3 AND position('.' in c) = 0 THEN left(c, 3) || '.' || substr(c, 4)
+                ELSE c
+            END
+            FROM (SELECT upper(btrim(COALESCE(code, ''))) AS c) x
+        $$;
+
+        -- ICD-10 codes of an element: its code's ICD-10 codings and the
+        -- ICD10CM_CODE of its IMO search data extensions
+        CREATE OR REPLACE FUNCTION fhir_icd10_codes(element JSONB)
+        RETURNS SETOF TEXT LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+            SELECT code FROM (
+                SELECT fhir_icd10_normalize(c->>'code') AS code
+                FROM jsonb_array_elements(CASE WHEN jsonb_typeof(element->'code'->'coding') = 'array'
+                                               THEN element->'code'->'coding' ELSE '[]'::jsonb END) c
+                WHERE position('icd-10' in lower(COALESCE(c->>'system', ''))) > 0
+                   OR position('icd10' in lower(COALESCE(c->>'system', ''))) > 0
+                   OR c->>'system' IN ('urn:oid:2.16.840.1.113883.6.90', 'urn:oid:2.16.840.1.113883.6.3')
+                UNION
+                SELECT fhir_icd10_normalize(fhir_try_jsonb(x->>'valueString')->>'ICD10CM_CODE')
+                FROM jsonb_array_elements(CASE WHEN jsonb_typeof(element->'extension') = 'array'
+                                               THEN element->'extension' ELSE '[]'::jsonb END) x
+                WHERE x->>'url' = 'https://www.healthgorilla.com/fhir/StructureDefinition/imo-core-search-data'
+            ) codes
+            WHERE code <> ''
+        $$;
+
+        -- What one stored document contributes to the cohort rollups, as
+        -- (dimension, context, key, number of entries). For conditions:
+        -- 'conditions' (every condition), 'icd10' and 'icd10_category' (the
+        -- three character category) and 'onset_year'. For family history:
+        -- 'family' (every relative), 'relationship', and
+        -- 'family_icd10_category' with the relationship as context.
+        CREATE OR REPLACE FUNCTION fhir_cohort_facts(kind TEXT, document JSONB)
+        RETURNS TABLE (dimension TEXT, context TEXT, key TEXT, n INTEGER)
+        LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+            WITH r AS (
+                SELECT e.pos, fhir_entry_resource(e.entry) AS resource
+                FROM jsonb_array_elements(fhir_document_entries(document)) WITH ORDINALITY AS e(entry, pos)
+            ), facts AS (
+                SELECT r.pos, 'conditions' AS dimension, '' AS context, '' AS key
+                FROM r WHERE kind = 'conditions'
+                UNION ALL
+                SELECT r.pos, 'onset_year', '', left(fhir_date(COALESCE(
+                    r.resource->>'onsetDateTime', r.resource->'onsetPeriod'->>'start',
+                    r.resource->>'assertedDate', r.resource->>'recordedDate')), 4)
+                FROM r WHERE kind = 'conditions'
+                UNION ALL
+                SELECT r.pos, d.dimension, '', d.key
+                FROM r
+                CROSS JOIN LATERAL fhir_icd10_codes(r.resource) code
+                CROSS JOIN LATERAL (VALUES ('icd10', code), ('icd10_category', left(code, 3))) d(dimension, key)
+                WHERE kind = 'conditions'
+                UNION ALL
+                SELECT r.pos, 'family', '', ''
+                FROM r WHERE kind = 'family_history'
+                UNION ALL
+                SELECT r.pos, 'relationship', '', fhir_normalize_text(fhir_codeable_text(r.resource->'relationship'))
+                FROM r WHERE kind = 'family_history'
+                UNION ALL
+                SELECT r.pos, 'family_icd10_category',
+                       fhir_normalize_text(fhir_codeable_text(r.resource->'relationship')), left(code, 3)
+                FROM r
+                CROSS JOIN LATERAL jsonb_array_elements(CASE WHEN jsonb_typeof(r.resource->'condition') = 'array'
+                                                             THEN r.resource->'condition' ELSE '[]'::jsonb END) c
+                CROSS JOIN LATERAL fhir_icd10_codes(c) code
+                WHERE kind = 'family_history'
+            )
+            SELECT f.dimension, f.context, f.key, count(DISTINCT f.pos)::integer
+            FROM facts f
+            JOIN r ON r.pos = f.pos AND r.resource <> '{}'::jsonb
+            WHERE f.dimension IN ('conditions', 'family')
+               OR (f.key <> '' AND (f.dimension <> 'family_icd10_category' OR f.context <> ''))
+            GROUP BY f.dimension, f.context, f.key
+        $$;
+
+        -- Each user's facts, kept in step by triggers; kind is the table.
+        -- No foreign key: when a user is deleted the cascaded delete of
+        -- their documents must still find these rows to subtract them.
+        CREATE TABLE IF NOT EXISTS cohort_facts (
+            user_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            dimension TEXT NOT NULL,
+            context TEXT NOT NULL,
+            key TEXT NOT NULL,
+            n INTEGER NOT NULL,
+            PRIMARY KEY (user_id, kind, dimension, context, key)
+        );
+        -- Code prefix lookups ('E11.6*') scan a range of keys in byte order
+        CREATE INDEX IF NOT EXISTS cohort_facts_key_idx
+            ON cohort_facts (dimension, key COLLATE "C", user_id);
+
+        -- Users and entries per (dimension, context, key) across all users
+        CREATE TABLE IF NOT EXISTS cohort_rollups (
+            dimension TEXT NOT NULL,
+            key TEXT NOT NULL,
+            context TEXT NOT NULL,
+            users INTEGER NOT NULL,
+            total INTEGER NOT NULL,
+            refreshed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (dimension, key, context)
+        );
+
+        -- Changes to cohort_rollups not applied yet. Writers only append,
+        -- so they never wait on each other for a popular key.
+        CREATE TABLE IF NOT EXISTS cohort_rollup_deltas (
+            dimension TEXT NOT NULL,
+            context TEXT NOT NULL,
+            key TEXT NOT NULL,
+            users INTEGER NOT NULL,
+            total INTEGER NOT NULL
+        );
+
+        -- Diffs a written document's facts against the stored ones, updates
+        -- cohort_facts and queues the difference for the rollups
+        CREATE OR REPLACE FUNCTION sync_cohort_facts()
+        RETURNS TRIGGER LANGUAGE plpgsql AS $$
+        DECLARE
+            changed_user INTEGER;
+            document JSONB;
+        BEGIN
+            IF TG_OP = 'DELETE' THEN
+                changed_user := OLD.user_id;
+                document := '[]'::jsonb;
+            ELSE
+                changed_user := NEW.user_id;
+                document := NEW.api_response;
+            END IF;
+            IF changed_user IS NULL THEN
+                RETURN NULL;
+            END IF;
+            WITH new_facts AS (
+                SELECT * FROM fhir_cohort_facts(TG_ARGV[0], document)
+            ), old_facts AS (
+                SELECT f.dimension, f.context, f.key, f.n
+                FROM cohort_facts f
+                WHERE f.user_id = changed_user AND f.kind = TG_ARGV[0]
+            ), changes AS (
+                SELECT COALESCE(nf.dimension, o.dimension) AS dimension,
+                       COALESCE(nf.context, o.context) AS context,
+                       COALESCE(nf.key, o.key) AS key,
+                       nf.n AS new_n,
+                       (nf.n IS NOT NULL)::integer - (o.n IS NOT NULL)::integer AS users,
+                       COALESCE(nf.n, 0) - COALESCE(o.n, 0) AS total
+                FROM new_facts nf
+                FULL JOIN old_facts o
+                    ON o.dimension = nf.dimension AND o.context = nf.context AND o.key = nf.key
+                WHERE nf.n IS DISTINCT FROM o.n
+            ), removed AS (
+                DELETE FROM cohort_facts f
+                USING changes c
+                WHERE f.user_id = changed_user AND f.kind = TG_ARGV[0]
+                  AND f.dimension = c.dimension AND f.context = c.context AND f.key = c.key
+                  AND c.new_n IS NULL
+            ), upserted AS (
+                INSERT INTO cohort_facts (user_id, kind, dimension, context, key, n)
+                SELECT changed_user, TG_ARGV[0], c.dimension, c.context, c.key, c.new_n
+                FROM changes c
+                WHERE c.new_n IS NOT NULL
+                ON CONFLICT (user_id, kind, dimension, context, key) DO UPDATE SET n = EXCLUDED.n
+            )
+            INSERT INTO cohort_rollup_deltas (dimension, context, key, users, total)
+            SELECT c.dimension, c.context, c.key, c.users, c.total FROM changes c;
+            RETURN NULL;
+        END
+        $$;
+
+        -- Applies the queued deltas to cohort_rollups and returns how many
+        -- rollup rows changed. Only deltas committed before the call are
+        -- taken; later ones wait for the next refresh.
+        CREATE OR REPLACE FUNCTION refresh_cohort_rollups()
+        RETURNS INTEGER LANGUAGE plpgsql AS $$
+        DECLARE
+            applied INTEGER;
+        BEGIN
+            -- One refresh at a time; a concurrent one has nothing left to apply
+            IF NOT pg_try_advisory_xact_lock(hashtext('refresh_cohort_rollups')) THEN
+                RETURN 0;
+            END IF;
+            WITH taken AS (
+                DELETE FROM cohort_rollup_deltas RETURNING dimension, context, key, users, total
+            )
+            INSERT INTO cohort_rollups AS r (dimension, key, context, users, total)
+            SELECT dimension, key, context, sum(users), sum(total)
+            FROM taken
+            GROUP BY dimension, key, context
+            ON CONFLICT (dimension, key, context) DO UPDATE
+            SET users = r.users + EXCLUDED.users,
+                total = r.total + EXCLUDED.total,
+                refreshed_at = CURRENT_TIMESTAMP;
+            GET DIAGNOSTICS applied = ROW_COUNT;
+            IF applied > 0 THEN
+                DELETE FROM cohort_rollups WHERE users <= 0;
+            END IF;
+            RETURN applied;
+        END
+        $$;
+
+        DROP TRIGGER IF EXISTS conditions_cohort_facts ON conditions;
+        CREATE TRIGGER conditions_cohort_facts
+            AFTER INSERT OR UPDATE OF api_response OR DELETE ON conditions
+            FOR EACH ROW EXECUTE FUNCTION sync_cohort_facts('conditions');
+
+        DROP TRIGGER IF EXISTS family_history_cohort_facts ON family_history;
+        CREATE TRIGGER family_history_cohort_facts
+            AFTER INSERT OR UPDATE OF api_response OR DELETE ON family_history
+            FOR EACH ROW EXECUTE FUNCTION sync_cohort_facts('family_history');
+
+        INSERT INTO cohort_facts (user_id, kind, dimension, context, key, n)
+        SELECT t.user_id, 'conditions', f.dimension, f.context, f.key, f.n
+        FROM conditions t CROSS JOIN LATERAL fhir_cohort_facts('conditions', t.api_response) f
+        WHERE t.user_id IS NOT NULL
+        ON CONFLICT DO NOTHING;
+
+        INSERT INTO cohort_facts (user_id, kind, dimension, context, key, n)
+        SELECT t.user_id, 'family_history', f.dimension, f.context, f.key, f.n
+        FROM family_history t CROSS JOIN LATERAL fhir_cohort_facts('family_history', t.api_response) f
+        WHERE t.user_id IS NOT NULL
+        ON CONFLICT DO NOTHING;
+
+        INSERT INTO cohort_rollups (dimension, key, context, users, total)
+        SELECT dimension, key, context, count(*), sum(n)
+        FROM cohort_facts
+        GROUP BY dimension, key, context
+        ON CONFLICT (dimension, key, context) DO NOTHING;
+    """),
+
+    (13, "Tell apart relatives who share a relationship, gender and birth date", """
+        -- Identity of a family member: relationship, gender, birth date, name
+        -- and their conditions, so two brothers without a birth date are
+        -- two relatives
+        CREATE OR REPLACE FUNCTION fhir_family_member_fingerprint(resource JSONB)
+        RETURNS TEXT LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+            SELECT md5(concat_ws(chr(31),
+                fhir_concept_key(resource->'relationship'),
+                fhir_normalize_text(resource->>'gender'),
+                fhir_date(resource->>'bornDate'),
+                fhir_normalize_text(resource->>'name'),
+                COALESCE((
+                    SELECT string_agg(k, chr(30) ORDER BY k)
+                    FROM jsonb_array_elements(CASE WHEN jsonb_typeof(resource->'condition') = 'array'
+                                                   THEN resource->'condition' ELSE '[]'::jsonb END) c
+                    CROSS JOIN LATERAL fhir_concept_key(c->'code') k
+                ), '')))
+        $$;
+
+        DELETE FROM entry_fingerprints WHERE kind = 'family_history';
+        INSERT INTO entry_fingerprints (user_id, kind, fingerprint)
+        SELECT DISTINCT t.user_id, 'family_history', fhir_entry_fingerprint('family_history', e)
+        FROM family_history t, jsonb_array_elements(fhir_document_entries(t.api_response)) e
+        WHERE t.user_id IS NOT NULL
+        ON CONFLICT DO NOTHING;
+    """),
+
+    (14, "Keep one row per document entry for paging", """
+        -- Key of an entry within its document: its resource id (every entry
+        -- written by the app has one), else a hash of the entry
+        CREATE OR REPLACE FUNCTION fhir_entry_key(entry JSONB)
+        RETURNS TEXT LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+            SELECT COALESCE(entry->'resource'->>'id', entry->>'id', md5(entry::text))
+        $$;
+
+        -- Date pages are sorted on, newest first; '' (undated) sorts last.
+        -- Conditions: recorded date, else onset date. Family members:
+        -- recorded date, else birth date.
+        CREATE OR REPLACE FUNCTION fhir_entry_sort_date(kind TEXT, entry JSONB)
+        RETURNS TEXT LANGUAGE sql IMMUTABLE PARALLEL SAFE AS $$
+            SELECT CASE kind
+                WHEN 'conditions' THEN COALESCE(
+                    NULLIF(fhir_date(fhir_entry_resource(entry)->>'assertedDate'), ''),
+                    NULLIF(fhir_date(fhir_entry_resource(entry)->'onsetPeriod'->>'start'), ''),
+                    fhir_date(fhir_entry_resource(entry)->>'onsetDateTime'))
+                ELSE COALESCE(
+                    NULLIF(fhir_date(fhir_entry_resource(entry)->>'date'), ''),
+                    fhir_date(fhir_entry_resource(entry)->>'bornDate'))
+            END
+        $$;
+
+        -- The entries of each user's stored documents; kind is the
+        -- document's table. seq is assigned when an entry is first seen,
+        -- so it keeps the order entries were added in, and (sort_date, seq)
+        -- stays a valid page cursor when other entries are replaced or
+        -- deleted.
+        CREATE TABLE IF NOT EXISTS document_entries (
+            user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+            kind TEXT NOT NULL,
+            entry_id TEXT NOT NULL,
+            seq BIGINT GENERATED ALWAYS AS IDENTITY,
+            sort_date TEXT NOT NULL,
+            entry JSONB NOT NULL,
+            PRIMARY KEY (user_id, kind, entry_id)
+        );
+
+        CREATE INDEX IF NOT EXISTS idx_document_entries_page
+            ON document_entries (user_id, kind, sort_date DESC, seq DESC);
+
+        -- Keeps document_entries in step with every write to a document;
+        -- entries that did not change are left alone
+        CREATE OR REPLACE FUNCTION sync_document_entries()
+        RETURNS TRIGGER LANGUAGE plpgsql AS $$
+        BEGIN
+            IF TG_OP = 'DELETE' THEN
+                DELETE FROM document_entries
+                WHERE user_id = OLD.user_id AND kind = TG_ARGV[0];
+                RETURN NULL;
+            END IF;
+            IF NEW.user_id IS NULL THEN
+                RETURN NULL;
+            END IF;
+            IF TG_OP = 'UPDATE' THEN
+                DELETE FROM document_entries d
+                WHERE d.user_id = NEW.user_id AND d.kind = TG_ARGV[0]
+                  AND d.entry_id NOT IN (
+                      SELECT fhir_entry_key(e)
+                      FROM jsonb_array_elements(fhir_document_entries(NEW.api_response)) e);
+            END IF;
+            INSERT INTO document_entries (user_id, kind, entry_id, sort_date, entry)
+            SELECT NEW.user_id, TG_ARGV[0], k.entry_id, fhir_entry_sort_date(TG_ARGV[0], k.entry), k.entry
+            FROM (
+                SELECT DISTINCT ON (fhir_entry_key(e.entry))
+                       fhir_entry_key(e.entry) AS entry_id, e.entry, e.pos
+                FROM jsonb_array_elements(fhir_document_entries(NEW.api_response))
+                    WITH ORDINALITY AS e(entry, pos)
+                WHERE fhir_entry_resource(e.entry) <> '{}'::jsonb
+                ORDER BY fhir_entry_key(e.entry), e.pos
+            ) k
+            ORDER BY k.pos
+            ON CONFLICT (user_id, kind, entry_id) DO UPDATE
+            SET entry = EXCLUDED.entry,
+                sort_date = EXCLUDED.sort_date
+            WHERE document_entries.entry IS DISTINCT FROM EXCLUDED.entry;
+            RETURN NULL;
+        END
+        $$;
+
+        DROP TRIGGER IF EXISTS conditions_document_entries ON conditions;
+        CREATE TRIGGER conditions_document_entries
+            AFTER INSERT OR UPDATE OF api_response OR DELETE ON conditions
+            FOR EACH ROW EXECUTE FUNCTION sync_document_entries('conditions');
+
+        DROP TRIGGER IF EXISTS family_history_document_entries ON family_history;
+        CREATE TRIGGER family_history_document_entries
+            AFTER INSERT OR UPDATE OF api_response OR DELETE ON family_history
+            FOR EACH ROW EXECUTE FUNCTION sync_document_entries('family_history');
+
+        INSERT INTO document_entries (user_id, kind, entry_id, sort_date, entry)
+        SELECT user_id, kind, entry_id, fhir_entry_sort_date(kind, entry), entry
+        FROM (
+            SELECT DISTINCT ON (t.user_id, t.kind, fhir_entry_key(e.entry))
+                   t.user_id, t.kind, fhir_entry_key(e.entry) AS entry_id, e.entry, e.pos
+            FROM (
+                SELECT user_id, 'conditions' AS kind, api_response FROM conditions
+                UNION ALL
+                SELECT user_id, 'family_history', api_response FROM family_history
+            ) t
+            CROSS JOIN LATERAL jsonb_array_elements(fhir_document_entries(t.api_response))
+                WITH ORDINALITY AS e(entry, pos)
+            WHERE t.user_id IS NOT NULL AND fhir_entry_resource(e.entry) <> '{}'::jsonb
+            ORDER BY t.user_id, t.kind, fhir_entry_key(e.entry), e.pos
+        ) k
+        ORDER BY user_id, kind, pos
+        ON CONFLICT DO NOTHING;
+    """),
+
+    (15, "Keep the derived tables from one trigger per document table", """
+        -- Brings every table derived from a user's document (fingerprints,
+        -- condition names, document entries, summary, cohort facts) in
+        -- line with its entries. keep_summary is false when the user
+        -- itself is being deleted.
+        CREATE OR REPLACE FUNCTION sync_document_derived_full(
+            doc_kind TEXT, doc_user INTEGER, doc_entries JSONB, keep_summary BOOLEAN)
+        RETURNS VOID LANGUAGE plpgsql AS $$
+        BEGIN
+            WITH current AS (
+                SELECT DISTINCT fhir_entry_fingerprint(doc_kind, e) AS fingerprint
+                FROM jsonb_array_elements(doc_entries) e
+            ), removed AS (
+                DELETE FROM entry_fingerprints f
+                WHERE f.user_id = doc_user AND f.kind = doc_kind
+                  AND f.fingerprint NOT IN (SELECT fingerprint FROM current)
+            )
+            INSERT INTO entry_fingerprints (user_id, kind, fingerprint)
+            SELECT doc_user, doc_kind, fingerprint FROM current
+            ON CONFLICT DO NOTHING;
+
+            WITH current AS (
+                SELECT DISTINCT ON (c.context, c.name) c.context, c.name, c.display
+                FROM jsonb_array_elements(doc_entries) e, fhir_entry_condition_names(doc_kind, e) c
+                WHERE c.name <> ''
+            ), removed AS (
+                DELETE FROM entry_condition_names n
+                WHERE n.user_id = doc_user AND n.kind = doc_kind
+                  AND (n.context, n.name) NOT IN (SELECT context, name FROM current)
+            )
+            INSERT INTO entry_condition_names (user_id, kind, context, name, display)
+            SELECT doc_user, doc_kind, context, name, display FROM current
+            ON CONFLICT DO NOTHING;
+
+            WITH current AS (
+                SELECT DISTINCT ON (fhir_entry_key(e.entry))
+                       fhir_entry_key(e.entry) AS entry_id, e.entry, e.pos
+                FROM jsonb_array_elements(doc_entries) WITH ORDINALITY AS e(entry, pos)
+                WHERE fhir_entry_resource(e.entry) <> '{}'::jsonb
+                ORDER BY fhir_entry_key(e.entry), e.pos
+            ), removed AS (
+                DELETE FROM document_entries d
+                WHERE d.user_id = doc_user AND d.kind = doc_kind
+                  AND d.entry_id NOT IN (SELECT entry_id FROM current)
+            )
+            INSERT INTO document_entries (user_id, kind, entry_id, sort_date, entry)
+            SELECT doc_user, doc_kind, entry_id, fhir_entry_sort_date(doc_kind, entry), entry
+            FROM current
+            ORDER BY pos
+            ON CONFLICT (user_id, kind, entry_id) DO UPDATE
+            SET entry = EXCLUDED.entry,
+                sort_date = EXCLUDED.sort_date
+            WHERE document_entries.entry IS DISTINCT FROM EXCLUDED.entry;
+
+            IF keep_summary AND doc_kind = 'conditions' THEN
+                INSERT INTO user_summary (
+                    user_id, conditions_total, conditions_active, conditions_inactive,
+                    conditions_unknown, condition_status_counts, condition_years
+                )
+                SELECT doc_user, s.* FROM fhir_condition_summary(doc_entries) s
+                ON CONFLICT (user_id) DO UPDATE
+                SET conditions_total = EXCLUDED.conditions_total,
+                    conditions_active = EXCLUDED.conditions_active,
+                    conditions_inactive = EXCLUDED.conditions_inactive,
+                    conditions_unknown = EXCLUDED.conditions_unknown,
+                    condition_status_counts = EXCLUDED.condition_status_counts,
+                    condition_years = EXCLUDED.condition_years,
+                    updated_at = CURRENT_TIMESTAMP;
+            ELSIF keep_summary THEN
+                INSERT INTO user_summary (user_id, relatives, relatives_cause_of_death)
+                SELECT doc_user, s.* FROM fhir_family_summary(doc_entries) s
+                ON CONFLICT (user_id) DO UPDATE
+                SET relatives = EXCLUDED.relatives,
+                    relatives_cause_of_death = EXCLUDED.relatives_cause_of_death,
+                    updated_at = CURRENT_TIMESTAMP;
+            END IF;
+
+            WITH new_facts AS (
+                SELECT * FROM fhir_cohort_facts(doc_kind, doc_entries)
+            ), old_facts AS (
+                SELECT f.dimension, f.context, f.key, f.n
+                FROM cohort_facts f
+                WHERE f.user_id = doc_user AND f.kind = doc_kind
+            ), changes AS (
+                SELECT COALESCE(nf.dimension, o.dimension) AS dimension,
+                       COALESCE(nf.context, o.context) AS context,
+                       COALESCE(nf.key, o.key) AS key,
+                       nf.n AS new_n,
+                       (nf.n IS NOT NULL)::integer - (o.n IS NOT NULL)::integer AS users,
+                       COALESCE(nf.n, 0) - COALESCE(o.n, 0) AS total
+                FROM new_facts nf
+                FULL JOIN old_facts o
+                    ON o.dimension = nf.dimension AND o.context = nf.context AND o.key = nf.key
+                WHERE nf.n IS DISTINCT FROM o.n
+            ), removed AS (
+                DELETE FROM cohort_facts f
+                USING changes c
+                WHERE f.user_id = doc_user AND f.kind = doc_kind
+                  AND f.dimension = c.dimension AND f.context = c.context AND f.key = c.key
+                  AND c.new_n IS NULL
+            ), upserted AS (
+                INSERT INTO cohort_facts (user_id, kind, dimension, context, key, n)
+                SELECT doc_user, doc_kind, c.dimension, c.context, c.key, c.new_n
+                FROM changes c
+                WHERE c.new_n IS NOT NULL
+                ON CONFLICT (user_id, kind, dimension, context, key) DO UPDATE SET n = EXCLUDED.n
+            )
+            INSERT INTO cohort_rollup_deltas (dimension, context, key, users, total)
+            SELECT c.dimension, c.context, c.key, c.users, c.total FROM changes c;
+        END
+        $$;
+
+        -- Adds entries appended to a user's document to the derived tables.
+        -- Every derived value is a set or a count over entries, so the
+        -- appended entries alone say what changes.
+        CREATE OR REPLACE FUNCTION sync_document_derived_append(
+            doc_kind TEXT, doc_user INTEGER, appended JSONB)
+        RETURNS VOID LANGUAGE plpgsql AS $$
+        BEGIN
+            INSERT INTO entry_fingerprints (user_id, kind, fingerprint)
+            SELECT DISTINCT doc_user, doc_kind, fhir_entry_fingerprint(doc_kind, e)
+            FROM jsonb_array_elements(appended) e
+            ON CONFLICT DO NOTHING;
+
+            INSERT INTO entry_condition_names (user_id, kind, context, name, display)
+            SELECT DISTINCT ON (c.context, c.name) doc_user, doc_kind, c.context, c.name, c.display
+            FROM jsonb_array_elements(appended) e, fhir_entry_condition_names(doc_kind, e) c
+            WHERE c.name <> ''
+            ON CONFLICT DO NOTHING;
+
+            -- An entry whose key is already stored keeps its earlier row
+            INSERT INTO document_entries (user_id, kind, entry_id, sort_date, entry)
+            SELECT doc_user, doc_kind, k.entry_id, fhir_entry_sort_date(doc_kind, k.entry), k.entry
+            FROM (
+                SELECT DISTINCT ON (fhir_entry_key(e.entry))
+                       fhir_entry_key(e.entry) AS entry_id, e.entry, e.pos
+                FROM jsonb_array_elements(appended) WITH ORDINALITY AS e(entry, pos)
+                WHERE fhir_entry_resource(e.entry) <> '{}'::jsonb
+                ORDER BY fhir_entry_key(e.entry), e.pos
+            ) k
+            ORDER BY k.pos
+            ON CONFLICT DO NOTHING;
+
+            IF doc_kind = 'conditions' THEN
+                INSERT INTO user_summary AS u (
+                    user_id, conditions_total, conditions_active, conditions_inactive,
+                    conditions_unknown, condition_status_counts, condition_years
+                )
+                SELECT doc_user, s.* FROM fhir_condition_summary(appended) s
+                ON CONFLICT (user_id) DO UPDATE
+                SET conditions_total = u.conditions_total + EXCLUDED.conditions_total,
+                    conditions_active = u.conditions_active + EXCLUDED.conditions_active,
+                    conditions_inactive = u.conditions_inactive + EXCLUDED.conditions_inactive,
+                    conditions_unknown = u.conditions_unknown + EXCLUDED.conditions_unknown,
+                    condition_status_counts = (
+                        SELECT COALESCE(jsonb_object_agg(status, n), '{}'::jsonb)
+                        FROM (
+                            SELECT key AS status, sum(value::integer) AS n
+                            FROM (SELECT * FROM jsonb_each_text(u.condition_status_counts)
+                                  UNION ALL
+                                  SELECT * FROM jsonb_each_text(EXCLUDED.condition_status_counts)) c
+                            GROUP BY key
+                        ) g),
+                    condition_years = ARRAY(
+                        SELECT DISTINCT y FROM unnest(u.condition_years || EXCLUDED.condition_years) y
+                        ORDER BY y DESC),
+                    updated_at = CURRENT_TIMESTAMP;
+            ELSE
+                INSERT INTO user_summary AS u (user_id, relatives, relatives_cause_of_death)
+                SELECT doc_user, s.* FROM fhir_family_summary(appended) s
+                ON CONFLICT (user_id) DO UPDATE
+                SET relatives = u.relatives + EXCLUDED.relatives,
+                    relatives_cause_of_death = u.relatives_cause_of_death + EXCLUDED.relatives_cause_of_death,
+                    updated_at = CURRENT_TIMESTAMP;
+            END IF;
+
+            WITH added AS (
+                SELECT * FROM fhir_cohort_facts(doc_kind, appended)
+            ), existing AS (
+                SELECT f.dimension, f.context, f.key
+                FROM cohort_facts f
+                JOIN added a ON a.dimension = f.dimension AND a.context = f.context AND a.key = f.key
+                WHERE f.user_id = doc_user AND f.kind = doc_kind
+            ), upserted AS (
+                INSERT INTO cohort_facts AS f (user_id, kind, dimension, context, key, n)
+                SELECT doc_user, doc_kind, a.dimension, a.context, a.key, a.n FROM added a
+                ON CONFLICT (user_id, kind, dimension, context, key) DO UPDATE SET n = f.n + EXCLUDED.n
+            )
+            INSERT INTO cohort_rollup_deltas (dimension, context, key, users, total)
+            SELECT a.dimension, a.context, a.key, (x.key IS NULL)::integer, a.n
+            FROM added a
+            LEFT JOIN existing x ON x.dimension = a.dimension AND x.context = a.context AND x.key = a.key;
+        END
+        $$;
+
+        -- One trigger per document table. The document is read once; when
+        -- a write only appended entries (the old entries are an unchanged
+        -- prefix of the new ones), only those entries are processed.
+        CREATE OR REPLACE FUNCTION sync_document_derived()
+        RETURNS TRIGGER LANGUAGE plpgsql AS $$
+        DECLARE
+            entries JSONB;
+            old_entries JSONB;
+            old_count INTEGER;
+        BEGIN
+            IF TG_OP = 'DELETE' THEN
+                IF OLD.user_id IS NOT NULL THEN
+                    -- The summary goes with the user when it is deleted (ON DELETE CASCADE)
+                    PERFORM sync_document_derived_full(TG_ARGV[0], OLD.user_id, '[]'::jsonb,
+                                                       EXISTS (SELECT 1 FROM users WHERE id = OLD.user_id));
+                END IF;
+                RETURN NULL;
+            END IF;
+            IF NEW.user_id IS NULL THEN
+                RETURN NULL;
+            END IF;
+            entries := fhir_document_entries(NEW.api_response);
+            IF TG_OP = 'UPDATE' AND OLD.user_id = NEW.user_id THEN
+                old_entries := fhir_document_entries(OLD.api_response);
+                old_count := jsonb_array_length(old_entries);
+                IF old_count > 0 AND jsonb_array_length(entries) >= old_count
+                   AND jsonb_path_query_array(entries, format('$[0 to %s]', old_count - 1)::jsonpath)
+                       = old_entries THEN
+                    IF jsonb_array_length(entries) > old_count THEN
+                        PERFORM sync_document_derived_append(TG_ARGV[0], NEW.user_id,
+                            jsonb_path_query_array(entries, format('$[%s to last]', old_count)::jsonpath));
+                    END IF;
+                    RETURN NULL;
+                END IF;
+            END IF;
+            PERFORM sync_document_derived_full(TG_ARGV[0], NEW.user_id, entries, true);
+            RETURN NULL;
+        END
+        $$;
+
+        DROP TRIGGER IF EXISTS conditions_entry_fingerprints ON conditions;
+        DROP TRIGGER IF EXISTS conditions_entry_condition_names ON conditions;
+        DROP TRIGGER IF EXISTS conditions_user_summary ON conditions;
+        DROP TRIGGER IF EXISTS conditions_cohort_facts ON conditions;
+        DROP TRIGGER IF EXISTS conditions_document_entries ON conditions;
+        DROP TRIGGER IF EXISTS family_history_entry_fingerprints ON family_history;
+        DROP TRIGGER IF EXISTS family_history_entry_condition_names ON family_history;
+        DROP TRIGGER IF EXISTS family_history_user_summary ON family_history;
+        DROP TRIGGER IF EXISTS family_history_cohort_facts ON family_history;
+        DROP TRIGGER IF EXISTS family_history_document_entries ON family_history;
+        DROP FUNCTION IF EXISTS sync_entry_fingerprints();
+        DROP FUNCTION IF EXISTS sync_entry_condition_names();
+        DROP FUNCTION IF EXISTS refresh_condition_summary();
+        DROP FUNCTION IF EXISTS refresh_family_summary();
+        DROP FUNCTION IF EXISTS sync_cohort_facts();
+        DROP FUNCTION IF EXISTS sync_document_entries();
+
+        DROP TRIGGER IF EXISTS conditions_derived ON conditions;
+        CREATE TRIGGER conditions_derived
+            AFTER INSERT OR UPDATE OF api_response OR DELETE ON conditions
+            FOR EACH ROW EXECUTE FUNCTION sync_document_derived('conditions');
+
+        DROP TRIGGER IF EXISTS family_history_derived ON family_history;
+        CREATE TRIGGER family_history_derived
+            AFTER INSERT OR UPDATE OF api_response OR DELETE ON family_history
+            FOR EACH ROW EXECUTE FUNCTION sync_document_derived('family_history');
+    """),
+]
+
+
+def get_schema_version(conn):
+    """
+    Get the highest applied migration version (0 for a fresh database)
+    """
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+        return cur.fetchone()[0]
+    finally:
+        cur.close()
+
+
+def run_migrations(conn):
+    """
+    Apply all pending migrations in order.
+    Returns the list of versions that were applied.
+    """
+    applied = []
+    cur = conn.cursor()
+    try:
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                description TEXT NOT NULL,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        conn.commit()
+
+        cur.execute("SELECT pg_advisory_lock(%s)", (MIGRATION_LOCK_ID,))
+        try:
+            current = get_schema_version(conn)
+            conn.commit()
+            for version, description, sql in sorted(MIGRATIONS):
+                if version <= current:
+                    continue
+                try:
+                    cur.execute(sql)
+                    cur.execute(
+                        "INSERT INTO schema_version (version, description) VALUES (%s, %s)",
+                        (version, description)
+                    )
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+                applied.append(version)
+        finally:
+            cur.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_ID,))
+            conn.commit()
+    finally:
+        cur.close()
+    return applied
@@ -1,5 +1,5 @@
 import streamlit as st
-from database import get_profile_by_user_id, get_all_user_data
+from database import get_profile_by_user_id, get_user_summary, get_all_user_data, get_all_user_data_json
 import json
 import requests
 import os
@@ -273,6 +273,18 @@ def show_dashboard():
                 st.write(f"- {line}")
             st.write(f"{address.get('city', '')}, {address.get('state', '')} {address.get('postalCode', '')}")
     
+    # Health summary, read from the user's summary row in one lookup
+    summary = get_user_summary(st.session_state.user_id)
+    if summary:
+        st.subheader("Health Summary")
+        col1, col2, col3, col4 = st.columns(4)
+        col1.metric("Conditions", summary['conditions_total'])
+        col2.metric("Active", summary['conditions_active'])
+        col3.metric("Inactive", summary['conditions_inactive'])
+        col4.metric("Relatives Recorded", summary['relatives'])
+        if summary['condition_years']:
+            st.caption(f"Conditions recorded from {summary['condition_years'][-1]} to {summary['condition_years'][0]}")
+    
     # Navigation buttons
     col1, col2, col3 = st.columns(3)
     with col1:
@@ -798,11 +810,10 @@ def main():
                 st.switch_page("pages/6_FamilyHistory.py")
         with col4:
             if st.button("Download Profile", key="download_profile", use_container_width=True):
-                # Get all user data
-                user_data = get_all_user_data(st.session_state.user_id)
-                if user_data:
-                    # Convert to JSON string
-                    json_str = json.dumps(user_data, indent=2)
+                # Get all user data as a JSON document built by the database,
+                # indented as the download has always been
+                json_str = get_all_user_data_json(st.session_state.user_id, indent=2)
+                if json_str:
                     # Create download button
                     st.download_button(
                         label="Download Profile Data",
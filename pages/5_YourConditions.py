@@ -3,7 +3,7 @@ import requests
 import os
 import json
 from dotenv import load_dotenv
-from database import get_profile_by_user_id, save_conditions, get_conditions_by_user_id, check_and_init_db, check_duplicate_condition
+from database import get_profile_by_user_id, append_new_conditions, find_similar_conditions, get_conditions_by_user_id, init_db, session, get_condition_years, get_conditions_page, get_condition_status_counts, get_user_summary
 from streamlit_mic_recorder import mic_recorder
 import whisper
 import tempfile
@@ -19,8 +19,8 @@ OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
 # Ensure FFmpeg is available to Whisper
 os.environ["PATH"] += os.pathsep + r"C:\Program Files\ffmpeg-master-latest-win64-gpl-shared\ffmpeg-master-latest-win64-gpl-shared\bin"
 
-# Initialize database if needed
-check_and_init_db()
+# Initialize database if needed (runs once per process)
+init_db()
 
 st.set_page_config(
     page_title="TheraCare - Your Conditions",
@@ -276,25 +276,20 @@ def show_imported_conditions():
             # Add save button with duplicate checking
             if st.button("Save Conditions to Database", type="primary"):
                 with st.spinner("Saving conditions..."):
-                    # Check for duplicates
-                    duplicates = []
-                    non_duplicates = []
-                    for condition in conditions:
-                        if check_duplicate_condition(st.session_state.user_id, condition):
-                            duplicates.append(condition)
-                        else:
-                            non_duplicates.append(condition)
-                    
-                    if duplicates:
-                        st.warning(f"Found {len(duplicates)} duplicate conditions. They will not be added again.")
+                    # Append only the conditions that are not saved yet; a
+                    # concurrent save is merged rather than overwritten
+                    result = append_new_conditions(st.session_state.user_id, st.session_state.gorilla_id, conditions)
                     
-                    if non_duplicates:
-                        if save_conditions(st.session_state.user_id, st.session_state.gorilla_id, non_duplicates):
+                    if result is None:
+                        st.error("Failed to save conditions. Please try again.")
+                    else:
+                        duplicates, non_duplicates = result
+                        if duplicates:
+                            st.warning(f"Found {len(duplicates)} duplicate conditions. They will not be added again.")
+                        if non_duplicates:
                             st.success("Successfully saved new conditions to your profile!")
                         else:
-                            st.error("Failed to save conditions. Please try again.")
-                    else:
-                        st.info("No new conditions to save.")
+                            st.info("No new conditions to save.")
         else:
             st.info("No conditions found in your health record.")
     else:
@@ -533,8 +528,10 @@ def show_manual_conditions_form():
     if not audio_data or not audio_data['bytes']:
         st.session_state.processed_audio = False
     
-    # Get existing conditions if any
-    existing_conditions = get_conditions_by_user_id(st.session_state.user_id)
+    # Get existing conditions and the profile on one connection
+    with session():
+        existing_conditions = get_conditions_by_user_id(st.session_state.user_id)
+        profile = get_profile_by_user_id(st.session_state.user_id)
     saved_conditions = existing_conditions.get('api_response', {}) if existing_conditions else {'entry': []}
     
     # Debug section to show raw JSON data
@@ -550,7 +547,6 @@ def show_manual_conditions_form():
         entries = []
     
     # Get Gorilla ID from profile if it exists, otherwise use a default value
-    profile = get_profile_by_user_id(st.session_state.user_id)
     gorilla_id = profile.get('gorilla_id') if profile else f"MANUAL_{st.session_state.user_id}"
     
     # Form for adding new condition
@@ -587,6 +583,8 @@ def show_manual_conditions_form():
             value=st.session_state.get('onset_date', None)
         )
         
+        save_anyway = st.checkbox("Save even if a similar condition is already recorded")
+        
         submitted = st.form_submit_button("Add Condition")
         if submitted:
             if condition_name:
@@ -633,173 +631,107 @@ def show_manual_conditions_form():
                     if tokenized_data:
                         new_condition['resource']['tokenized_data'] = tokenized_data
                 
-                # Check for duplicate
-                if check_duplicate_condition(st.session_state.user_id, new_condition):
+                # Look for the same condition saved under another wording
+                similar = [] if save_anyway else find_similar_conditions(st.session_state.user_id, [new_condition])
+                if similar:
+                    names = ", ".join(f"\"{match['existing']}\"" for match in similar)
+                    st.warning(f"You may already have this condition recorded as {names}. "
+                               "Tick \"Save even if a similar condition is already recorded\" to add it anyway.")
+                    return
+                
+                # Skip it if the exact condition is already saved
+                result = append_new_conditions(st.session_state.user_id, gorilla_id, [new_condition])
+                if result and result[0]:
                     st.warning("This condition already exists in your records.")
+                elif result:
+                    st.success(f"Added condition: {condition_name}")
+                    # Clear session state after successful submission
+                    for key in ['condition_name', 'condition_text', 'recorded_date', 'clinical_status', 'category', 'onset_date']:
+                        if key in st.session_state:
+                            del st.session_state[key]
                 else:
-                    # Add to existing conditions
-                    if isinstance(saved_conditions, dict):
-                        if 'entry' not in saved_conditions:
-                            saved_conditions['entry'] = []
-                        saved_conditions['entry'].append(new_condition)
-                    else:
-                        saved_conditions.append(new_condition)
-                    
-                    if save_conditions(st.session_state.user_id, gorilla_id, saved_conditions):
-                        st.success(f"Added condition: {condition_name}")
-                        # Clear session state after successful submission
-                        for key in ['condition_name', 'condition_text', 'recorded_date', 'clinical_status', 'category', 'onset_date']:
-                            if key in st.session_state:
-                                del st.session_state[key]
-                    else:
-                        st.error("Failed to save condition. Please try again.")
+                    st.error("Failed to save condition. Please try again.")
             else:
                 st.error("Please enter a condition name")
 
+# Saved conditions fetched per "Load more" click
+SAVED_PAGE_SIZE = 25
+
+def load_more_conditions(page, statuses, year):
+    """
+    Fetch the next page of saved conditions for one status group
+    """
+    rows, cursor = get_conditions_page(
+        st.session_state.user_id,
+        status=statuses,
+        year=year,
+        cursor=page['cursor'],
+        limit=SAVED_PAGE_SIZE
+    )
+    page['rows'].extend(rows)
+    page['cursor'] = cursor
+
 def show_saved_conditions():
     """
     Display conditions that have been saved to the database
     """
     st.subheader("Your Saved Conditions")
     
-    # Get saved conditions from database
-    existing_conditions = get_conditions_by_user_id(st.session_state.user_id)
-    if not existing_conditions or not existing_conditions.get('api_response'):
-        st.info("No conditions have been saved yet.")
-        return
-    
-    saved_conditions = existing_conditions['api_response']
-    
-    if not saved_conditions:
-        st.info("No conditions have been saved yet.")
-        return
-    
-    # Ensure saved_conditions is a list of entries
-    if isinstance(saved_conditions, dict) and 'entry' in saved_conditions:
-        entries = saved_conditions['entry']
-    elif isinstance(saved_conditions, list):
-        entries = saved_conditions
-    else:
-        st.error("Invalid data format in saved conditions")
-        return
-    
-    # Organize conditions by status
-    active_conditions = []
-    inactive_conditions = []
-    unknown_conditions = []
-    
-    for entry in entries:
-        # Ensure entry is a dictionary
-        if not isinstance(entry, dict):
-            continue
-            
-        # Get the resource, handling both direct resource and nested resource cases
-        resource = entry.get('resource', {}) if isinstance(entry.get('resource'), dict) else entry
-        
-        if not resource:
-            continue
-        
-        # Extract condition details with safe access
-        code = resource.get('code', {})
-        condition_name = code.get('text', '')
-        if not condition_name and isinstance(code.get('coding'), list) and code.get('coding'):
-            coding = code['coding'][0]
-            condition_name = coding.get('display', 'Unknown Condition')
-        
-        recorded_date = resource.get('assertedDate', '')
-        if recorded_date:
-            recorded_date = recorded_date.split('T')[0]
-        
-        # Extract clinical status properly
-        clinical_status = 'unknown'
-        clinical_status_obj = resource.get('clinicalStatus', {})
-        if isinstance(clinical_status_obj, dict):
-            coding = clinical_status_obj.get('coding', [{}])[0]
-            if isinstance(coding, dict):
-                clinical_status = coding.get('code', 'unknown')
-        elif isinstance(clinical_status_obj, str):
-            clinical_status = clinical_status_obj.lower()
-        
-        # Get onset date if available
-        onset_period = resource.get('onsetPeriod', {})
-        onset_date = onset_period.get('start', '') if isinstance(onset_period, dict) else ''
-        if onset_date:
-            onset_date = onset_date.split('T')[0]
-        
-        # Get category if available
-        category = ''
-        category_obj = resource.get('category', [{}])[0] if isinstance(resource.get('category'), list) else {}
-        if isinstance(category_obj, dict):
-            category_coding = category_obj.get('coding', [{}])[0] if isinstance(category_obj.get('coding'), list) else {}
-            category = category_coding.get('display', '')
-        
-        # Get condition text if available
-        condition_text = ''
-        text_obj = resource.get('text', {})
-        if isinstance(text_obj, dict):
-            condition_text = text_obj.get('div', '')
-            if condition_text:
-                # Remove HTML tags
-                import re
-                condition_text = re.sub('<[^<]+?>', '', condition_text)
-        
-        condition_data = {
-            'name': condition_name,
-            'text': condition_text,
-            'recorded_date': recorded_date,
-            'status': clinical_status,
-            'category': category,
-            'onset_date': onset_date
-        }
-        
-        if clinical_status == 'active':
-            active_conditions.append(condition_data)
-        elif clinical_status == 'inactive':
-            inactive_conditions.append(condition_data)
+    # Filtering, ordering and paging happen in the database; only one page
+    # of the fields the cards show comes back at a time
+    selected_year = st.session_state.get("saved_year_filter", "All Years")
+    year = None if selected_year == "All Years" else selected_year
+    with session():
+        # The unfiltered counts and the years come from the user's summary row
+        summary = get_user_summary(st.session_state.user_id)
+        if summary and year is None:
+            counts = summary['condition_status_counts']
         else:
-            unknown_conditions.append(condition_data)
+            counts = get_condition_status_counts(st.session_state.user_id, year=year)
+        if not counts and year is None:
+            st.info("No conditions have been saved yet.")
+            return
+        all_years = summary['condition_years'] if summary else get_condition_years(st.session_state.user_id)
+        
+        # Organize conditions by status
+        groups = [
+            ('active', "Active Conditions", ['active'], True),
+            ('inactive', "Inactive Conditions", ['inactive'], False),
+            ('unknown', "Unknown Status Conditions",
+             [status for status in counts if status not in ('active', 'inactive')], False),
+        ]
+        
+        # Start again from the first page when the filter or the saved
+        # conditions change; every write bumps the document's version
+        pages_key = (year, summary['conditions_version'] if summary else None, tuple(sorted(counts.items())))
+        if st.session_state.get('saved_conditions_key') != pages_key:
+            st.session_state.saved_conditions_key = pages_key
+            st.session_state.saved_conditions_pages = {}
+        pages = st.session_state.saved_conditions_pages
+        
+        for group, _, statuses, _ in groups:
+            if group not in pages and any(counts.get(status) for status in statuses):
+                pages[group] = {'rows': [], 'cursor': None}
+                load_more_conditions(pages[group], statuses, year)
     
     # Year filter
-    all_years = sorted(set(
-        condition['recorded_date'].split('-')[0] 
-        for condition in active_conditions + inactive_conditions + unknown_conditions 
-        if condition['recorded_date']
-    ), reverse=True)
-    
-    selected_year = st.selectbox(
+    st.selectbox(
         "Filter by Year",
         ["All Years"] + all_years,
         key="saved_year_filter"
     )
     
-    # Filter conditions by year if selected
-    def filter_by_year(conditions_list):
-        if selected_year == "All Years":
-            return conditions_list
-        return [
-            condition for condition in conditions_list 
-            if condition['recorded_date'] and condition['recorded_date'].startswith(selected_year)
-        ]
-    
-    active_conditions = filter_by_year(active_conditions)
-    inactive_conditions = filter_by_year(inactive_conditions)
-    unknown_conditions = filter_by_year(unknown_conditions)
-    
     # Display conditions in expanders by status
-    if active_conditions:
-        with st.expander(f"Active Conditions ({len(active_conditions)})", expanded=True):
-            for condition in active_conditions:
-                display_condition_card(condition)
-    
-    if inactive_conditions:
-        with st.expander(f"Inactive Conditions ({len(inactive_conditions)})"):
-            for condition in inactive_conditions:
-                display_condition_card(condition)
-    
-    if unknown_conditions:
-        with st.expander(f"Unknown Status Conditions ({len(unknown_conditions)})"):
-            for condition in unknown_conditions:
+    for group, label, statuses, expanded in groups:
+        if group not in pages:
+            continue
+        total = sum(counts.get(status, 0) for status in statuses)
+        with st.expander(f"{label} ({total})", expanded=expanded):
+            for condition in pages[group]['rows']:
                 display_condition_card(condition)
+            if pages[group]['cursor'] and st.button("Load more", key=f"load_more_{group}"):
+                load_more_conditions(pages[group], statuses, year)
+                st.rerun()
 
 def main():
     if not st.session_state.get("logged_in"):
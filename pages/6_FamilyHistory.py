@@ -2,7 +2,7 @@ import streamlit as st
 import requests
 import os
 from dotenv import load_dotenv
-from database import get_profile_by_user_id, save_family_history, get_family_history_by_user_id, check_and_init_db, check_duplicate_family_history
+from database import get_profile_by_user_id, append_family_history_entries, find_similar_family_history, append_new_family_history_entries, get_family_history_page, count_family_history, get_user_summary, session
 import json
 from streamlit_mic_recorder import mic_recorder
 import whisper
@@ -153,26 +153,48 @@ def get_family_history(gorilla_id):
         st.error(f"Error fetching family history: {str(e)}")
         return None
 
+# Saved family members fetched per "Load more" click
+SAVED_PAGE_SIZE = 20
+
+def load_more_history(page):
+    """
+    Fetch the next page of saved family history entries
+    """
+    entries, cursor = get_family_history_page(
+        st.session_state.user_id,
+        cursor=page['cursor'],
+        limit=SAVED_PAGE_SIZE
+    )
+    page['entries'].extend(entries)
+    page['cursor'] = cursor
+
 def show_saved_history():
     """
     Display family history that has been saved to the database
     """
     st.subheader("Your Saved Family History")
     
-    # Get saved history from database
-    existing_history = get_family_history_by_user_id(st.session_state.user_id)
-    if not existing_history or not existing_history.get('api_response'):
-        st.info("No family history has been saved yet.")
-        return
-    
-    saved_history = existing_history['api_response']
+    # Entries are paged in the database, newest first
+    with session():
+        summary = get_user_summary(st.session_state.user_id)
+        total = summary['relatives'] if summary else count_family_history(st.session_state.user_id)
+        if not total:
+            st.info("No family history has been saved yet.")
+            return
+        
+        # Start again from the first page when the saved history changes;
+        # every write bumps the document's version
+        history_key = (summary['family_history_version'] if summary else None, total)
+        if st.session_state.get('saved_history_key') != history_key or 'saved_history_page' not in st.session_state:
+            st.session_state.saved_history_key = history_key
+            st.session_state.saved_history_page = {'entries': [], 'cursor': None}
+            load_more_history(st.session_state.saved_history_page)
+    page = st.session_state.saved_history_page
     
-    if not saved_history or not isinstance(saved_history, dict) or 'entry' not in saved_history:
-        st.info("No family history has been saved yet.")
-        return
+    st.caption(f"Showing {len(page['entries'])} of {total} family members")
     
     # Display history entries
-    for entry in saved_history['entry']:
+    for entry in page['entries']:
         resource = entry.get('resource', {})
         if not resource:
             continue
@@ -252,6 +274,10 @@ def show_saved_history():
                 """, unsafe_allow_html=True)
             
             st.divider()
+    
+    if page['cursor'] and st.button("Load more", key="load_more_history"):
+        load_more_history(page)
+        st.rerun()
 
 def show_imported_history():
     """
@@ -358,32 +384,20 @@ def show_imported_history():
             # Add save button with duplicate checking
             if st.button("Save Family History to Database", type="primary"):
                 with st.spinner("Saving family history..."):
-                    # Check for duplicates
-                    duplicates = []
-                    non_duplicates = []
-                    for entry in history['entry']:
-                        if check_duplicate_family_history(st.session_state.user_id, entry):
-                            duplicates.append(entry)
-                        else:
-                            non_duplicates.append(entry)
+                    # Append only the entries that are not saved yet; a
+                    # concurrent save is merged rather than overwritten
+                    result = append_new_family_history_entries(st.session_state.user_id, st.session_state.gorilla_id, history['entry'])
                     
-                    if duplicates:
-                        st.warning(f"Found {len(duplicates)} duplicate family history entries. They will not be added again.")
-                    
-                    if non_duplicates:
-                        # Create a new bundle with only non-duplicate entries
-                        new_history = {
-                            'resourceType': 'Bundle',
-                            'type': 'searchset',
-                            'entry': non_duplicates
-                        }
-                        
-                        if save_family_history(st.session_state.user_id, st.session_state.gorilla_id, new_history):
+                    if result is None:
+                        st.error("Failed to save family history. Please try again.")
+                    else:
+                        duplicates, non_duplicates = result
+                        if duplicates:
+                            st.warning(f"Found {len(duplicates)} duplicate family history entries. They will not be added again.")
+                        if non_duplicates:
                             st.success("Successfully saved new family history entries to your profile!")
                         else:
-                            st.error("Failed to save family history. Please try again.")
-                    else:
-                        st.info("No new family history entries to save.")
+                            st.info("No new family history entries to save.")
         else:
             st.info("No family history found in your health record.")
     else:
@@ -868,6 +882,8 @@ def show_family_history_form():
         value=st.session_state.form_data.get('notes', '')
     )
     
+    save_anyway = st.checkbox("Save even if a similar condition is already recorded for this relative")
+    
     # Submit button
     if st.button("Add Family History Entry"):
         if relationship and st.session_state.selected_conditions:
@@ -908,6 +924,16 @@ def show_family_history_form():
                     notes=notes
                 )
                 
+                # Look for the same conditions saved for this relative under
+                # another wording
+                similar = [] if save_anyway else find_similar_family_history(st.session_state.user_id, [new_entry])
+                if similar:
+                    st.warning(f"Similar conditions are already recorded for your {relationship.lower()}:")
+                    for match in similar:
+                        st.markdown(f"- {match['name']}: already saved as \"{match['existing']}\"")
+                    st.info("Tick \"Save even if a similar condition is already recorded for this relative\" to add it anyway.")
+                    return
+                
                 # Save to database
                 if save_family_history_entry(new_entry):
                     st.success(f"Added family history entry: {relationship}")
@@ -963,23 +989,8 @@ def create_family_history_entry(relationship, gender, birth_year, conditions, ag
 def save_family_history_entry(new_entry):
     """Save a new family history entry to the database"""
     try:
-        # Get existing history
-        saved_history = get_family_history_by_user_id(st.session_state.user_id)
-        if not saved_history:
-            # Create new history if none exists
-            saved_history = {
-                'api_response': {
-                    'resourceType': 'Bundle',
-                    'type': 'searchset',
-                    'entry': []
-                }
-            }
-        
-        # Add new entry to history
-        saved_history['api_response']['entry'].append(new_entry)
-        
-        # Save to database
-        return save_family_history(st.session_state.user_id, st.session_state.gorilla_id, saved_history['api_response'])
+        # Append the entry in place; the saved history is not read back
+        return append_family_history_entries(st.session_state.user_id, st.session_state.gorilla_id, [new_entry])
     except Exception as e:
         print(f"Error saving family history entry: {str(e)}")
         return False
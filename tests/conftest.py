@@ -0,0 +1,47 @@
+import os
+import sys
+import uuid
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+
+@pytest.fixture(scope='session')
+def database():
+    """
+    The database module, initialized against the DB_* settings. Tests using
+    it are skipped when no database is configured or reachable.
+    """
+    pytest.importorskip('psycopg')
+    pytest.importorskip('dotenv')
+    if not (os.getenv('DB_HOST') or os.getenv('DB_PRIMARY_DSN')):
+        pytest.skip("no database configured (DB_HOST or DB_PRIMARY_DSN)")
+    import database
+    if not database.init_db():
+        pytest.skip("database could not be initialized")
+    return database
+
+
+@pytest.fixture
+def new_user(database):
+    """
+    Create users with unique names and delete them afterwards
+    """
+    created = []
+
+    def create():
+        name = f"test_{uuid.uuid4().hex[:12]}"
+        user_id = database.create_user(name, f"{name}@test.invalid", 'x')
+        assert user_id is not None
+        created.append(user_id)
+        return user_id
+
+    yield create
+    if created:
+        conn = database.get_db_connection()
+        try:
+            conn.execute("DELETE FROM users WHERE id = ANY(%s)", (created,))
+            conn.commit()
+        finally:
+            database.release_db_connection(conn)
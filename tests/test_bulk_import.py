@@ -0,0 +1,52 @@
+import pytest
+
+pytest.importorskip('psycopg')
+pytest.importorskip('dotenv')
+
+from database import _document_entries
+
+
+def condition(name):
+    return {'resource': {'resourceType': 'Condition', 'code': {'text': name}, 'assertedDate': '2021-03-04',
+                         'clinicalStatus': {'coding': [{'code': 'active'}]}}}
+
+
+def relative(code, gender):
+    return {'resource': {'resourceType': 'FamilyMemberHistory', 'gender': gender,
+                         'relationship': {'coding': [{'code': code}]}}}
+
+
+def names(document):
+    return [entry['resource']['code']['text'] for entry in _document_entries(document['api_response'])]
+
+
+def relationships(document):
+    return [entry['resource']['relationship']['coding'][0]['code']
+            for entry in _document_entries(document['api_response'])]
+
+
+def test_reimport_keeps_entries_added_by_the_user(database, new_user):
+    user_id = new_user()
+    conn = database.get_db_connection()
+    try:
+        username = conn.execute("SELECT username FROM users WHERE id = %s", (user_id,)).fetchone()[0]
+    finally:
+        database.release_db_connection(conn)
+    database.save_profile(user_id, 'gorilla-1', {'resourceType': 'Patient', 'id': username})
+    database.save_conditions(user_id, 'gorilla-1', {'entry': [condition('Eczema'), condition('Asthma')]})
+    database.save_family_history(user_id, 'gorilla-1', {'resourceType': 'Bundle', 'entry': [relative('MTH', 'female')]})
+
+    record = {
+        'username': username, 'email': f"{username}@test.invalid", 'password_hash': 'x',
+        'gorilla_id': 'gorilla-1', 'profile_data': {'resourceType': 'Patient', 'id': username},
+        'conditions': [condition('Asthma'), condition('Migraine')],
+        'family_history': [relative('FTH', 'male')]
+    }
+    assert database.bulk_import_users([record]) == {username: user_id}
+    conditions = database.get_conditions_by_user_id(user_id)
+    assert names(conditions) == ['Eczema', 'Asthma', 'Migraine']
+    assert relationships(database.get_family_history_by_user_id(user_id)) == ['MTH', 'FTH']
+
+    # Importing the same patient again adds nothing
+    assert database.bulk_import_users([record]) == {username: user_id}
+    assert database.get_conditions_by_user_id(user_id)['version'] == conditions['version']
@@ -0,0 +1,86 @@
+import pytest
+
+pytest.importorskip('psycopg')
+pytest.importorskip('dotenv')
+
+import cohort_analytics
+
+ICD10 = 'http://hl7.org/fhir/sid/icd-10-cm'
+
+
+@pytest.fixture
+def cohort(database, monkeypatch):
+    monkeypatch.setattr(cohort_analytics, 'REFRESH_INTERVAL', 0)
+    return cohort_analytics
+
+
+def condition(code, onset):
+    return {'resource': {'resourceType': 'Condition', 'code': {'coding': [{'system': ICD10, 'code': code}]},
+                         'onsetPeriod': {'start': onset}, 'clinicalStatus': {'coding': [{'code': 'active'}]}}}
+
+
+@pytest.mark.parametrize('pattern, code', [('e119', 'E11.9'), ('E11.*', 'E11'), ('E11.6*', 'E11.6'), ('J45', 'J45')])
+def test_parse_pattern(pattern, code):
+    assert cohort_analytics._parse_pattern(pattern)[0] == code
+
+
+def test_counts_follow_writes(database, cohort, new_user):
+    before = {pattern: cohort.count_users_with_code(pattern) for pattern in ('E11.*', 'E11.6*', 'E11.9', 'I10')}
+    years = {row['year']: row['conditions'] for row in cohort.get_condition_onset_years()}
+
+    first, second = new_user(), new_user()
+    database.save_conditions(first, 'gorilla', {'entry': [condition('E11.9', '1901-02-03'),
+                                                          condition('E11.65', '1901-05-06')]})
+    database.save_conditions(second, 'gorilla', {'entry': [condition('E11.65', '1901-07-08'),
+                                                           condition('I10', '1902-01-01')]})
+
+    after = {pattern: cohort.count_users_with_code(pattern) for pattern in before}
+    assert {pattern: after[pattern] - before[pattern] for pattern in before} == {
+        'E11.*': 2, 'E11.6*': 2, 'E11.9': 1, 'I10': 1}
+    onset = {row['year']: row['conditions'] for row in cohort.get_condition_onset_years()}
+    assert onset['1901'] - years.get('1901', 0) == 3
+
+
+def test_reads_within_the_interval_skip_the_refresh(database, cohort, monkeypatch):
+    calls = []
+    monkeypatch.setattr(cohort, 'refresh_rollups', lambda: calls.append(1))
+    monkeypatch.setattr(cohort, 'REFRESH_INTERVAL', 3600)
+    monkeypatch.setattr(cohort, '_last_refresh', None)
+    cohort.count_users_with_code('E11')
+    monkeypatch.setattr(cohort, '_last_refresh', cohort.time.monotonic())
+    cohort.count_users_with_code('E11')
+    cohort.get_condition_onset_years()
+    assert calls == [1]
+
+
+def test_reads_after_a_refresh_use_the_primary(database, cohort, monkeypatch):
+    calls = []
+
+    def get_db_connection(readonly=False, user_id=None):
+        calls.append(readonly)
+        return database.get_db_connection(readonly=readonly, user_id=user_id)
+
+    monkeypatch.setattr(cohort, 'get_db_connection', get_db_connection)
+    monkeypatch.setattr(cohort, 'REFRESH_INTERVAL', 3600)
+    monkeypatch.setattr(cohort, '_last_refresh', None)
+    cohort.count_users_with_code('E11')
+    monkeypatch.setattr(cohort, '_last_refresh', cohort.time.monotonic() - database.READ_YOUR_WRITES_SECONDS)
+    cohort.count_users_with_code('E11')
+    assert calls == [False, True]
+
+
+def test_background_refresh_drains_the_queue(database, new_user, monkeypatch):
+    monkeypatch.setattr(database, 'COHORT_REFRESH_INTERVAL', 0.05)
+    monkeypatch.setattr(database, '_rollup_refresher', None)
+    database.start_rollup_refresher()
+    database.save_conditions(new_user(), 'gorilla', {'entry': [condition('E11.9', '1901-02-03')]})
+    conn = database.get_db_connection()
+    try:
+        deadline = cohort_analytics.time.monotonic() + 5
+        while conn.execute("SELECT count(*) FROM cohort_rollup_deltas").fetchone()[0]:
+            conn.commit()
+            assert cohort_analytics.time.monotonic() < deadline
+            cohort_analytics.time.sleep(0.05)
+    finally:
+        conn.rollback()
+        database.release_db_connection(conn)
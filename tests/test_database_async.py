@@ -0,0 +1,27 @@
+import asyncio
+
+import pytest
+
+pytest.importorskip('psycopg')
+pytest.importorskip('dotenv')
+
+import database_async
+
+
+def test_pool_stats_outside_a_loop():
+    # No exception from synchronous code, with or without a pool
+    database_async.get_pool_stats()
+
+
+def test_pool_stats_of_the_background_loop(database):
+    assert database_async.run(database_async.get_user_by_username('no such user')) is None
+    stats = database_async.get_pool_stats()
+    assert stats is not None and stats['requests'] >= 1
+
+
+def test_pool_stats_inside_a_loop(database):
+    async def main():
+        await database_async.get_user_by_username('no such user')
+        return database_async.get_pool_stats()
+
+    assert asyncio.run(main())['requests'] >= 1
@@ -0,0 +1,74 @@
+from db_cache import MISSING, TTLCache
+
+
+def test_get_returns_a_copy():
+    cache = TTLCache()
+    cache.set(('profile', 1), {'name': 'a'})
+    value = cache.get(('profile', 1))
+    value['name'] = 'b'
+    assert cache.get(('profile', 1)) == {'name': 'a'}
+
+
+def test_invalidate_drops_entry():
+    cache = TTLCache()
+    cache.set(('profile', 1), 'x')
+    cache.invalidate(('profile', 1))
+    assert cache.get(('profile', 1)) is MISSING
+
+
+def test_stale_read_is_not_cached():
+    cache = TTLCache()
+    generation = cache.generation(('profile', 1))
+    cache.invalidate(('profile', 1))
+    cache.set(('profile', 1), 'stale', generation)
+    assert cache.get(('profile', 1)) is MISSING
+
+
+def test_current_read_is_cached():
+    cache = TTLCache()
+    cache.invalidate(('profile', 1))
+    generation = cache.generation(('profile', 1))
+    cache.set(('profile', 1), 'fresh', generation)
+    assert cache.get(('profile', 1)) == 'fresh'
+
+
+def test_clear_outdates_generations():
+    cache = TTLCache()
+    generation = cache.generation(('profile', 1))
+    cache.clear()
+    cache.set(('profile', 1), 'stale', generation)
+    assert cache.get(('profile', 1)) is MISSING
+
+
+def test_generations_stay_bounded():
+    cache = TTLCache(max_entries=2)
+    generation = cache.generation(('profile', 0))
+    cache.invalidate(('profile', 0))
+    for user_id in range(1, 5000):
+        cache.invalidate(('profile', user_id))
+    assert cache.stats()['generations'] <= 1024
+    # Forgetting the key's generation must not let the stale read back in
+    cache.set(('profile', 0), 'stale', generation)
+    assert cache.get(('profile', 0)) is MISSING
+
+
+def test_lru_eviction():
+    cache = TTLCache(max_entries=2)
+    cache.set(('profile', 1), 1)
+    cache.set(('profile', 2), 2)
+    cache.get(('profile', 1))
+    cache.set(('profile', 3), 3)
+    assert cache.get(('profile', 2)) is MISSING
+    assert cache.get(('profile', 1)) == 1
+    assert cache.stats()['evictions'] == 1
+
+
+def test_invalidate_user():
+    cache = TTLCache()
+    cache.set(('profile', 1), 'p')
+    cache.set(('conditions', 1), 'c')
+    cache.set(('profile', 2), 'other')
+    cache.invalidate_user(1)
+    assert cache.get(('profile', 1)) is MISSING
+    assert cache.get(('conditions', 1)) is MISSING
+    assert cache.get(('profile', 2)) == 'other'
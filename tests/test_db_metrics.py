@@ -0,0 +1,67 @@
+import pytest
+
+from db_metrics import Histogram, QueryMetrics, redact
+
+
+def test_histogram_buckets_and_percentiles():
+    histogram = Histogram(bounds=(1, 10, 100))
+    for value in (0.5, 0.5, 5, 50, 500):
+        histogram.record(value)
+    assert histogram.counts == [2, 1, 1, 1]
+    assert histogram.percentile(40) == 1
+    assert histogram.percentile(60) == 10
+    # The overflow bucket reports the largest value seen
+    assert histogram.percentile(100) == 500
+    snapshot = histogram.snapshot()
+    assert snapshot['count'] == 5
+    assert snapshot['mean'] == pytest.approx(111.2)
+
+
+def test_empty_histogram():
+    assert Histogram().percentile(99) == 0.0
+    assert Histogram().snapshot()['count'] == 0
+
+
+def test_instrument_records_calls_and_errors():
+    metrics = QueryMetrics()
+
+    @metrics.instrument
+    def ok():
+        return 1
+
+    @metrics.instrument
+    def fails():
+        raise RuntimeError("boom")
+
+    assert ok() == 1
+    with pytest.raises(RuntimeError):
+        fails()
+    functions = metrics.stats()['functions']
+    assert functions['ok']['calls'] == 1 and functions['ok']['errors'] == 0
+    assert functions['fails']['calls'] == 1 and functions['fails']['errors'] == 1
+
+
+def test_redact_hides_values():
+    assert redact({'name': 'Jane Doe', 'age': 41, 'note': None}) == {
+        'name': '<str len=8>', 'age': 41, 'note': None}
+    assert redact(None) is None
+
+
+def test_create_user_with_metrics_enabled(database, new_user, monkeypatch):
+    # Metrics are on by default; a statement must succeed and be counted
+    assert database._metrics.enabled
+    monkeypatch.setattr(database._metrics, 'bytes_sample_rate', 1)
+    database._metrics.reset()
+    user_id = new_user()
+    assert isinstance(user_id, int)
+    stats = database.get_query_stats()['functions']['create_user']
+    assert stats['calls'] == 1 and stats['errors'] == 0
+    assert stats['rows'] >= 1 and stats['bytes'] > 0
+
+
+def test_bytes_not_measured_at_zero_rate(database, new_user, monkeypatch):
+    monkeypatch.setattr(database._metrics, 'bytes_sample_rate', 0)
+    database._metrics.reset()
+    new_user()
+    stats = database.get_query_stats()['functions']['create_user']
+    assert stats['rows'] >= 1 and stats['bytes'] == 0
@@ -0,0 +1,161 @@
+import threading
+
+import pytest
+
+from db_pool import ConnectionPool, PoolTimeout, ReplicaSet
+
+
+class FakeConnection:
+    """
+    Just enough of a psycopg connection for the pool
+    """
+
+    def __init__(self):
+        self.closed = False
+        self.broken = False
+        self.rollbacks = 0
+        self.pings = 0
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def close(self):
+        self.closed = True
+
+
+class FakeCursor:
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def execute(self, query):
+        self.conn.pings += 1
+        if self.conn.closed or self.conn.broken:
+            raise RuntimeError("connection is closed")
+
+    def fetchone(self):
+        return (1,)
+
+    def close(self):
+        pass
+
+
+def test_reuses_returned_connection():
+    pool = ConnectionPool(FakeConnection, min_size=0, max_size=2)
+    conn = pool.getconn()
+    pool.putconn(conn)
+    assert pool.getconn() is conn
+    assert pool.stats()['connections_created'] == 1
+
+
+def test_putconn_rolls_back():
+    pool = ConnectionPool(FakeConnection, min_size=0, max_size=1, pre_ping=False)
+    conn = pool.getconn()
+    pool.putconn(conn)
+    assert conn.rollbacks == 1
+
+
+def test_times_out_when_exhausted():
+    pool = ConnectionPool(FakeConnection, min_size=0, max_size=1)
+    pool.getconn()
+    with pytest.raises(PoolTimeout):
+        pool.getconn(timeout=0.05)
+    assert pool.stats()['timeouts'] == 1
+
+
+def test_waiter_gets_returned_connection():
+    pool = ConnectionPool(FakeConnection, min_size=0, max_size=1)
+    conn = pool.getconn()
+    got = []
+    waiter = threading.Thread(target=lambda: got.append(pool.getconn(timeout=5)))
+    waiter.start()
+    pool.putconn(conn)
+    waiter.join(5)
+    assert got == [conn]
+
+
+def test_discards_broken_connection():
+    pool = ConnectionPool(FakeConnection, min_size=1, max_size=1)
+    conn = pool.getconn()
+    pool.putconn(conn)
+    conn.closed = True
+    replacement = pool.getconn()
+    assert replacement is not conn
+    stats = pool.stats()
+    assert stats['connections_discarded'] == 1 and stats['size'] == 1
+
+
+def test_recently_used_connection_is_not_pinged():
+    pool = ConnectionPool(FakeConnection, min_size=0, max_size=1, ping_idle=60)
+    conn = pool.getconn()
+    pool.putconn(conn)
+    assert pool.getconn() is conn
+    assert conn.pings == 0
+
+
+def test_long_idle_connection_is_pinged():
+    pool = ConnectionPool(FakeConnection, min_size=1, max_size=1, ping_idle=-1)
+    conn = pool.getconn()
+    assert conn.pings == 1
+    pool.putconn(conn)
+    conn.broken = True
+    replacement = pool.getconn()
+    assert replacement is not conn
+    assert pool.stats()['ping_failures'] == 1
+
+
+def test_failed_connect_frees_the_slot():
+    attempts = []
+
+    def connect():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise RuntimeError("refused")
+        return FakeConnection()
+
+    pool = ConnectionPool(connect, min_size=0, max_size=1)
+    with pytest.raises(RuntimeError):
+        pool.getconn()
+    assert pool.getconn() is not None
+
+
+def test_replica_set_round_robin_and_fallback():
+    pools = [ConnectionPool(FakeConnection, min_size=0, max_size=2) for _ in range(2)]
+    replicas = ReplicaSet(pools)
+    first, second = replicas.getconn(), replicas.getconn()
+    assert replicas.owns(first) and replicas.owns(second)
+    assert replicas.stats()['replicas'][0]['requests'] == 1
+    assert replicas.stats()['replicas'][1]['requests'] == 1
+    replicas.putconn(first)
+    assert not replicas.owns(first)
+
+
+def test_replica_set_skips_unhealthy_replica():
+    pools = [ConnectionPool(FakeConnection, min_size=0, max_size=2)]
+    replicas = ReplicaSet(pools, check=lambda conn: False, retry_interval=60)
+    assert replicas.getconn() is None
+    stats = replicas.stats()
+    assert stats['fallbacks'] == 1 and not stats['replicas'][0]['healthy']
+
+
+def test_replica_set_passes_over_a_busy_replica():
+    pools = [ConnectionPool(FakeConnection, min_size=0, max_size=1) for _ in range(2)]
+    replicas = ReplicaSet(pools, checkout_timeout=0.01)
+    held = [replicas.getconn(), replicas.getconn()]
+    assert replicas.getconn() is None
+    stats = replicas.stats()
+    assert all(replica['healthy'] and replica['busy'] == 1 for replica in stats['replicas'])
+    replicas.putconn(held[0])
+    assert replicas.getconn() is held[0]
+
+
+def test_replica_set_marks_unreachable_replica_down():
+    def refuse():
+        raise RuntimeError("refused")
+
+    replicas = ReplicaSet([ConnectionPool(refuse, min_size=0, max_size=1)], retry_interval=60)
+    assert replicas.getconn() is None
+    assert not replicas.stats()['replicas'][0]['healthy']
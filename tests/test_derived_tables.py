@@ -0,0 +1,58 @@
+import pytest
+
+pytest.importorskip('psycopg')
+pytest.importorskip('dotenv')
+
+# What the triggers derive from a user's documents, in a comparable order
+DERIVED_SQL = {
+    'entry_fingerprints': "SELECT kind, fingerprint FROM entry_fingerprints WHERE user_id = %s ORDER BY 1, 2",
+    'entry_condition_names': "SELECT kind, context, name FROM entry_condition_names WHERE user_id = %s ORDER BY 1, 2, 3",
+    'document_entries': "SELECT kind, entry_id, seq, sort_date, entry FROM document_entries WHERE user_id = %s "
+                        "ORDER BY 1, 2",
+    'user_summary': "SELECT conditions_total, conditions_active, condition_status_counts, condition_years, "
+                    "relatives FROM user_summary WHERE user_id = %s",
+    'cohort_facts': "SELECT kind, dimension, context, key, n FROM cohort_facts WHERE user_id = %s "
+                    "ORDER BY 1, 2, 3, 4",
+}
+
+
+def condition(name, status, code, year):
+    return {'resource': {'resourceType': 'Condition', 'code': {'text': name, 'coding': [
+        {'system': 'http://hl7.org/fhir/sid/icd-10-cm', 'code': code}]},
+        'assertedDate': f'{year}-03-04', 'clinicalStatus': {'coding': [{'code': status}]}}}
+
+
+def relative(code, condition_name):
+    return {'resource': {'resourceType': 'FamilyMemberHistory', 'relationship': {'coding': [{'code': code}]},
+                         'condition': [{'code': {'text': condition_name}}]}}
+
+
+def derived(conn, user_id):
+    return {table: conn.execute(sql, (user_id,)).fetchall() for table, sql in DERIVED_SQL.items()}
+
+
+def test_appends_match_a_full_recompute(database, new_user):
+    user_id = new_user()
+    database.save_conditions(user_id, 'gorilla', [condition('Asthma', 'active', 'J45.909', 2019)])
+    database.append_conditions(user_id, 'gorilla', [condition('Gout', 'inactive', 'M10.9', 2021)])
+    database.append_new_conditions(user_id, 'gorilla', [
+        condition('Gout', 'inactive', 'M10.9', 2021), condition('Asthma', 'resolved', 'J45.909', 2023)])
+    database.append_family_history_entries(user_id, 'gorilla', [relative('MTH', 'Asthma')])
+    database.append_family_history_entries(user_id, 'gorilla', [relative('FTH', 'Gout')])
+
+    conn = database.get_db_connection()
+    try:
+        incremental = derived(conn, user_id)
+        assert incremental['user_summary'][0][:2] == (3, 1)
+        deltas = conn.execute("SELECT count(*) FROM cohort_rollup_deltas").fetchone()[0]
+        for table in ('conditions', 'family_history'):
+            conn.execute(f"""
+                SELECT sync_document_derived_full(%s, user_id, fhir_document_entries(api_response), true)
+                FROM {table} WHERE user_id = %s
+            """, (table, user_id))
+        assert derived(conn, user_id) == incremental
+        # Nothing was left for the full recompute to queue for the rollups
+        assert conn.execute("SELECT count(*) FROM cohort_rollup_deltas").fetchone()[0] == deltas
+    finally:
+        conn.rollback()
+        database.release_db_connection(conn)
@@ -0,0 +1,22 @@
+import pytest
+
+pytest.importorskip('psycopg')
+pytest.importorskip('dotenv')
+
+
+def brother(condition):
+    return {'resource': {'resourceType': 'FamilyMemberHistory', 'gender': 'male',
+                         'relationship': {'text': 'Sibling', 'coding': [{'code': 'SIB', 'display': 'Sibling'}]},
+                         'condition': [{'code': {'text': condition, 'coding': [{'display': condition}]}}]}}
+
+
+def test_two_brothers_without_birth_dates_are_both_saved(database, new_user):
+    user_id = new_user()
+    duplicates, saved = database.append_new_family_history_entries(
+        user_id, 'gorilla', [brother('Asthma'), brother('Gout')])
+    assert (len(duplicates), len(saved)) == (0, 2)
+
+    duplicates, new_entries = database.split_duplicate_family_history(
+        user_id, [brother('Gout'), brother('Migraine'), brother('Migraine')])
+    assert [d['resource']['condition'][0]['code']['text'] for d in duplicates] == ['Gout', 'Migraine']
+    assert [e['resource']['condition'][0]['code']['text'] for e in new_entries] == ['Migraine']
@@ -0,0 +1,117 @@
+import copy
+import json
+
+import pytest
+
+from fhir_minimizer import IMO_EXTENSION_URL, PayloadMinimizer
+
+XHTML = '<div xmlns="http://www.w3.org/1999/xhtml">{}</div>'
+
+
+def condition(name, narrative=None):
+    return {'resource': {
+        'resourceType': 'Condition',
+        'id': name.lower().replace(' ', '-'),
+        'code': {'text': name, 'coding': [{'system': 'http://hl7.org/fhir/sid/icd-10-cm', 'code': 'E11.9'}]},
+        'clinicalStatus': {'coding': [{
+            'system': 'http://terminology.hl7.org/CodeSystem/condition-clinical', 'code': 'active'}]},
+        'category': [{'coding': [{
+            'system': 'http://terminology.hl7.org/CodeSystem/condition-category', 'code': 'PROBLEM'}]}],
+        'assertedDate': '2020-05-01',
+        'text': {'status': 'generated', 'div': XHTML.format(narrative or name)},
+        'meta': {'versionId': '1'},
+    }}
+
+
+def family_member():
+    imo = [{'url': IMO_EXTENSION_URL, 'valueString': json.dumps({'kndg_title': name, 'ICD10CM_CODE': code})}
+           for name, code in (('Asthma', 'J45.909'), ('Migraine', 'G43.909'))]
+    return {'resource': {
+        'resourceType': 'FamilyMemberHistory',
+        'relationship': {'text': 'Mother'},
+        'condition': [{'code': {'text': name}, 'extension': copy.deepcopy(imo)}
+                      for name in ('Asthma', 'Migraine')],
+        'note': None,
+    }}
+
+
+def documents():
+    return [
+        [condition('Type 2 diabetes'), condition('Asthma', 'Asthma, seen in clinic')],
+        {'resourceType': 'Bundle', 'type': 'searchset', 'entry': [family_member()]},
+    ]
+
+
+@pytest.mark.parametrize('document', documents())
+def test_lossless_round_trip(document):
+    minimizer = PayloadMinimizer('lossless')
+    minimized = minimizer.minimize(document)
+    assert len(json.dumps(minimized)) < len(json.dumps(document))
+    assert minimizer.rehydrate(minimized) == document
+
+
+def test_minimize_does_not_modify_its_argument():
+    document = documents()[0]
+    original = copy.deepcopy(document)
+    PayloadMinimizer('lossless').minimize(document)
+    assert document == original
+
+
+def test_off_returns_document_unchanged():
+    document = documents()[0]
+    assert PayloadMinimizer('off').minimize(document) is document
+
+
+def test_rehydrate_leaves_unminimized_documents_alone():
+    without_div = condition('Asthma')
+    without_div['resource']['text'] = {'status': 'empty'}
+    plain_div = condition('Migraine')
+    plain_div['resource']['text']['div'] = 'Migraine'
+    for document in documents() + [[without_div, plain_div]]:
+        for mode in ('off', 'lossless'):
+            assert PayloadMinimizer(mode).rehydrate(copy.deepcopy(document)) == document
+
+
+def test_off_does_not_rehydrate():
+    minimized = PayloadMinimizer('lossless').minimize(documents()[0])
+    assert PayloadMinimizer('off').rehydrate(copy.deepcopy(minimized)) == minimized
+
+
+def test_lossy_keeps_codes_names_dates_and_statuses():
+    minimized = PayloadMinimizer('lossy').minimize(documents()[0])
+    resource = minimized[0]['resource']
+    assert 'meta' not in resource and 'text' not in resource
+    assert resource['code'] == documents()[0][0]['resource']['code']
+    assert resource['assertedDate'] == '2020-05-01'
+    assert resource['clinicalStatus']['coding'][0]['code'] == 'active'
+
+
+def test_lossy_keeps_every_imo_code():
+    member = family_member()
+    for c in member['resource']['condition']:
+        for ext in c['extension']:
+            data = json.loads(ext['valueString'])
+            data.update(ICD10CM_TITLE=data['kndg_title'], SNOMEDCT_TITLE='Other title', SNOMEDCT_CODE=None)
+            ext['valueString'] = json.dumps(data)
+    minimizer = PayloadMinimizer('lossy')
+    minimized = minimizer.rehydrate(minimizer.minimize({'entry': [member]}))
+    conditions = minimized['entry'][0]['resource']['condition']
+    imo = [json.loads(ext['valueString']) for c in conditions for ext in c['extension']]
+    assert [data['ICD10CM_CODE'] for data in imo] == ['J45.909', 'G43.909'] * 2
+    assert imo[0] == {'kndg_title': 'Asthma', 'ICD10CM_CODE': 'J45.909', 'SNOMEDCT_TITLE': 'Other title'}
+    assert 'note' not in minimized['entry'][0]['resource']
+
+
+def test_unknown_mode():
+    with pytest.raises(ValueError):
+        PayloadMinimizer('tiny')
+
+
+@pytest.mark.parametrize('mode', ['lossless', 'lossy'])
+def test_condition_cards_keep_their_text(database, new_user, monkeypatch, mode):
+    monkeypatch.setattr(database, '_minimizer', PayloadMinimizer(mode=mode))
+    user_id = new_user()
+    database.save_conditions(user_id, 'gorilla', {'entry': [
+        condition('Asthma'), condition('Migraine', 'Migraine, since 2010')]})
+    cards = database.get_condition_summaries(user_id)
+    assert sorted(card['text'] for card in cards) == ['Asthma', 'Migraine, since 2010']
@@ -0,0 +1,44 @@
+import pytest
+
+pytest.importorskip('psycopg')
+pytest.importorskip('dotenv')
+
+from database import _match_near_duplicates, _trigram_similarity
+
+
+def test_similarity_matches_pg_trgm():
+    # Values from the pg_trgm documentation and similarity() on PostgreSQL
+    assert _trigram_similarity('word', 'two words') == pytest.approx(0.363636, abs=1e-6)
+    assert _trigram_similarity('type 2 diabetes', 'Diabetes, type 2') == 1.0
+    assert _trigram_similarity('', '') == 0.0
+
+
+def test_match_near_duplicates():
+    candidates = [('', 'asthma attack', 'Asthma attack'), ('', 'migraine', 'Migraine')]
+    saved = [('', 'asthma', 'Asthma'), ('', 'asthmatic attack', 'Asthmatic attack'),
+             ('mother', 'asthma attack', 'Asthma attack')]
+    rows = _match_near_duplicates(candidates, saved, 0.3, 5)
+    assert [(name, existing) for name, existing, _ in rows] == [
+        ('Asthma attack', 'Asthmatic attack'), ('Asthma attack', 'Asthma')]
+    assert rows[0][2] >= rows[1][2]
+    assert len(_match_near_duplicates(candidates, saved, 0.3, 1)) == 1
+
+
+def test_falls_back_when_pg_trgm_is_gone(database, new_user, monkeypatch):
+    condition = {'resource': {'resourceType': 'Condition', 'code': {'text': 'Type 2 diabetes mellitus'}}}
+    user_id = new_user()
+    database.save_conditions(user_id, 'gorilla', {'entry': [condition]})
+    connection = database.get_db_connection()
+    try:
+        installed = connection.execute(database._HAS_PG_TRGM_SQL).fetchone()[0]
+    finally:
+        database.release_db_connection(connection)
+    if installed:
+        pytest.skip("pg_trgm is installed")
+    # As if pg_trgm had been dropped after it was looked up
+    monkeypatch.setattr(database, '_pg_trgm_installed', True)
+    monkeypatch.setattr(database, '_pg_trgm_checked_at', database.time.monotonic())
+    similar = database.find_similar_conditions(user_id, [
+        {'resource': {'resourceType': 'Condition', 'code': {'text': 'Diabetes mellitus type 2'}}}])
+    assert [match['existing'] for match in similar] == ['Type 2 diabetes mellitus']
+    assert database._pg_trgm_installed is False
@@ -0,0 +1,21 @@
+import pytest
+
+pytest.importorskip('psycopg')
+pytest.importorskip('dotenv')
+
+from database import _decode_cursor, _encode_cursor
+
+
+def test_round_trip():
+    assert _decode_cursor(_encode_cursor('2024-01-31', 7)) == ('2024-01-31', 7)
+
+
+def test_cursor_is_url_safe():
+    cursor = _encode_cursor('2024-01-31', 123456)
+    assert all(c.isalnum() or c in '-_=' for c in cursor)
+
+
+@pytest.mark.parametrize('cursor', ['', 'not-a-cursor', 'WzFd'])
+def test_invalid_cursor(cursor):
+    with pytest.raises(ValueError):
+        _decode_cursor(cursor)
@@ -0,0 +1,43 @@
+import pytest
+
+pytest.importorskip('psycopg')
+pytest.importorskip('dotenv')
+
+
+def condition(name, date):
+    return {'resource': {'resourceType': 'Condition', 'id': name, 'code': {'text': name}, 'assertedDate': date,
+                         'clinicalStatus': {'coding': [{'code': 'active'}]}}}
+
+
+def relative(name):
+    return {'resource': {'resourceType': 'FamilyMemberHistory', 'id': name, 'name': name,
+                         'relationship': {'coding': [{'code': 'SIB'}]}}}
+
+
+def test_cursor_survives_deletes_and_replacements(database, new_user):
+    user_id = new_user()
+    database.save_conditions(user_id, 'gorilla', {'entry': [
+        condition('a', '2020-01-01'), condition('b', '2021-01-01'), condition('c', '2021-01-01'),
+        condition('d', '2022-01-01'), condition('e', '')]})
+    version = database.get_user_summary(user_id)['conditions_version']
+
+    first, cursor = database.get_conditions_page(user_id, cursor=None, limit=2, fields=('id',))
+    assert [row['id'] for row in first] == ['d', 'c']
+    # Both move the entries after them in the stored document
+    assert database.delete_condition_entry(user_id, 'a')
+    assert database.replace_condition_entry(user_id, 'b', condition('b', '2021-01-01'))
+    rest, cursor = database.get_conditions_page(user_id, cursor=cursor, limit=5, fields=('id',))
+    assert [row['id'] for row in rest] == ['b', 'e']
+    assert cursor is None
+    assert database.get_user_summary(user_id)['conditions_version'] == version + 2
+
+
+def test_family_history_pages(database, new_user):
+    user_id = new_user()
+    database.append_family_history_entries(user_id, 'gorilla', [relative(name) for name in 'abcd'])
+    first, cursor = database.get_family_history_page(user_id, limit=2)
+    assert [entry['resource']['id'] for entry in first] == ['d', 'c']
+    assert database.delete_family_history_entry(user_id, 'a')
+    rest, cursor = database.get_family_history_page(user_id, cursor=cursor, limit=2)
+    assert [entry['resource']['id'] for entry in rest] == ['b']
+    assert cursor is None
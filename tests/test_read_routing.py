@@ -0,0 +1,16 @@
+def test_new_user_reads_from_the_primary(database, new_user):
+    user_id = new_user()
+    assert database._reads_from_primary(user_id)
+
+
+def test_login_lookup_uses_the_primary(database, monkeypatch):
+    calls = []
+    get_db_connection = database.get_db_connection
+
+    def spy(*args, **kwargs):
+        calls.append(kwargs.get('readonly', args[0] if args else False))
+        return get_db_connection(*args, **kwargs)
+
+    monkeypatch.setattr(database, 'get_db_connection', spy)
+    assert database.get_user_by_username('no such user') is None
+    assert calls == [False]
@@ -0,0 +1,9 @@
+import json
+
+
+def test_download_keeps_the_indented_format(database, new_user):
+    user_id = new_user()
+    database.save_profile(user_id, 'gorilla', {'resourceType': 'Patient', 'name': [{'text': 'Test Patient'}]})
+    document = database.get_all_user_data_json(user_id, indent=2)
+    assert document == json.dumps(database.get_all_user_data(user_id), indent=2)
+    assert json.loads(database.get_all_user_data_json(user_id)) == json.loads(document)
@@ -0,0 +1,31 @@
+def condition(name, status):
+    return {'resource': {'resourceType': 'Condition', 'code': {'text': name}, 'assertedDate': '2021-03-04',
+                         'clinicalStatus': {'coding': [{'code': status}]}}}
+
+
+def test_summary_follows_writes(database, new_user):
+    user_id = new_user()
+    database.save_conditions(user_id, 'gorilla', {'entry': [
+        condition('Asthma', 'active'), condition('Migraine', 'resolved')]})
+    summary = database.get_user_summary(user_id)
+    assert (summary['conditions_total'], summary['conditions_active']) == (2, 1)
+
+    conn = database.get_db_connection()
+    try:
+        conn.execute("DELETE FROM conditions WHERE user_id = %s", (user_id,))
+        conn.commit()
+    finally:
+        database.release_db_connection(conn)
+    assert database.get_user_summary(user_id)['conditions_total'] == 0
+
+
+def test_user_with_documents_can_be_deleted(database, new_user):
+    user_id = new_user()
+    database.save_conditions(user_id, 'gorilla', {'entry': [condition('Asthma', 'active')]})
+    conn = database.get_db_connection()
+    try:
+        conn.execute("DELETE FROM users WHERE id = %s", (user_id,))
+        conn.commit()
+        assert conn.execute("SELECT count(*) FROM user_summary WHERE user_id = %s", (user_id,)).fetchone()[0] == 0
+    finally:
+        database.release_db_connection(conn)